@@ -1,17 +1,28 @@
 import os
-import io
+import json
 import mimetypes
 import time
 import logging
 import openai
-from flask import Flask, request, jsonify, send_file, abort
-from azure.identity import DefaultAzureCredential
-from azure.search.documents import SearchClient
+from typing import AsyncGenerator, Optional
+import aiofiles
+from quart import Quart, request, jsonify, make_response, abort
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError
+from azure.identity.aio import DefaultAzureCredential
+from azure.search.documents.aio import SearchClient
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.readretrieveread import ReadRetrieveReadApproach
 from approaches.readdecomposeask import ReadDecomposeAsk
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
-from azure.storage.blob import BlobServiceClient
+from cache import InMemoryCache, create_cache
+from contentcache import DiskBlobCache, parse_range
+from localsearch import LocalSearchClient, LocalSearchIndex
+from openaipool import OpenAIPool, parse_tpm_limits
+from retrieval import IndexGeneration, RetrievalService
+import telemetry
+from vectorindex import VectorIndex, create_embedder
+from azure.storage.blob.aio import BlobServiceClient
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.environ.get("AZURE_STORAGE_ACCOUNT") or "mystorageaccount"
@@ -23,108 +34,412 @@ AZURE_OPENAI_GPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_DEPLOYMENT") or "
 AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_CHATGPT_DEPLOYMENT") or "chat"
 AZURE_OPENAI_CHATGPT_MODEL = os.environ.get("AZURE_OPENAI_CHATGPT_MODEL") or "gpt-35-turbo"
 
+# Token budget of the chat prompt (instructions, sources and history), defaults to what the model's context window
+# leaves after the answer. Lower-ranked sources are truncated or dropped to stay within it
+CHATGPT_MAX_PROMPT_TOKENS = int(os.environ.get("CHATGPT_MAX_PROMPT_TOKENS") or 0) or None
+
 KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
 KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "category"
 KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "sourcepage"
 
-# Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed, 
-# just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the 
-# keys for each service
-# If you encounter a blocking error during a DefaultAzureCredntial resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
-azure_credential = DefaultAzureCredential()
-
-# Used by the OpenAI SDK
-openai.api_type = "azure"
-openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
-openai.api_version = "2023-05-15"
-
-# Comment these two lines out if using keys, set your API key in the OPENAI_API_KEY environment variable instead
-openai.api_type = "azure_ad"
-openai_token = azure_credential.get_token("https://cognitiveservices.azure.com/.default")
-openai.api_key = openai_token.token
-
-# Set up clients for Cognitive Search and Storage
-search_client = SearchClient(
-    endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-    index_name=AZURE_SEARCH_INDEX,
-    credential=azure_credential)
-blob_client = BlobServiceClient(
-    account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", 
-    credential=azure_credential)
-blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
-
-# Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
-# or some derivative, here we include several for exploration purposes
-ask_approaches = {
-    "rtr": RetrieveThenReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT),
-    "rrr": ReadRetrieveReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT),
-    "rda": ReadDecomposeAsk(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
-}
-
-chat_approaches = {
-    "rrr": ChatReadRetrieveReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, AZURE_OPENAI_CHATGPT_MODEL, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
-}
-
-app = Flask(__name__)
+# Caching of generated search queries and search results. Set CACHE_REDIS_URL to share the caches between processes
+# and instances, otherwise each process keeps its own LRU caches of up to *_CACHE_MAX_ENTRIES entries
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL") or None
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_MAX_ENTRIES") or 1000)
+QUERY_CACHE_TTL_SECONDS = float(os.environ.get("QUERY_CACHE_TTL_SECONDS") or 3600)
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES") or 1000)
+SEARCH_CACHE_TTL_SECONDS = float(os.environ.get("SEARCH_CACHE_TTL_SECONDS") or 600)
+# How often to check whether prepdocs.py has updated the index, cached search results from older runs are discarded
+INDEX_GENERATION_REFRESH_SECONDS = float(os.environ.get("INDEX_GENERATION_REFRESH_SECONDS") or 30)
+
+# Content files are streamed in chunks of CONTENT_CHUNK_SIZE bytes and browsers may reuse them for
+# CONTENT_MAX_AGE_SECONDS before revalidating. Set CONTENT_CACHE_DIR to keep up to CONTENT_CACHE_MAX_BYTES of hot
+# blobs on local disk instead of downloading them from storage for every request
+CONTENT_CHUNK_SIZE = int(os.environ.get("CONTENT_CHUNK_SIZE") or 1024 * 1024)
+CONTENT_MAX_AGE_SECONDS = int(os.environ.get("CONTENT_MAX_AGE_SECONDS") or 3600)
+CONTENT_CACHE_DIR = os.environ.get("CONTENT_CACHE_DIR") or None
+CONTENT_CACHE_MAX_BYTES = int(os.environ.get("CONTENT_CACHE_MAX_BYTES") or 512 * 1024 * 1024)
+
+# Limits of /ask_batch: questions per request, and requests to the approach (groups of questions for approaches that
+# send several prompts per call) in flight at a time for each batch
+ASK_BATCH_MAX_QUESTIONS = int(os.environ.get("ASK_BATCH_MAX_QUESTIONS") or 5000)
+ASK_BATCH_CONCURRENCY = int(os.environ.get("ASK_BATCH_CONCURRENCY") or 8)
+
+# Local vector index written by prepdocs.py --vectorindex. When set, searches default to RETRIEVAL_MODE "hybrid", which
+# fuses the keyword results of Cognitive Search with the closest sections by embedding. VECTOR_INDEX_NPROBE is the
+# number of clusters scanned per query on large indexes, 0 scans every vector. Queries are embedded with the embedder
+# recorded in the index, AZURE_OPENAI_EMB_DEPLOYMENT overrides the deployment of an OpenAI embedding model
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR") or None
+VECTOR_INDEX_NPROBE = int(os.environ.get("VECTOR_INDEX_NPROBE") or 16) or None
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE") or None
+AZURE_OPENAI_EMB_DEPLOYMENT = os.environ.get("AZURE_OPENAI_EMB_DEPLOYMENT") or None
+
+# Local BM25 index written by prepdocs.py --localsearchindex. When set, it's searched instead of Cognitive Search, to
+# develop and load test without a search service or to serve small deployments. Semantic ranking isn't available
+LOCAL_SEARCH_INDEX_DIR = os.environ.get("LOCAL_SEARCH_INDEX_DIR") or None
+
+# Searches only download the fields the approaches use. With SEARCH_TWO_PHASE, sections are ranked first and their
+# content is then fetched in rank order for the ones that fit in SEARCH_CONTENT_TOKEN_BUDGET tokens (0 for no budget),
+# requests can still choose with the two_phase_search override
+SEARCH_TWO_PHASE = (os.environ.get("SEARCH_TWO_PHASE") or "false").lower() == "true"
+SEARCH_CONTENT_TOKEN_BUDGET = int(os.environ.get("SEARCH_CONTENT_TOKEN_BUDGET") or 2000) or None
+
+# With ADAPTIVE_RETRIEVAL, searches fetch at least ADAPTIVE_CANDIDATES results and keep those scoring at least
+# ADAPTIVE_RELATIVE_CUTOFF times the best one within SEARCH_CONTENT_TOKEN_BUDGET, instead of a fixed top. When the best
+# keyword result scores below SEARCH_MIN_SCORE (BM25, or 0 to 4 with the semantic ranker) or the best vector result
+# below VECTOR_MIN_SCORE (cosine similarity, at most 1), rtr and chat answer that they don't know without a completion.
+# The reciprocal rank fusion scores of hybrid search are at most 2 / 61 whatever the relevance, so in hybrid mode the
+# keyword and vector rankings are each cut with their own minimum before they're fused, and there's no answer when
+# neither keeps a result. Requests can choose with the adaptive_retrieval, minimum_search_score and
+# minimum_vector_score overrides
+ADAPTIVE_RETRIEVAL = (os.environ.get("ADAPTIVE_RETRIEVAL") or "false").lower() == "true"
+ADAPTIVE_CANDIDATES = int(os.environ.get("ADAPTIVE_CANDIDATES") or 10)
+ADAPTIVE_RELATIVE_CUTOFF = float(os.environ.get("ADAPTIVE_RELATIVE_CUTOFF") or 0.5)
+SEARCH_MIN_SCORE = float(os.environ.get("SEARCH_MIN_SCORE") or 0)
+VECTOR_MIN_SCORE = float(os.environ.get("VECTOR_MIN_SCORE") or 0)
+
+# Let the rda approach run independent actions of a step concurrently by default, requests can still choose with the
+# parallel_actions override
+RDA_PARALLEL_ACTIONS = (os.environ.get("RDA_PARALLEL_ACTIONS") or "false").lower() == "true"
+
+# The agent approaches compile their prompts and agents once for each combination of prompt overrides, temperature
+# and deployment, and keep up to this many of them
+AGENT_CACHE_MAX_ENTRIES = int(os.environ.get("AGENT_CACHE_MAX_ENTRIES") or 64)
+
+# Completions are spread over the deployments of AZURE_OPENAI_SERVICE and of these additional services (comma-separated
+# names, for example in other regions), which must have deployments with the same names. AZURE_OPENAI_TPM_LIMITS
+# ("chat=120000,davinci=60000") keeps each deployment within its tokens-per-minute quota on every service. Throttled
+# and failed requests are retried up to OPENAI_MAX_RETRIES times, on another service when there is one
+AZURE_OPENAI_EXTRA_SERVICES = [s.strip() for s in (os.environ.get("AZURE_OPENAI_EXTRA_SERVICES") or "").split(",") if s.strip()]
+AZURE_OPENAI_TPM_LIMITS = parse_tpm_limits(os.environ.get("AZURE_OPENAI_TPM_LIMITS"))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES") or 5)
+
+# Telemetry, off by default and free when off. Set OTEL_EXPORTER_OTLP_ENDPOINT (and the other standard OTEL_* variables
+# as needed) to trace each request through query rewriting, search and completions, and PROMETHEUS_METRICS to expose
+# stage latencies and OpenAI token usage at /metrics. Each needs its optional packages, see README.md
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT") or None
+OTEL_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME") or "azure-search-openai-demo"
+PROMETHEUS_METRICS = (os.environ.get("PROMETHEUS_METRICS") or "false").lower() == "true"
+
+# Keys used to store the shared clients and approaches in the app config
+CONFIG_OPENAI_TOKEN = "openai_token"
+CONFIG_CREDENTIAL = "azure_credential"
+CONFIG_SEARCH_CLIENT = "search_client"
+CONFIG_BLOB_CLIENT = "blob_client"
+CONFIG_BLOB_CONTAINER = "blob_container"
+CONFIG_ASK_APPROACHES = "ask_approaches"
+CONFIG_CHAT_APPROACHES = "chat_approaches"
+CONFIG_CACHES = "caches"
+CONFIG_OPENAI_POOL = "openai_pool"
+
+app = Quart(__name__)
 
 @app.route("/", defaults={"path": "index.html"})
 @app.route("/<path:path>")
-def static_file(path):
-    return app.send_static_file(path)
+async def static_file(path):
+    return await app.send_static_file(path)
 
-# Serve content files from blob storage from within the app to keep the example self-contained. 
+# Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. Blobs are streamed in chunks, with support for range requests and revalidation
+# through their ETag, and hot blobs can be kept in a local disk cache (see CONTENT_CACHE_DIR).
 @app.route("/content/<path>")
-def content_file(path):
-    blob = blob_container.get_blob_client(path).download_blob()
-    if not blob.properties or not blob.properties.has_key("content_settings"):
+async def content_file(path):
+    blob_client = app.config[CONFIG_BLOB_CONTAINER].get_blob_client(path)
+    try:
+        properties = await blob_client.get_blob_properties()
+    except ResourceNotFoundError:
         abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
+    etag = properties.etag
+    size = properties.size
+    mime_type = properties.content_settings.content_type if properties.content_settings else None
+    if not mime_type or mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    blob.readinto(blob_file)
-    blob_file.seek(0)
-    return send_file(blob_file, mimetype=mime_type, as_attachment=False, download_name=path)
-    
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={CONTENT_MAX_AGE_SECONDS}", "Accept-Ranges": "bytes"}
+
+    if etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+        return await make_response("", 304, headers)
+
+    # A range is only honored for the version of the blob the client already has part of
+    if_range = request.headers.get("If-Range")
+    try:
+        byte_range = parse_range(request.headers.get("Range"), size) if not if_range or if_range == etag else None
+    except ValueError:
+        return await make_response("", 416, {**headers, "Content-Range": f"bytes */{size}"})
+    start, end = byte_range if byte_range else (0, size - 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    if request.method == "HEAD":
+        body = ""
+    else:
+        content_cache = app.config[CONFIG_CACHES].get("content")
+        cached_path = content_cache.get(path, etag) if content_cache else None
+        if cached_path:
+            body = stream_file(cached_path, start, end - start + 1)
+        else:
+            # Only complete downloads of blobs small enough to be cached are written to the cache
+            cache_to = content_cache if content_cache and not byte_range and size <= content_cache.max_file_bytes else None
+            body = stream_blob(blob_client, etag, start, end - start + 1, cache_to)
+    response = await make_response(body, 206 if byte_range else 200, headers)
+    response.mimetype = mime_type
+    response.headers["Content-Length"] = str(end - start + 1)
+    response.timeout = None
+    return response
+
+async def stream_file(file_path: str, offset: int, length: int) -> AsyncGenerator[bytes, None]:
+    async with aiofiles.open(file_path, "rb") as f:
+        await f.seek(offset)
+        while length > 0:
+            chunk = await f.read(min(CONTENT_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+async def stream_blob(blob_client, etag: str, offset: int, length: int, content_cache: Optional[DiskBlobCache] = None) -> AsyncGenerator[bytes, None]:
+    """Streams the blob chunk by chunk, and writes the whole blob to the content cache along the way when one is given."""
+    if length <= 0:
+        return
+    # Fail rather than mix two versions of the blob if it's replaced while being downloaded
+    downloader = await blob_client.download_blob(offset=offset, length=length, etag=etag, match_condition=MatchConditions.IfNotModified)
+    if not content_cache:
+        async for chunk in downloader.chunks():
+            yield chunk
+        return
+    temp_path = content_cache.temp_path(blob_client.blob_name, etag)
+    try:
+        async with aiofiles.open(temp_path, "wb") as f:
+            async for chunk in downloader.chunks():
+                await f.write(chunk)
+                yield chunk
+        content_cache.add(blob_client.blob_name, etag, temp_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
 @app.route("/ask", methods=["POST"])
-def ask():
-    ensure_openai_token()
-    if not request.json:
+async def ask():
+    await ensure_openai_token()
+    request_json = await request.get_json()
+    if not request_json:
         return jsonify({"error": "request must be json"}), 400
-    approach = request.json["approach"]
+    approach = request_json["approach"]
     try:
-        impl = ask_approaches.get(approach)
+        impl = app.config[CONFIG_ASK_APPROACHES].get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["question"], request.json.get("overrides") or {})
+        with telemetry.request("/ask", approach):
+            r = await impl.run(request_json["question"], request_json.get("overrides") or {})
         return jsonify(r)
+    except openai.error.RateLimitError as e:
+        return rate_limited(e)
     except Exception as e:
         logging.exception("Exception in /ask")
         return jsonify({"error": str(e)}), 500
-    
+
+# Answers a list of questions with shared overrides, streaming one NDJSON line per question as answers come in
+# (in completion order, each line has the index of its question). Meant for evaluation jobs and bulk testing
+@app.route("/ask_batch", methods=["POST"])
+async def ask_batch():
+    await ensure_openai_token()
+    request_json = await request.get_json()
+    if not request_json:
+        return jsonify({"error": "request must be json"}), 400
+    approach = request_json["approach"]
+    questions = request_json.get("questions")
+    if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+        return jsonify({"error": "questions must be a list of strings"}), 400
+    if len(questions) > ASK_BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"at most {ASK_BATCH_MAX_QUESTIONS} questions can be sent in one batch"}), 400
+    try:
+        impl = app.config[CONFIG_ASK_APPROACHES].get(approach)
+        if not impl:
+            return jsonify({"error": "unknown approach"}), 400
+        response_generator = telemetry.streamed_request("/ask_batch", approach,
+            impl.run_batch(questions, request_json.get("overrides") or {}, max_concurrency=ASK_BATCH_CONCURRENCY))
+        response = await make_response(format_as_ndjson(response_generator))
+        response.timeout = None
+        response.mimetype = "application/x-ndjson"
+        return response
+    except Exception as e:
+        logging.exception("Exception in /ask_batch")
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/chat", methods=["POST"])
-def chat():
-    ensure_openai_token()
-    if not request.json:
+async def chat():
+    await ensure_openai_token()
+    request_json = await request.get_json()
+    if not request_json:
         return jsonify({"error": "request must be json"}), 400
-    approach = request.json["approach"]
+    approach = request_json["approach"]
     try:
-        impl = chat_approaches.get(approach)
+        impl = app.config[CONFIG_CHAT_APPROACHES].get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["history"], request.json.get("overrides") or {})
+        with telemetry.request("/chat", approach):
+            r = await impl.run(request_json["history"], request_json.get("overrides") or {})
         return jsonify(r)
+    except openai.error.RateLimitError as e:
+        return rate_limited(e)
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
 
-def ensure_openai_token():
-    global openai_token
+@app.route("/cache_stats", methods=["GET"])
+async def cache_stats():
+    return jsonify({name: cache.stats() for name, cache in app.config[CONFIG_CACHES].items()})
+
+# Requests, throttling, token usage and latency of each OpenAI deployment
+@app.route("/openai_stats", methods=["GET"])
+async def openai_stats():
+    return jsonify(app.config[CONFIG_OPENAI_POOL].stats())
+
+# Prometheus metrics, when PROMETHEUS_METRICS is set
+@app.route("/metrics", methods=["GET"])
+async def metrics():
+    if not isinstance(telemetry.metrics, telemetry.PrometheusMetrics):
+        abort(404)
+    body, content_type = telemetry.metrics.render()
+    return body, 200, {"Content-Type": content_type}
+
+def retry_after(e: openai.error.RateLimitError) -> str:
+    return (e.headers or {}).get("Retry-After") or "10"
+
+def rate_limited(e: openai.error.RateLimitError):
+    # Every deployment stayed throttled through the retries, tell the client when to come back rather than failing
+    logging.warning("OpenAI rate limit: %s", e)
+    return jsonify({"error": "The service is busy, please retry later"}), 429, {"Retry-After": retry_after(e)}
+
+async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+    # The generator only runs once the response is being sent, so its errors can't change the status any more
+    try:
+        async for event in r:
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    except openai.error.RateLimitError as e:
+        # Like rate_limited, the client is told when to come back but in the last line of the stream
+        logging.warning("OpenAI rate limit: %s", e)
+        yield json.dumps({"error": "The service is busy, please retry later", "retry_after": float(retry_after(e))}) + "\n"
+    except Exception as e:
+        # Headers are already sent at this point, so report the error in-band as the last line of the stream
+        logging.exception("Exception while generating response stream")
+        yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+
+@app.route("/chat_stream", methods=["POST"])
+async def chat_stream():
+    await ensure_openai_token()
+    request_json = await request.get_json()
+    if not request_json:
+        return jsonify({"error": "request must be json"}), 400
+    approach = request_json["approach"]
+    try:
+        impl = app.config[CONFIG_CHAT_APPROACHES].get(approach)
+        if not impl:
+            return jsonify({"error": "unknown approach"}), 400
+        response_generator = telemetry.streamed_request("/chat_stream", approach,
+            impl.run_with_streaming(request_json["history"], request_json.get("overrides") or {}))
+        response = await make_response(format_as_ndjson(response_generator))
+        response.timeout = None
+        response.mimetype = "application/x-ndjson"
+        return response
+    except Exception as e:
+        logging.exception("Exception in /chat_stream")
+        return jsonify({"error": str(e)}), 500
+
+async def ensure_openai_token():
+    openai_token = app.config[CONFIG_OPENAI_TOKEN]
     if openai_token.expires_on < int(time.time()) - 60:
-        openai_token = azure_credential.get_token("https://cognitiveservices.azure.com/.default")
+        openai_token = await app.config[CONFIG_CREDENTIAL].get_token("https://cognitiveservices.azure.com/.default")
+        app.config[CONFIG_OPENAI_TOKEN] = openai_token
         openai.api_key = openai_token.token
-    
+
+@app.before_serving
+async def setup_clients():
+    # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed,
+    # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
+    # keys for each service
+    # If you encounter a blocking error during a DefaultAzureCredntial resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
+    azure_credential = DefaultAzureCredential()
+
+    # Used by the OpenAI SDK
+    openai.api_type = "azure"
+    openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+    openai.api_version = "2023-05-15"
+
+    # Comment these two lines out if using keys, set your API key in the OPENAI_API_KEY environment variable instead
+    openai.api_type = "azure_ad"
+    openai_token = await azure_credential.get_token("https://cognitiveservices.azure.com/.default")
+    openai.api_key = openai_token.token
+    telemetry.configure(telemetry.create_tracer(OTEL_SERVICE_NAME) if OTEL_EXPORTER_OTLP_ENDPOINT else None,
+                        telemetry.PrometheusMetrics() if PROMETHEUS_METRICS else None)
+
+    openai_pool = OpenAIPool([AZURE_OPENAI_SERVICE] + AZURE_OPENAI_EXTRA_SERVICES, AZURE_OPENAI_TPM_LIMITS, max_retries=OPENAI_MAX_RETRIES)
+    app.config[CONFIG_OPENAI_POOL] = openai_pool
+
+    # Set up clients for Cognitive Search and Storage. The async clients keep a pooled connection per service, so a
+    # single process can keep many requests in flight while they wait on the network
+    if LOCAL_SEARCH_INDEX_DIR:
+        search_client = LocalSearchClient(LocalSearchIndex.load(LOCAL_SEARCH_INDEX_DIR))
+    else:
+        search_client = SearchClient(
+            endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+            index_name=AZURE_SEARCH_INDEX,
+            credential=azure_credential)
+    # Downloads are requested in chunks of CONTENT_CHUNK_SIZE, so serving a large file doesn't buffer it in memory
+    blob_client = BlobServiceClient(
+        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=azure_credential,
+        max_single_get_size=CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=CONTENT_CHUNK_SIZE)
+    blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+
+    app.config[CONFIG_CREDENTIAL] = azure_credential
+    app.config[CONFIG_OPENAI_TOKEN] = openai_token
+    app.config[CONFIG_SEARCH_CLIENT] = search_client
+    app.config[CONFIG_BLOB_CLIENT] = blob_client
+    app.config[CONFIG_BLOB_CONTAINER] = blob_container
+
+    query_cache = create_cache("query", CACHE_REDIS_URL, QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL_SECONDS)
+    search_cache = create_cache("search", CACHE_REDIS_URL, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_SECONDS)
+    # Compiled agents hold live objects, so they are always cached in the process
+    agent_cache = InMemoryCache("agents", AGENT_CACHE_MAX_ENTRIES, ttl_seconds=float("inf"))
+    app.config[CONFIG_CACHES] = {"query": query_cache, "search": search_cache, "agents": agent_cache}
+    if CONTENT_CACHE_DIR:
+        app.config[CONFIG_CACHES]["content"] = DiskBlobCache(CONTENT_CACHE_DIR, CONTENT_CACHE_MAX_BYTES)
+
+    # All approaches query the index through the same retrieval service so they share cached results
+    vector_index = embedder = None
+    if VECTOR_INDEX_DIR:
+        vector_index = VectorIndex.load(VECTOR_INDEX_DIR)
+        embedder = create_embedder(vector_index.embedder_config, AZURE_OPENAI_EMB_DEPLOYMENT)
+    retrieval = RetrievalService(search_client, cache=search_cache, index_generation=IndexGeneration(blob_container, INDEX_GENERATION_REFRESH_SECONDS),
+                                 vector_index=vector_index, embedder=embedder, default_mode=RETRIEVAL_MODE, nprobe=VECTOR_INDEX_NPROBE,
+                                 sourcepage_field=KB_FIELDS_SOURCEPAGE, content_field=KB_FIELDS_CONTENT,
+                                 two_phase=SEARCH_TWO_PHASE, content_token_budget=SEARCH_CONTENT_TOKEN_BUDGET,
+                                 adaptive=ADAPTIVE_RETRIEVAL, adaptive_candidates=ADAPTIVE_CANDIDATES,
+                                 relative_score_cutoff=ADAPTIVE_RELATIVE_CUTOFF, min_score=SEARCH_MIN_SCORE,
+                                 min_vector_score=VECTOR_MIN_SCORE)
+
+    # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
+    # or some derivative, here we include several for exploration purposes
+    app.config[CONFIG_ASK_APPROACHES] = {
+        "rtr": RetrieveThenReadApproach(retrieval, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, openai_pool=openai_pool),
+        "rrr": ReadRetrieveReadApproach(retrieval, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, agent_cache=agent_cache, openai_pool=openai_pool),
+        "rda": ReadDecomposeAsk(retrieval, AZURE_OPENAI_CHATGPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, parallel_actions=RDA_PARALLEL_ACTIONS, agent_cache=agent_cache, openai_pool=openai_pool)
+    }
+
+    app.config[CONFIG_CHAT_APPROACHES] = {
+        "rrr": ChatReadRetrieveReadApproach(retrieval, AZURE_OPENAI_CHATGPT_DEPLOYMENT, AZURE_OPENAI_CHATGPT_MODEL, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, query_cache=query_cache, max_prompt_tokens=CHATGPT_MAX_PROMPT_TOKENS, openai_pool=openai_pool)
+    }
+
+@app.after_serving
+async def close_clients():
+    await app.config[CONFIG_SEARCH_CLIENT].close()
+    await app.config[CONFIG_BLOB_CLIENT].close()
+    await app.config[CONFIG_CREDENTIAL].close()
+    await app.config[CONFIG_OPENAI_POOL].close()
+    for cache in app.config[CONFIG_CACHES].values():
+        await cache.close()
+
 if __name__ == "__main__":
     app.run()
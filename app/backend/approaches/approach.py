@@ -1,6 +1,74 @@
-from typing import Any
+import asyncio
+import contextvars
+from typing import Any, AsyncGenerator, Optional, Sequence
 
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.callbacks.manager import CallbackManager
+from langchainadapters import HtmlCallbackHandler
+
+def include_thoughts(overrides: dict[str, Any]) -> bool:
+    """Whether to return the thought process, which clients that only show answers can turn off with include_thoughts."""
+    return overrides.get("include_thoughts") is not False
+
+class RequestContext:
+    """
+    State of a single request. One approach instance serves every request of the app, concurrently in asyncio tasks
+    or threads, so whatever a request collects while it runs is kept here and never on the approach.
+    """
+
+    def __init__(self, overrides: dict[str, Any]):
+        self.overrides = overrides
+        self.data_points: list[str] = []
+        # Captures the thought process during the iterations of agents, unless the client doesn't want it
+        self.cb_handler = HtmlCallbackHandler() if include_thoughts(overrides) else None
+        self.callbacks = CallbackManager(handlers=[self.cb_handler] if self.cb_handler else [])
+
+    def thoughts(self) -> Optional[str]:
+        return self.cb_handler.render() if self.cb_handler else None
+
+# The request an approach is answering in the current asyncio task or thread. Agents and their tools are cached and
+# shared by every request, so the tools find the state of the request they run for here
+current_request: contextvars.ContextVar[RequestContext] = contextvars.ContextVar("current_request")
+
+class CurrentRequestCallbackHandler(AsyncCallbackHandler):
+    """
+    Callbacks of the tools of cached agents. The callbacks passed when running an agent don't reach its tools, so the
+    tools forward their events to the handler of the request they run for. It's async so that it runs in the task of
+    the request, LangChain runs synchronous handlers in a thread pool where current_request isn't set.
+    """
+
+    async def on_tool_start(self, *args: Any, **kwargs: Any) -> None:
+        cb_handler = current_request.get().cb_handler
+        if cb_handler:
+            cb_handler.on_tool_start(*args, **kwargs)
+
+    async def on_tool_end(self, *args: Any, **kwargs: Any) -> None:
+        cb_handler = current_request.get().cb_handler
+        if cb_handler:
+            cb_handler.on_tool_end(*args, **kwargs)
+
+    async def on_tool_error(self, *args: Any, **kwargs: Any) -> None:
+        cb_handler = current_request.get().cb_handler
+        if cb_handler:
+            cb_handler.on_tool_error(*args, **kwargs)
 
 class Approach:
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
         raise NotImplementedError
+
+    async def run_batch(self, questions: Sequence[str], overrides: dict[str, Any], max_concurrency: int = 8) -> AsyncGenerator[dict[str, Any], None]:
+        """
+        Answers many questions with the same overrides, up to max_concurrency at a time. Yields one result per
+        question as soon as it's ready, with the index of the question and either the result of run or an error.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def answer(i: int, q: str) -> dict[str, Any]:
+            async with semaphore:
+                try:
+                    return {"index": i, "question": q, **await self.run(q, overrides)}
+                except Exception as e:
+                    return {"index": i, "question": q, "error": str(e)}
+
+        for result in asyncio.as_completed([answer(i, q) for i, q in enumerate(questions)]):
+            yield await result
@@ -1,10 +1,12 @@
-from typing import Any, Sequence
+from typing import Any, AsyncGenerator, Coroutine, Optional, Sequence
 
 import openai
-import tiktoken
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
-from approaches.approach import Approach
+import telemetry
+from approaches.approach import Approach, include_thoughts
+from cache import Cache, make_key, normalize_text
+from openaipool import OpenAIPool
+from promptbuilder import MODEL_CONTEXT_WINDOWS, PromptBuilder, get_encoding
+from retrieval import RetrievalService
 from text import nonewlines
 
 class ChatReadRetrieveReadApproach(Approach):
@@ -20,6 +22,10 @@ class ChatReadRetrieveReadApproach(Approach):
     """
 
     MAX_HISTORY = 3
+    MAX_COMPLETION_TOKENS = 1500
+
+    # Answer when adaptive retrieval finds no relevant source, which the system message would make the model say anyway
+    no_answer = "ขออภัยครับ ผมไม่พบข้อมูลเกี่ยวกับคำถามนี้ในเอกสารของธนาคาร จึงไม่สามารถตอบได้ครับ"
 
     system_message_chat_conversation = """<|im_start|>system Assistant provides accurate information to potential customers of TMBThanachart (TTB) Bank regarding various bank products. These products include accounts, debit cards (both digital and physical), credit cards, insurance, and more. Customers rely on your responses, and any fabrication of data can harm the bank's reputation. Therefore, it is crucial to answer based only on the facts provided in the sources below.
 
@@ -69,26 +75,30 @@ Question:
 Search query:
 """
 
-    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, chatgpt_model: str, gpt_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    def __init__(self, retrieval: RetrievalService, chatgpt_deployment: str, chatgpt_model: str, gpt_deployment: str, sourcepage_field: str, content_field: str, query_cache: Optional[Cache] = None, max_prompt_tokens: Optional[int] = None, openai_pool: Optional[OpenAIPool] = None):
+        self.retrieval = retrieval
         self.chatgpt_deployment = chatgpt_deployment
         self.chatgpt_model = chatgpt_model
         self.gpt_deployment = gpt_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
-
-    def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
-        history_length = len(history)
-        if history_length > self.MAX_HISTORY:
-            history = history[-self.MAX_HISTORY:]
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        prompt = self.query_prompt_template.format(chat_history=None, question=history[-1]["user"])
-        completion = openai.Completion.create(
+        self.query_cache = query_cache
+        # openai.Completion, or the pool that spreads completions over several deployments
+        self.completions = openai_pool.completions if openai_pool else openai.Completion
+        # Leave room in the model's context window for the longest answer we ask for
+        self.prompt_builder = PromptBuilder(chatgpt_model, max_prompt_tokens or MODEL_CONTEXT_WINDOWS.get(chatgpt_model, 4096) - self.MAX_COMPLETION_TOKENS)
+
+    async def generate_search_query(self, question: str) -> str:
+        # The query prompt doesn't include the chat history, so the generated query only depends on the question text
+        # and can be reused for repeated questions without another round trip to the model
+        cache_key = make_key(self.gpt_deployment, self.query_prompt_template, normalize_text(question))
+        if self.query_cache:
+            q = await self.query_cache.get(cache_key)
+            if q is not None:
+                return q
+
+        prompt = self.query_prompt_template.format(chat_history=None, question=question)
+        completion = await self.completions.acreate(
             engine=self.gpt_deployment, 
             prompt=prompt, 
             temperature=0.0, 
@@ -97,29 +107,37 @@ Search query:
             stop=["\n"])
         q = completion.choices[0].text
 
+        if self.query_cache:
+            await self.query_cache.set(cache_key, q)
+        return q
+
+    async def run_until_final_call(self, history: Sequence[dict[str, str]], overrides: dict[str, Any], should_stream: bool = False) -> tuple[dict[str, Any], Optional[Coroutine]]:
+        """
+        Retrieves the sources and builds the prompt, returns the extra info of the response and the coroutine of the
+        completion, or None when adaptive retrieval found no relevant source and the answer is no_answer.
+        """
+        history_length = len(history)
+        if history_length > self.MAX_HISTORY:
+            history = history[-self.MAX_HISTORY:]
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+
+        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+        with telemetry.span("chat.query_rewrite"):
+            q = await self.generate_search_query(history[-1]["user"])
+
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
+        r = await self.retrieval.search(q, overrides)
         if use_semantic_captions:
             results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
         else:
             results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
-        content = "\n".join(results)
 
         follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
         
         # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
         prompt_override = overrides.get("prompt_template")
-        messages = self.get_messages_from_history(prompt_override=prompt_override, follow_up_questions_prompt=follow_up_questions_prompt,history=history, sources=content)
+        with telemetry.span("chat.prompt"):
+            messages, results, token_usage = self.get_messages_from_history(prompt_override=prompt_override, follow_up_questions_prompt=follow_up_questions_prompt,history=history, sources=results)
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
         # new code: new api called object
@@ -136,31 +154,59 @@ Search query:
         # chat_content = chat_completion.choices[0].message.content
         # return {"data_points": results, "answer": chat_content, "thoughts": f"Searched for:<br>{q}<br><br>Conversations:<br>" + msg_to_display.replace('\n', '<br>')}
     
+        thoughts = f"Searched for:<br>{q}<br><br>Conversations:<br>" + messages.replace('\n', '<br>') if include_thoughts(overrides) else None
+        extra_info = {"data_points": results, "token_usage": token_usage, "thoughts": thoughts}
+        # No source is relevant enough, skip the completion that could only say it doesn't know
+        if not r and self.retrieval.is_adaptive(overrides):
+            return (extra_info, None)
+
         # old implementation
-        chat_completion = openai.Completion.create(
+        chat_coroutine = self.completions.acreate(
             engine=self.chatgpt_deployment,
             prompt=messages,
             temperature=overrides.get("temperature") or 0.7, 
-            max_tokens=1500, 
+            max_tokens=self.MAX_COMPLETION_TOKENS, 
             n=1, 
-            stop=["<|im_end|>", "<|im_start|>"])
-        
-        return {"data_points": results, "answer": chat_completion.choices[0].text, "thoughts": f"Searched for:<br>{q}<br><br>Conversations:<br>" + messages.replace('\n', '<br>')}
-    
-    def get_chat_history_as_text(self, history: Sequence[dict[str, str]], include_last_turn: bool=True, approx_max_tokens: int=0) -> str:
-        history_text = ""
-        for h in reversed(history if include_last_turn else history[:-1]):
-            history_text = """<|im_start|>user""" + "\n" + h["user"] + "\n" + """<|im_end|>""" + "\n" + """<|im_start|>assistant""" + "\n" + (h.get("bot", "") + """<|im_end|>""" if h.get("bot") else "") + "\n" + history_text
-            if len(history_text) > approx_max_tokens*4:
-                break    
-        return history_text
+            stop=["<|im_end|>", "<|im_start|>"],
+            stream=should_stream)
+        return (extra_info, chat_coroutine)
+
+    async def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=False)
+        if chat_coroutine is None:
+            return {**extra_info, "answer": self.no_answer}
+        with telemetry.span("chat.answer"):
+            chat_completion = await chat_coroutine
+        usage = chat_completion.get("usage")
+        if usage:
+            extra_info["token_usage"] = {**extra_info["token_usage"], "completion_tokens": usage["completion_tokens"], "total_tokens": usage["total_tokens"]}
+        return {**extra_info, "answer": chat_completion.choices[0].text}
+
+    async def run_with_streaming(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> AsyncGenerator[dict[str, Any], None]:
+        """
+        Same as run, but yields the search results and thought process as soon as retrieval is done, followed by
+        {"delta": text} events for each piece of the answer as the model generates it.
+        """
+        extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=True)
+        yield {**extra_info, "answer": ""}
+        if chat_coroutine is None:
+            yield {"delta": self.no_answer}
+            return
+        with telemetry.span("chat.answer"):
+            async for chunk in await chat_coroutine:
+                # Azure OpenAI can send chunks without choices (e.g. content filter results), skip those
+                if chunk.choices:
+                    yield {"delta": chunk.choices[0].text}
     
-    def get_messages_from_history(self, prompt_override, follow_up_questions_prompt, history: Sequence[dict[str, str]], sources: str, approx_max_tokens: int = 1000):
+    def get_chat_history_turns(self, history: Sequence[dict[str, str]], include_last_turn: bool=True) -> list[str]:
+        return ["""<|im_start|>user""" + "\n" + h["user"] + "\n" + """<|im_end|>""" + "\n" + """<|im_start|>assistant""" + "\n" + (h.get("bot", "") + """<|im_end|>""" if h.get("bot") else "") + "\n"
+                for h in (history if include_last_turn else history[:-1])]
+
+    def get_messages_from_history(self, prompt_override, follow_up_questions_prompt, history: Sequence[dict[str, str]], sources: Sequence[str]) -> tuple[str, list[str], dict[str, Any]]:
         '''
-        Generate messages needed for chat Completion api
+        Generate the prompt for the Completion api, fitting as much of the chat history and of the sources (in rank
+        order) as the token budget allows. Returns the prompt, the sources included in it and the token usage.
         '''
-        messages = []
-        token_count = 0
         # new code: change in promt template
         # if prompt_override is None:
         #     system_message = self.system_message_chat_conversation.format(injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt)
@@ -170,38 +216,15 @@ Search query:
         #     system_message = prompt_override.format(follow_up_questions_prompt=follow_up_questions_prompt)
         
         # old code with apdatation
-        if prompt_override is None:
-            system_message = self.system_message_chat_conversation.format(injected_prompt="", sources=sources, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
-        elif prompt_override.startswith(">>>"):
-            system_message = self.system_message_chat_conversation.format(injected_prompt=prompt_override[3:] + "\n", sources=sources, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
-        else:
-            system_message = prompt_override.format(sources=sources, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
-
-        # messages.append({"role":self.SYSTEM, "content": system_message})
-        # token_count += self.num_tokens_from_messages(system_message[-1], self.chatgpt_model)
-        
-        # latest conversation
-        # user_content = history[-1]["user"] + " \nSources:" + sources
-        # messages.append({"role": self.USER, "content": user_content})
-        # token_count += token_count + self.num_tokens_from_messages(system_message[-1], self.chatgpt_model)
-
-        '''
-        Enqueue in reverse order
-        if limit exceeds truncate old messages 
-        leaving system message behind
-        Keep track of token count for each conversation
-        If token count exceeds limit, break
-        '''
-        # for h in reversed(history[:-1]):
-        #     if h.get("bot"):
-        #         messages.insert(1, {"role": self.ASSISTANT, "content" : h.get("bot")})
-        #         token_count += self.num_tokens_from_messages(messages[1], self.chatgpt_model)
-        #     messages.insert(1, {"role": self.USER, "content" : h.get("user")})
-        #     token_count += self.num_tokens_from_messages(messages[1], self.chatgpt_model)
-        #     if token_count > approx_max_tokens*4:
-        #         break
-        # return messages
-        return system_message
+        def render(sources_text: str, chat_history: str) -> str:
+            if prompt_override is None:
+                return self.system_message_chat_conversation.format(injected_prompt="", sources=sources_text, chat_history=chat_history, follow_up_questions_prompt=follow_up_questions_prompt)
+            elif prompt_override.startswith(">>>"):
+                return self.system_message_chat_conversation.format(injected_prompt=prompt_override[3:] + "\n", sources=sources_text, chat_history=chat_history, follow_up_questions_prompt=follow_up_questions_prompt)
+            else:
+                return prompt_override.format(sources=sources_text, chat_history=chat_history, follow_up_questions_prompt=follow_up_questions_prompt)
+
+        return self.prompt_builder.build(render, sources, self.get_chat_history_turns(history))
     
     def num_tokens_from_messages(self, message: dict[str,str], model: str) -> int:
         """
@@ -217,15 +240,9 @@ Search query:
             num_tokens_from_messages(message, model)
             output: 11
         """
-        encoding = tiktoken.encoding_for_model(self.get_oai_chatmodel_tiktok(model))
+        encoding = get_encoding(model)
         num_tokens = 0
         num_tokens += 2  # For "role" and "content" keys
         for key, value in message.items():
             num_tokens += len(encoding.encode(value))
         return num_tokens
-
-    def get_oai_chatmodel_tiktok(self, aoaimodel: str):
-        if aoaimodel == "" or aoaimodel is None:
-            raise Exception("Expected AOAI chatGPT model name")
-        
-        return "gpt-3.5-turbo" if aoaimodel == "gpt-35-turbo" else aoaimodel
\ No newline at end of file
@@ -1,99 +1,189 @@
+import asyncio
 import openai
 import re
-from approaches.approach import Approach
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
+from approaches.approach import Approach, CurrentRequestCallbackHandler, RequestContext, current_request
+from langchain.chains import LLMChain
 from langchain.llms.openai import AzureOpenAI
-from langchain.prompts import PromptTemplate, BasePromptTemplate
-from langchain.callbacks.manager import CallbackManager
+from langchain.prompts import PromptTemplate
 from langchain.agents import Tool, AgentExecutor
+from langchain.agents.agent import AgentOutputParser
 from langchain.agents.react.base import ReActDocstoreAgent
-from langchainadapters import HtmlCallbackHandler
+from langchain.schema import AgentAction, AgentFinish, OutputParserException
+from cache import Cache, InMemoryCache, make_key
+from openaipool import OpenAIPool
+from retrieval import RetrievalService
 from text import nonewlines
-from typing import Any, List, Optional
+from typing import Any, Awaitable, Callable, List, Optional, Union
 
 class ReadDecomposeAsk(Approach):
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    """
+    Answers with a ReAct agent that searches and looks up facts until it can answer. With the parallel_actions
+    override, the agent can emit several independent actions in one step and they run concurrently, and the semantic
+    answers of the entities in each Search query are looked up in the background in case the agent asks for them next.
+    """
+
+    # Actions run at the same time in one step, any further ones the model emits are ignored
+    MAX_PARALLEL_ACTIONS = 4
+
+    def __init__(self, retrieval: RetrievalService, openai_deployment: str, sourcepage_field: str, content_field: str, parallel_actions: bool = False, agent_cache: Optional[Cache] = None, openai_pool: Optional[OpenAIPool] = None):
+        self.retrieval = retrieval
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.parallel_actions = parallel_actions
+        # Agent executors compiled for each combination of prompt overrides, temperature, deployment and mode
+        self.agent_cache = agent_cache or InMemoryCache("agents", max_entries=64, ttl_seconds=float("inf"))
+        self.openai_pool = openai_pool
 
-    def search(self, q: str, overrides: dict[str, Any]) -> str:
+    async def search_results(self, q: str, overrides: dict[str, Any]) -> list[str]:
         use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
+
+        r = await self.retrieval.search(q, overrides)
         if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) for doc in r]
+            return [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) for doc in r]
         else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) for doc in r]
-        return "\n".join(self.results)
-
-    def lookup(self, q: str) -> Optional[str]:
-        r = self.search_client.search(q,
-                                      top = 1,
-                                      include_total_count=True,
-                                      query_type=QueryType.SEMANTIC, 
-                                      query_language="en-us", 
-                                      query_speller="lexicon", 
-                                      semantic_configuration_name="default",
-                                      query_answer="extractive|count-1",
-                                      query_caption="extractive|highlight-false")
-        
-        answers = r.get_answers()
-        if answers and len(answers) > 0:
-            return answers[0].text
-        if r.get_count() > 0:
-            return "\n".join(d['content'] for d in r)
+            return [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) for doc in r]
+
+    async def search(self, q: str, context: "ReadDecomposeAskContext") -> str:
+        results = await self.search_results(q, context.overrides)
+        if context.parallel:
+            # The searches of a step run concurrently, so keep the results of all of them
+            context.data_points.extend(r for r in results if r not in context.data_points)
+        else:
+            context.data_points = results
+        return "\n".join(results)
+
+    async def lookup(self, q: str) -> Optional[str]:
+        answers, docs = await self.retrieval.semantic_answers(q)
+        if len(answers) > 0:
+            return answers[0]
+        if len(docs) > 0:
+            return "\n".join(d['content'] for d in docs)
         return None
 
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
+    async def search_tool(self, query: str) -> str:
+        context = current_request.get()
+        if context.parallel and context.overrides.get("prefetch_lookups") is not False:
+            for entity in query_entities(query):
+                context.start_lookup(entity, self.lookup)
+        return await self.search(query, context)
 
-        # Use to capture thought process during iterations
-        cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
+    async def lookup_tool(self, term: str) -> Optional[str]:
+        context = current_request.get()
+        if context.parallel:
+            return await context.start_lookup(term, self.lookup)
+        return await self.lookup(term)
 
+    def create_agent(self, overrides: dict[str, Any], parallel: bool) -> AgentExecutor:
         llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
+        if self.openai_pool:
+            # The pool retries on its own, across deployments
+            llm.client = self.openai_pool.completions
+            llm.max_retries = 1
         tools = [
-            Tool(name="Search", func=lambda q: self.search(q, overrides), description="useful for when you need to ask with search", callbacks=cb_manager),
-            Tool(name="Lookup", func=self.lookup, description="useful for when you need to ask with lookup", callbacks=cb_manager)
+            Tool(name="Search", func=lambda _: "Not implemented", coroutine=self.search_tool, description="useful for when you need to ask with search", callbacks=[CurrentRequestCallbackHandler()]),
+            Tool(name="Lookup", func=lambda _: "Not implemented", coroutine=self.lookup_tool, description="useful for when you need to ask with lookup", callbacks=[CurrentRequestCallbackHandler()])
         ]
 
-        # Like results above, not great to keep this as a global, will interfere with interleaving
-        global prompt
+        # The prompt is built here rather than returned by the agent's create_prompt, which can't see the overrides
         prompt_prefix = overrides.get("prompt_template")
-        prompt = PromptTemplate.from_examples(
-            EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
+        if parallel:
+            prompt = PromptTemplate.from_examples(
+                PARALLEL_EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PARALLEL_PREFIX if prompt_prefix else PARALLEL_PREFIX)
+            agent = ParallelReAct(llm_chain=LLMChain(llm=llm, prompt=prompt), allowed_tools=[t.name for t in tools], output_parser=ParallelReActOutputParser(max_actions=self.MAX_PARALLEL_ACTIONS))
+        else:
+            prompt = PromptTemplate.from_examples(
+                EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
+            agent = ReActDocstoreAgent(llm_chain=LLMChain(llm=llm, prompt=prompt), allowed_tools=[t.name for t in tools])
+        return AgentExecutor.from_agent_and_tools(agent, tools, verbose=True)
+
+    async def get_agent(self, overrides: dict[str, Any], parallel: bool) -> AgentExecutor:
+        key = make_key("rda", self.openai_deployment, overrides.get("temperature") or 0.3, overrides.get("prompt_template"), parallel)
+        chain = await self.agent_cache.get(key)
+        if chain is None:
+            chain = self.create_agent(overrides, parallel)
+            await self.agent_cache.set(key, chain)
+        return chain
+
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        parallel_actions = overrides.get("parallel_actions")
+        context = ReadDecomposeAskContext(overrides, parallel_actions if parallel_actions is not None else self.parallel_actions)
+        chain = await self.get_agent(overrides, context.parallel)
 
-        agent = ReAct.from_llm_and_tools(llm, tools)
-        chain = AgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
-        result = chain.run(q)
+        token = current_request.set(context)
+        try:
+            # The agent is shared, only the callbacks that capture the thought process are bound to this request
+            result = await chain.arun(q, callbacks=context.callbacks)
+        finally:
+            current_request.reset(token)
+            await context.cancel_lookups()
 
         # Replace substrings of the form <file.ext> with [file.ext] so that the frontend can render them as links, match them with a regex to avoid 
         # generalizing too much and disrupt HTML snippets if present
         result = re.sub(r"<([a-zA-Z0-9_ \-\.]+)>", r"[\1]", result)
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
-    
-class ReAct(ReActDocstoreAgent):
-    @classmethod
-    def create_prompt(cls, tools: List[Tool]) -> BasePromptTemplate:
-        return prompt
+        return {"data_points": context.data_points, "answer": result, "thoughts": context.thoughts()}
+
+class ReadDecomposeAskContext(RequestContext):
+    """Request state of ReadDecomposeAsk, with the lookups started for the request in parallel mode."""
+
+    def __init__(self, overrides: dict[str, Any], parallel: bool):
+        super().__init__(overrides)
+        self.parallel = parallel
+        self.lookups: dict[str, asyncio.Task] = {}
+
+    def start_lookup(self, term: str, lookup: Callable[[str], Awaitable[Optional[str]]]) -> asyncio.Task:
+        key = " ".join(term.casefold().split())
+        if key not in self.lookups:
+            self.lookups[key] = asyncio.create_task(lookup(term))
+        return self.lookups[key]
+
+    async def cancel_lookups(self):
+        # Speculative lookups the agent never asked for are not needed anymore
+        for task in self.lookups.values():
+            task.cancel()
+        await asyncio.gather(*self.lookups.values(), return_exceptions=True)
+
+def query_entities(query: str) -> list[str]:
+    """
+    The entities a Search query is about, whose semantic answers are worth prefetching: the query itself and, for
+    queries naming several things, each of them.
+    """
+    parts = [p.strip() for p in re.split(r",|\band\b|\bor\b|และ|หรือ", query) if p.strip()]
+    return [query.strip()] + (parts if len(parts) > 1 else [])
+
+class ParallelReActOutputParser(AgentOutputParser):
+    """Parses a step with one or more "Action: Tool[input]" lines into the actions to run concurrently."""
+    max_actions: int = 4
+
+    def parse(self, text: str) -> Union[List[AgentAction], AgentFinish]:
+        actions = []
+        for line in text.strip().split("\n"):
+            match = re.match(r"^Action: (\w+)\[(.*)\]\s*$", line.strip())
+            if match is None:
+                continue
+            if match.group(1) == "Finish":
+                return AgentFinish({"output": match.group(2)}, text)
+            # The first action of the step carries the step's text, so the scratchpad can tell where steps start
+            actions.append(AgentAction(match.group(1), match.group(2), "" if actions else text))
+        if not actions:
+            raise OutputParserException(f"Could not parse LLM Output: {text}")
+        return actions[:self.max_actions]
+
+    @property
+    def _type(self) -> str:
+        return "parallel-react"
+
+class ParallelReAct(ReActDocstoreAgent):
+    """ReAct agent whose steps can have several actions, whose observations follow the step in the same order."""
+
+    def _construct_scratchpad(self, intermediate_steps: List[tuple[AgentAction, str]]) -> str:
+        thoughts = ""
+        for i, (action, observation) in enumerate(intermediate_steps):
+            thoughts += f"{action.log}\n{self.observation_prefix}{observation}"
+            if i + 1 == len(intermediate_steps) or intermediate_steps[i + 1][0].log:
+                thoughts += f"\n{self.llm_prefix}"
+        return thoughts
     
 # Modified version of langchain's ReAct prompt that includes instructions and examples for how to cite information sources
 EXAMPLES = [
@@ -202,9 +292,52 @@ Thought: Leonid Levin is a mathematician and computer scientist. So Pavel Urysoh
 and Leonid Levin have the same type of work.
 Action: Finish[yes <info4444.pdf><datapoints_aaa.txt>]""",
 ]
+# The examples that compare several things search for them in a single step
+PARALLEL_EXAMPLES = EXAMPLES[:3] + [
+    """Question: What profession does Nicholas Ray and Elia Kazan have in common?
+Thought: I need to search Nicholas Ray and Elia Kazan, find their professions, then
+find the profession they have in common. The two searches don't depend on each other.
+Action: Search[Nicholas Ray]
+Action: Search[Elia Kazan]
+Observation: <files-987.png> Nicholas Ray (born Raymond Nicholas Kienzle Jr., August 7, 1911 - June 16,
+1979) was an American film director, screenwriter, and actor best known for
+the 1955 film Rebel Without a Cause.
+Observation: <files-654.txt> Elia Kazan was an American film and theatre director, producer, screenwriter
+and actor.
+Thought: Professions of Nicholas Ray are director, screenwriter, and actor. Professions
+of Elia Kazan are director, producer, screenwriter, and actor. So profession Nicholas
+Ray and Elia Kazan have in common is director, screenwriter, and actor.
+Action: Finish[director, screenwriter, actor <files-987.png><files-654.txt>]""",
+    """Question: Which magazine was started first Arthur's Magazine or First for Women?
+Thought: I need to search Arthur's Magazine and First for Women, and find which was
+started first. The two searches don't depend on each other.
+Action: Search[Arthur's Magazine]
+Action: Search[First for Women]
+Observation: <magazines-1850.pdf> Arthur's Magazine (1844-1846) was an American literary periodical published
+in Philadelphia in the 19th century.
+Observation: <magazines-1900.pdf> First for Women is a woman's magazine published by Bauer Media Group in the
+USA.[1] The magazine was started in 1989.
+Thought: Arthur's Magazine was started in 1844 and First for Women in 1989. 1844 (Arthur's
+Magazine) < 1989 (First for Women), so Arthur's Magazine was started first.
+Action: Finish[Arthur's Magazine <magazines-1850.pdf><magazines-1900.pdf>]""",
+    """Question: Were Pavel Urysohn and Leonid Levin known for the same type of work?
+Thought: I need to search Pavel Urysohn and Leonid Levin, find their types of work,
+then find if they are the same. The two searches don't depend on each other.
+Action: Search[Pavel Urysohn]
+Action: Search[Leonid Levin]
+Observation: <info4444.pdf> Pavel Samuilovich Urysohn (February 3, 1898 - August 17, 1924) was a Soviet
+mathematician who is best known for his contributions in dimension theory.
+Observation: <datapoints_aaa.txt> Leonid Anatolievich Levin is a Soviet-American mathematician and computer
+scientist.
+Thought: Pavel Urysohn is a mathematician, and Leonid Levin is a mathematician and computer
+scientist. So Pavel Urysohn and Leonid Levin have the same type of work.
+Action: Finish[yes <info4444.pdf><datapoints_aaa.txt>]""",
+]
 SUFFIX = """\nQuestion: {input}
 {agent_scratchpad}"""
 PREFIX = "Answer questions as shown in the following examples, by splitting the question into individual search or lookup actions to find facts until you can answer the question. " \
 "Observations are prefixed by their source name in angled brackets, source names MUST be included with the actions in the answers." \
 "All questions must be answered from the results from search or look up actions, only facts resulting from those can be used in an answer. "
 "Answer questions as truthfully as possible, and ONLY answer the questions using the information from observations, do not speculate or your own knowledge."
+PARALLEL_PREFIX = PREFIX + " When several facts can be found independently of each other, emit one Action line for each of them in the same step, " \
+"they are run at the same time and their observations are returned in the same order as the actions."
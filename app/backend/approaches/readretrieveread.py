@@ -1,15 +1,15 @@
 import openai
-from approaches.approach import Approach
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
+from approaches.approach import Approach, CurrentRequestCallbackHandler, RequestContext, current_request
 from langchain.llms.openai import AzureOpenAI
-from langchain.callbacks.manager import CallbackManager, Callbacks
+from langchain.callbacks.manager import Callbacks
 from langchain.chains import LLMChain
 from langchain.agents import Tool, ZeroShotAgent, AgentExecutor
-from langchainadapters import HtmlCallbackHandler
+from cache import Cache, InMemoryCache, make_key
+from openaipool import OpenAIPool
 from text import nonewlines
 from lookuptool import CsvLookupTool
-from typing import Any
+from retrieval import RetrievalService
+from typing import Any, Optional
 
 class ReadRetrieveReadApproach(Approach):
     """
@@ -44,49 +44,33 @@ Thought: {agent_scratchpad}"""
 
     CognitiveSearchToolDescription = "useful for searching the Microsoft employee benefits information such as healthcare plans, retirement plans, etc."
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    def __init__(self, retrieval: RetrievalService, openai_deployment: str, sourcepage_field: str, content_field: str, agent_cache: Optional[Cache] = None, openai_pool: Optional[OpenAIPool] = None):
+        self.retrieval = retrieval
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        # Agent executors compiled for each combination of prompt overrides, temperature and deployment
+        self.agent_cache = agent_cache or InMemoryCache("agents", max_entries=64, ttl_seconds=float("inf"))
+        self.openai_pool = openai_pool
 
-    def retrieve(self, q: str, overrides: dict[str, Any]) -> Any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter, 
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
+    async def retrieve(self, q: str, context: RequestContext) -> Any:
+        use_semantic_captions = True if context.overrides.get("semantic_captions") else False
+
+        r = await self.retrieval.search(q, context.overrides)
         if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            context.data_points = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
         else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) for doc in r]
-        content = "\n".join(self.results)
+            context.data_points = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) for doc in r]
+        content = "\n".join(context.data_points)
         return content
         
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
-
-        # Use to capture thought process during iterations
-        cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
-        
+    def create_agent(self, overrides: dict[str, Any]) -> AgentExecutor:
         acs_tool = Tool(name="CognitiveSearch", 
-                        func=lambda q: self.retrieve(q, overrides), 
+                        func=lambda _: "Not implemented",
+                        coroutine=lambda q: self.retrieve(q, current_request.get()), 
                         description=self.CognitiveSearchToolDescription,
-                        callbacks=cb_manager)
-        employee_tool = EmployeeInfoTool("Employee1", callbacks=cb_manager)
+                        callbacks=[CurrentRequestCallbackHandler()])
+        employee_tool = EmployeeInfoTool("Employee1", callbacks=[CurrentRequestCallbackHandler()])
         tools = [acs_tool, employee_tool]
 
         prompt = ZeroShotAgent.create_prompt(
@@ -95,18 +79,39 @@ Thought: {agent_scratchpad}"""
             suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
             input_variables = ["input", "agent_scratchpad"])
         llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
+        if self.openai_pool:
+            # The pool retries on its own, across deployments
+            llm.client = self.openai_pool.completions
+            llm.max_retries = 1
         chain = LLMChain(llm = llm, prompt = prompt)
-        agent_exec = AgentExecutor.from_agent_and_tools(
+        return AgentExecutor.from_agent_and_tools(
             agent = ZeroShotAgent(llm_chain = chain, tools = tools),
             tools = tools, 
-            verbose = True, 
-            callback_manager = cb_manager)
-        result = agent_exec.run(q)
+            verbose = True)
+
+    async def get_agent(self, overrides: dict[str, Any]) -> AgentExecutor:
+        key = make_key("rrr", self.openai_deployment, overrides.get("temperature") or 0.3, overrides.get("prompt_template_prefix"), overrides.get("prompt_template_suffix"))
+        agent_exec = await self.agent_cache.get(key)
+        if agent_exec is None:
+            agent_exec = self.create_agent(overrides)
+            await self.agent_cache.set(key, agent_exec)
+        return agent_exec
+
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        context = RequestContext(overrides)
+        agent_exec = await self.get_agent(overrides)
+
+        token = current_request.set(context)
+        try:
+            # The agent is shared, only the callbacks that capture the thought process are bound to this request
+            result = await agent_exec.arun(q, callbacks=context.callbacks)
+        finally:
+            current_request.reset(token)
                 
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "").replace("[Employee]", "")
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": context.data_points, "answer": result, "thoughts": context.thoughts()}
 
 class EmployeeInfoTool(CsvLookupTool):
     employee_name: str = ""
@@ -117,8 +122,9 @@ class EmployeeInfoTool(CsvLookupTool):
                          name="Employee", 
                          description="useful for answering questions about the employee, their benefits and other personal information",
                          callbacks=callbacks)
-        self.func = self.employee_info
+        self.func = lambda _: "Not implemented"
+        self.coroutine = self.employee_info
         self.employee_name = employee_name
 
-    def employee_info(self, name: str) -> str:
+    async def employee_info(self, name: str) -> str:
         return self.lookup(name)
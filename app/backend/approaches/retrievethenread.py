@@ -1,9 +1,10 @@
+import asyncio
 import openai
-from approaches.approach import Approach
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
+from approaches.approach import Approach, include_thoughts
+from openaipool import OpenAIPool
+from retrieval import RetrievalService
 from text import nonewlines
-from typing import Any
+from typing import Any, AsyncGenerator, Optional, Sequence
 
 
 class RetrieveThenReadApproach(Approach):
@@ -43,29 +44,25 @@ Sources:
 Answer:
 """
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    def __init__(self, retrieval: RetrievalService, openai_deployment: str, sourcepage_field: str, content_field: str, openai_pool: Optional[OpenAIPool] = None):
+        self.retrieval = retrieval
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        # openai.Completion, or the pool that spreads completions over several deployments
+        self.completions = openai_pool.completions if openai_pool else openai.Completion
 
-    def run(self, q: str, overrides: dict[str, Any]) -> Any:
+    # Maximum number of prompts sent in a single Completion call by run_batch
+    MAX_PROMPTS_PER_CALL = 16
+
+    # Answer when adaptive retrieval finds no relevant source, which the prompt would make the model say anyway
+    no_answer = "I don't know, none of the sources cover this question."
+
+    async def retrieve(self, q: str, overrides: dict[str, Any]) -> tuple[list[str], str]:
+        """Returns the sources found for the question and the prompt built from them."""
         use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
+
+        r = await self.retrieval.search(q, overrides)
         if use_semantic_captions:
             results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
         else:
@@ -73,12 +70,66 @@ Answer:
         content = "\n".join(results)
 
         prompt = (overrides.get("prompt_template") or self.template).format(q=q, retrieved=content)
-        completion = openai.Completion.create(
-            engine=self.openai_deployment, 
-            prompt=prompt, 
-            temperature=overrides.get("temperature") or 0.3, 
-            max_tokens=1024, 
-            n=1, 
-            stop=["\n"])
-
-        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+        return results, prompt
+
+    def completion_args(self, prompt: Any, overrides: dict[str, Any]) -> dict[str, Any]:
+        return {"engine": self.openai_deployment,
+                "prompt": prompt,
+                "temperature": overrides.get("temperature") or 0.3,
+                "max_tokens": 1024,
+                "n": 1,
+                "stop": ["\n"]}
+
+    def result(self, q: str, results: list[str], prompt: str, answer: str, overrides: dict[str, Any]) -> dict[str, Any]:
+        thoughts = f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>') if include_thoughts(overrides) else None
+        return {"data_points": results, "answer": answer, "thoughts": thoughts}
+
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        results, prompt = await self.retrieve(q, overrides)
+        if not results and self.retrieval.is_adaptive(overrides):
+            return self.result(q, results, prompt, self.no_answer, overrides)
+        completion = await self.completions.acreate(**self.completion_args(prompt, overrides))
+        return self.result(q, results, prompt, completion.choices[0].text, overrides)
+
+    async def run_batch(self, questions: Sequence[str], overrides: dict[str, Any], max_concurrency: int = 8) -> AsyncGenerator[dict[str, Any], None]:
+        """
+        Answers the questions in groups of up to MAX_PROMPTS_PER_CALL: the sources of a group are retrieved
+        concurrently, then all of its prompts are sent in one Completion call. Up to max_concurrency groups are in
+        flight at a time, and the results of each group are yielded as soon as its answers arrive.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def answer_group(start: int, group: Sequence[str]) -> list[dict[str, Any]]:
+            async with semaphore:
+                retrieved = await asyncio.gather(*[self.retrieve(q, overrides) for q in group], return_exceptions=True)
+                answers: list[dict[str, Any]] = [{"index": start + i, "question": q} for i, q in enumerate(group)]
+                ready = [i for i, r in enumerate(retrieved) if not isinstance(r, BaseException)]
+                for i, r in enumerate(retrieved):
+                    if isinstance(r, BaseException):
+                        answers[i]["error"] = str(r)
+                # Questions without relevant sources get no_answer rather than a prompt in the completion call
+                unanswerable = [i for i in ready if not retrieved[i][0]]
+                if unanswerable and self.retrieval.is_adaptive(overrides):
+                    for i in unanswerable:
+                        answers[i].update(self.result(group[i], *retrieved[i], self.no_answer, overrides))
+                        ready.remove(i)
+                if ready:
+                    try:
+                        completion = await self.completions.acreate(**self.completion_args([retrieved[i][1] for i in ready], overrides))
+                        # Choices come back in any order, their index is the position of the prompt in the call
+                        for choice in completion.choices:
+                            i = ready[choice.index]
+                            results, prompt = retrieved[i]
+                            answers[i].update(self.result(group[i], results, prompt, choice.text, overrides))
+                        for i in ready:
+                            if "answer" not in answers[i]:
+                                answers[i]["error"] = "No answer was returned for this question"
+                    except Exception as e:
+                        for i in ready:
+                            answers[i]["error"] = str(e)
+                return answers
+
+        groups = [answer_group(start, questions[start:start + self.MAX_PROMPTS_PER_CALL]) for start in range(0, len(questions), self.MAX_PROMPTS_PER_CALL)]
+        for answers in asyncio.as_completed(groups):
+            for answer in await answers:
+                yield answer
@@ -0,0 +1,120 @@
+import hashlib
+import pickle
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+def normalize_text(text: str) -> str:
+    """Normalize user input so that trivially different spellings of the same question share a cache entry."""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+def make_key(*parts: Any) -> str:
+    """Build a fixed-length cache key from any number of parts, safe to use as a Redis key."""
+    return hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+class Cache:
+    """
+    Base class for the caches used by the approaches. Values are looked up with get() and stored with set(), both
+    are coroutines so that shared backends can do network I/O. Subclasses implement _get and _set, the base class
+    keeps the hit and miss counters.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        await self._set(key, value)
+
+    async def _get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def _set(self, key: str, value: Any) -> None:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+class InMemoryCache(Cache):
+    """
+    Per-process LRU cache with a time-to-live. Once max_entries is reached the least recently used entry is evicted,
+    entries older than ttl_seconds are treated as missing.
+    """
+
+    def __init__(self, name: str, max_entries: int = 1000, ttl_seconds: float = 3600):
+        super().__init__(name)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        # Approaches can be served from several threads, so guard the OrderedDict against concurrent mutation
+        self.lock = threading.Lock()
+
+    async def _get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    async def _set(self, key: str, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, Any]:
+        return {**super().stats(), "entries": len(self.entries), "max_entries": self.max_entries}
+
+class RedisCache(Cache):
+    """
+    Cache shared by all processes and instances of the app, backed by Redis (for example Azure Cache for Redis).
+    Entries expire after ttl_seconds, size is bounded by the server's maxmemory setting, so configure the Redis
+    instance with an LRU eviction policy such as allkeys-lru. Requires the optional "redis" package.
+    """
+
+    def __init__(self, name: str, url: str, ttl_seconds: float = 3600):
+        super().__init__(name)
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise Exception("The redis package is required to use a shared cache, install it with 'pip install redis'")
+        self.client = redis.asyncio.Redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+
+    async def _get(self, key: str) -> Optional[Any]:
+        data = await self.client.get(f"{self.name}:{key}")
+        return pickle.loads(data) if data is not None else None
+
+    async def _set(self, key: str, value: Any) -> None:
+        await self.client.set(f"{self.name}:{key}", pickle.dumps(value), ex=max(1, int(self.ttl_seconds)))
+
+    async def close(self):
+        await self.client.close()
+
+def create_cache(name: str, redis_url: Optional[str], max_entries: int, ttl_seconds: float) -> Cache:
+    """Use the shared Redis backend when a URL is configured, otherwise fall back to a per-process LRU cache."""
+    if redis_url:
+        return RedisCache(name, redis_url, ttl_seconds=ttl_seconds)
+    return InMemoryCache(name, max_entries=max_entries, ttl_seconds=ttl_seconds)
@@ -0,0 +1,30 @@
+import asyncio
+import random
+
+class FakeRetrieval:
+    """
+    Stands in for RetrievalService: every search returns one section about the query, after a short random delay so
+    concurrent requests interleave. Searching for "boom" fails.
+    """
+
+    async def search(self, q, overrides):
+        if q == "boom":
+            raise Exception("search failed")
+        await asyncio.sleep(random.random() * 0.01)
+        return [{"sourcepage": f"{q}.pdf", "content": f"about {q}", "@search.captions": []}]
+
+    async def semantic_answers(self, q):
+        return [], []
+
+class CharEncoding:
+    """One token per character, so budgets are easy to reason about without downloading a real tokenizer."""
+
+    def encode(self, text):
+        return [ord(c) for c in text]
+
+    def decode(self, tokens):
+        return "".join(chr(t) for t in tokens)
+
+def section(id, content, sourcefile="ttb.pdf", category=None):
+    """A section like the ones prepdocs.py writes to the local indexes."""
+    return {"id": id, "content": content, "category": category, "sourcepage": f"{sourcefile}#page=1", "sourcefile": sourcefile}
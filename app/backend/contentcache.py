@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+class DiskBlobCache:
+    """
+    Size-bounded LRU cache of blob contents on local disk, used by the /content proxy to serve hot page blobs without
+    downloading them again. Files are named after the blob name and ETag, so a file never changes once written and
+    several worker processes can share the directory. Each process keeps its own LRU index of the directory, entries
+    are evicted once the total size exceeds max_bytes, and blobs larger than max_file_bytes are never cached.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_file_bytes: Optional[int] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes if max_file_bytes is not None else max_bytes // 10
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Pick up the files left by previous runs or other processes, least recently used first
+        existing = [e for e in os.scandir(directory) if e.is_file() and e.name.endswith(".blob")]
+        for entry in sorted(existing, key=lambda e: e.stat().st_atime):
+            self.entries[entry.path] = entry.stat().st_size
+            self.size += entry.stat().st_size
+        self.evict()
+
+    def path(self, name: str, etag: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(f"{name}|{etag}".encode("utf-8")).hexdigest() + ".blob")
+
+    def get(self, name: str, etag: str) -> Optional[str]:
+        """Returns the path of the cached content of this version of the blob, if any."""
+        path = self.path(name, etag)
+        with self.lock:
+            if path in self.entries and os.path.exists(path):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return path
+            self.misses += 1
+            return None
+
+    def temp_path(self, name: str, etag: str) -> str:
+        return f"{self.path(name, etag)}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def add(self, name: str, etag: str, temp_path: str):
+        """Moves a fully written temporary file into the cache."""
+        path = self.path(name, etag)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        with self.lock:
+            if path in self.entries:
+                self.size -= self.entries[path]
+            self.entries[path] = size
+            self.entries.move_to_end(path)
+            self.size += size
+            self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            path, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                # Already removed by another process, or still open for reading on Windows
+                logging.debug("Could not remove cached blob %s", path)
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes}
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def parse_range(header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    """
+    Parses a single byte range Range header into (start, end) inclusive offsets, clamped to the size of the content.
+    Returns None when the whole content should be sent (no header, multiple ranges or an unknown unit), and raises
+    ValueError for ranges that can't be satisfied.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range, the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("range not satisfiable")
+    return start, end
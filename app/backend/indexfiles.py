@@ -0,0 +1,15 @@
+import os
+from typing import Any, BinaryIO, Callable, Sequence
+
+def write_index_files(directory: str, files: Sequence[tuple[str, Callable[[BinaryIO], Any]]]):
+    """
+    Writes the files of a local index, given as (name, write) pairs, each under a temporary name then renamed over the
+    previous one. Indexes list meta.json last, since the readers load it first and it's only replaced once every file
+    it describes is in place.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name, write in files:
+        path = os.path.join(directory, name)
+        with open(path + ".tmp", "wb") as f:
+            write(f)
+        os.replace(path + ".tmp", path)
@@ -2,44 +2,84 @@ from typing import Any, Dict, List, Optional, Union
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish, LLMResult
 
+# Escapes text for the thought process panel in a single pass, line breaks become <br>
+HTML_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", "\r": "", "\n": "<br>"})
+
 def ch(text: Union[str, object]) -> str:
     s = text if isinstance(text, str) else str(text)
-    return s.replace("<", "&lt;").replace(">", "&gt;").replace("\r", "").replace("\n", "<br>")
+    return s.translate(HTML_ESCAPES)
 
 class HtmlCallbackHandler (BaseCallbackHandler):
-    html: str = ""
+    """
+    Records the thought process of one request as a list of (kind, color, texts) events, and renders it as HTML when
+    it's asked for. Agents put their whole scratchpad in every prompt, so the log is capped at max_events events and
+    max_chars characters of text, and whatever comes after that is only counted.
+    """
+
+    def __init__(self, max_events: int = 500, max_chars: int = 100_000):
+        self.max_events = max_events
+        self.max_chars = max_chars
+        self.events: list[tuple[str, Optional[str], tuple[str, ...]]] = []
+        self.chars = 0
+        self.omitted = 0
+
+    def add(self, kind: str, color: Optional[str], *texts: Any):
+        if len(self.events) >= self.max_events or self.chars >= self.max_chars:
+            self.omitted += 1
+            return
+        kept = []
+        for text in texts:
+            text = "" if text is None else text if isinstance(text, str) else str(text)
+            room = self.max_chars - self.chars
+            self.chars += min(len(text), room)
+            kept.append(text if len(text) <= room else text[:room] + " [...]")
+        self.events.append((kind, color, tuple(kept)))
+
+    def render(self) -> str:
+        html = []
+        for kind, color, texts in self.events:
+            if kind == "prompts":
+                html.append("LLM prompts:<br>" + "<br>".join(ch(p) for p in texts) + "<br>")
+            elif kind == "error":
+                html.append(f"<span style='color:red'>{ch(texts[0])} error: {ch(texts[1])}</span><br>")
+            elif kind == "chain_start":
+                html.append(f"Entering chain: {ch(texts[0])}<br>")
+            elif kind == "chain_end":
+                html.append("Finished chain<br>")
+            elif kind == "observation":
+                observation_prefix, output, llm_prefix = texts
+                html.append(f"{ch(observation_prefix)}<br><span style='color:{color}'>{ch(output)}</span><br>{ch(llm_prefix)}<br>")
+            else:
+                html.append(f"<span style='color:{color}'>{ch(texts[0])}</span><br>")
+        if self.omitted:
+            html.append(f"<span style='color:gray'>{self.omitted} more steps omitted</span><br>")
+        return "".join(html)
 
-    def get_and_reset_log(self) -> str:
-        result = self.html
-        self.html = ""
-        return result
-    
     def on_llm_start(
         self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
     ) -> None:
         """Print out the prompts."""
-        self.html += f"LLM prompts:<br>" + "<br>".join(ch(prompts)) + "<br>";
+        self.add("prompts", None, *prompts)
 
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         """Do nothing."""
         pass
 
     def on_llm_error(self, error: Exception, **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>LLM error: {ch(error)}</span><br>"
+        self.add("error", None, "LLM", error)
 
     def on_chain_start(
         self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
     ) -> None:
         """Print out that we are entering a chain."""
-        class_name = serialized["name"]
-        self.html += f"Entering chain: {ch(class_name)}<br>"
+        self.add("chain_start", None, serialized["name"])
 
     def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
         """Print out that we finished a chain."""
-        self.html += f"Finished chain<br>"
+        self.add("chain_end", None)
 
     def on_chain_error(self, error: Exception, **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>Chain error: {ch(error)}</span><br>"
+        self.add("error", None, "Chain", error)
 
     def on_tool_start(
         self,
@@ -60,10 +100,10 @@ class HtmlCallbackHandler (BaseCallbackHandler):
         **kwargs: Any,
     ) -> None:
         """If not the final action, print out observation."""
-        self.html += f"{ch(observation_prefix)}<br><span style='color:{color}'>{ch(output)}</span><br>{ch(llm_prefix)}<br>"
+        self.add("observation", color, observation_prefix, output, llm_prefix)
 
     def on_tool_error(self, error: Exception, **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>Tool error: {ch(error)}</span><br>"
+        self.add("error", None, "Tool", error)
 
     def on_text(
         self,
@@ -72,17 +112,17 @@ class HtmlCallbackHandler (BaseCallbackHandler):
         **kwargs: Optional[str],
     ) -> None:
         """Run when agent ends."""
-        self.html += f"<span style='color:{color}'>{ch(text)}</span><br>"
+        self.add("text", color, text)
 
     def on_agent_action(
-        self, 
-        action: AgentAction, 
+        self,
+        action: AgentAction,
         color: Optional[str] = None,
         **kwargs: Any) -> Any:
-        self.html += f"<span style='color:{color}'>{ch(action.log)}</span><br>"
+        self.add("action", color, action.log)
 
     def on_agent_finish(
         self, finish: AgentFinish, color: Optional[str] = None, **kwargs: Any
     ) -> None:
         """Run on agent end."""
-        self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+        self.add("finish", color, finish.log)
@@ -0,0 +1,262 @@
+import collections
+import json
+import os
+import re
+import threading
+import types
+import unicodedata
+from typing import Any, AsyncIterator, Optional, Sequence
+
+import numpy as np
+from azure.core.exceptions import ResourceNotFoundError
+
+from indexfiles import write_index_files
+
+# Version of the on-disk layout written by LocalSearchIndexWriter
+LOCAL_SEARCH_FORMAT = 1
+
+# Runs of Thai characters (letters, vowel and tone marks), or words in any other script
+TOKEN_PATTERN = re.compile(r"[\u0E00-\u0E7F]+|\w+")
+
+FILTER_CLAUSE_PATTERN = re.compile(r"\s*(\w+)\s+(eq|ne)\s+'((?:[^']|'')*)'\s*")
+SEARCH_IN_PATTERN = re.compile(r"\s*search\.in\(\s*(\w+)\s*,\s*'((?:[^']|'')*)'\s*(?:,\s*'([^']*)'\s*)?\)\s*")
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lowercased words, except for Thai: it's written without spaces between words, so runs of Thai characters are
+    indexed as overlapping character bigrams, which match the words of a question without a Thai word segmenter.
+    """
+    tokens = []
+    for run in TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).casefold()):
+        if "\u0E00" <= run[0] <= "\u0E7F" and len(run) > 1:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+def parse_filter(filter: Optional[str]) -> list[tuple[str, str, Any]]:
+    """
+    Parses the subset of OData filters the approaches use: eq and ne comparisons with strings, and search.in with a
+    list of strings, joined by 'and'.
+    """
+    if not filter:
+        return []
+    clauses: list[tuple[str, str, Any]] = []
+    for clause in re.split(r"\s+and\s+", filter.strip()):
+        match = FILTER_CLAUSE_PATTERN.fullmatch(clause)
+        if match:
+            clauses.append((match.group(1), match.group(2), match.group(3).replace("''", "'")))
+            continue
+        match = SEARCH_IN_PATTERN.fullmatch(clause)
+        if not match:
+            raise ValueError(f"Unsupported filter for the local search index: {filter}")
+        # Like Cognitive Search, the values are separated by spaces and commas unless delimiters are given
+        delimiters = match.group(3) or " ,"
+        values = [v for v in re.split("[" + re.escape(delimiters) + "]", match.group(2).replace("''", "'")) if v]
+        clauses.append((match.group(1), "in", values))
+    return clauses
+
+class LocalSearchIndexWriter:
+    """
+    Builds the local search index in a directory from the sections created by prepdocs.py: the sections in
+    sections.jsonl, and a BM25 inverted index in numpy arrays. terms.json lists the terms in order, and the postings of
+    term i are the rows offsets[i]:offsets[i + 1] of doc_ids.npy (uint32) and tfs.npy (uint16, term frequency).
+    The sections of an index already in the directory are read back, and save() rebuilds the inverted index from all
+    of them, so a prepdocs.py run only has to pass the files it processed. Tokenizing happens in save(), so the lock
+    held by replace_file from the pipeline's index workers is short.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.sections: dict[str, dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        if os.path.exists(os.path.join(directory, "meta.json")):
+            for section in LocalSearchIndex.load(directory).sections:
+                self.sections[section["id"]] = section
+
+    def replace_file(self, sourcefile: str, sections: Sequence[dict[str, Any]]) -> int:
+        """Replaces the sections of a file, returns how many sections it had."""
+        with self.lock:
+            removed = [id for id, s in self.sections.items() if s["sourcefile"] == sourcefile]
+            for id in removed:
+                del self.sections[id]
+            for section in sections:
+                self.sections[section["id"]] = {k: section[k] for k in ("id", "content", "category", "sourcepage", "sourcefile")}
+            return len(removed)
+
+    def remove_file(self, sourcefile: str) -> int:
+        return self.replace_file(sourcefile, [])
+
+    def clear(self) -> int:
+        with self.lock:
+            removed = len(self.sections)
+            self.sections = {}
+            return removed
+
+    def save(self):
+        with self.lock:
+            ids = sorted(self.sections)
+            sections = [self.sections[id] for id in ids]
+
+        postings = collections.defaultdict(list)
+        doc_lengths = np.zeros(len(sections), dtype=np.uint32)
+        for doc, section in enumerate(sections):
+            tokens = tokenize(section["content"])
+            doc_lengths[doc] = len(tokens)
+            for term, tf in collections.Counter(tokens).items():
+                postings[term].append((doc, min(tf, np.iinfo(np.uint16).max)))
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        doc_ids = np.fromiter((doc for term in terms for doc, _ in postings[term]), dtype=np.uint32, count=offsets[-1])
+        tfs = np.fromiter((tf for term in terms for _, tf in postings[term]), dtype=np.uint16, count=offsets[-1])
+
+        meta = {"format": LOCAL_SEARCH_FORMAT, "count": len(sections), "terms": len(terms)}
+        write_index_files(self.directory, [
+            ("sections.jsonl", lambda f: f.writelines((json.dumps(s, ensure_ascii=False) + "\n").encode("utf-8") for s in sections)),
+            ("terms.json", lambda f: f.write(json.dumps(terms, ensure_ascii=False).encode("utf-8"))),
+            *[(name, lambda f, array=array: np.save(f, array))
+              for name, array in (("offsets.npy", offsets), ("doc_ids.npy", doc_ids), ("tfs.npy", tfs), ("doc_lengths.npy", doc_lengths))],
+            ("meta.json", lambda f: f.write(json.dumps(meta).encode("utf-8")))])
+
+class LocalSearchIndex:
+    """Read side of the local search index, scores documents with BM25 using the defaults of Cognitive Search."""
+
+    def __init__(self, sections: list[dict[str, Any]], terms: list[str], offsets: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray, doc_lengths: np.ndarray, k1: float = 1.2, b: float = 0.75):
+        self.sections = sections
+        self.terms = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        average_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        # The document length part of the BM25 denominator only depends on the document, so compute it once
+        self.norms = (k1 * (1 - b + b * np.asarray(doc_lengths, dtype=np.float32) / max(average_length, 1e-9))).astype(np.float32)
+        self.fields: dict[str, np.ndarray] = {}
+        self.by_id: Optional[dict[str, dict[str, Any]]] = None
+
+    @classmethod
+    def load(cls, directory: str) -> "LocalSearchIndex":
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["format"] != LOCAL_SEARCH_FORMAT:
+            raise ValueError(f"Unsupported local search index format {meta['format']}, rebuild the index with prepdocs.py")
+        with open(os.path.join(directory, "sections.jsonl"), encoding="utf-8") as f:
+            sections = [json.loads(line) for line in f]
+        with open(os.path.join(directory, "terms.json"), encoding="utf-8") as f:
+            terms = json.load(f)
+        arrays = [np.load(os.path.join(directory, name), mmap_mode="r") for name in ("offsets.npy", "doc_ids.npy", "tfs.npy", "doc_lengths.npy")]
+        return cls(sections, terms, *arrays)
+
+    def __len__(self) -> int:
+        return len(self.sections)
+
+    def field(self, name: str) -> np.ndarray:
+        if name not in self.fields:
+            self.fields[name] = np.array([s.get(name) or "" for s in self.sections], dtype=object)
+        return self.fields[name]
+
+    def document(self, id: str) -> Optional[dict[str, Any]]:
+        if self.by_id is None:
+            self.by_id = {s["id"]: s for s in self.sections}
+        return self.by_id.get(id)
+
+    def matches(self, filter: Optional[str]) -> Optional[np.ndarray]:
+        """Returns the mask of the documents that pass the filter, or None if there is no filter."""
+        mask = None
+        for name, op, value in parse_filter(filter):
+            # A missing value is "", which is never equal to a filter value, like null in Cognitive Search
+            if op == "in":
+                clause = np.isin(self.field(name), value)
+            else:
+                clause = (self.field(name) == value) if op == "eq" else (self.field(name) != value)
+            mask = clause if mask is None else mask & clause
+        return mask
+
+    def search(self, q: str, top: int, filter: Optional[str] = None) -> tuple[list[tuple[float, dict[str, Any]]], int]:
+        """Returns the top (score, section) pairs and the total number of matching documents."""
+        n = len(self.sections)
+        if q.strip() in ("", "*"):
+            # Like Cognitive Search, an empty query matches every document with the same score
+            scores = np.ones(n, dtype=np.float32)
+        else:
+            scores = np.zeros(n, dtype=np.float32)
+            for term, count in collections.Counter(tokenize(q)).items():
+                i = self.terms.get(term)
+                if i is None:
+                    continue
+                start, end = self.offsets[i], self.offsets[i + 1]
+                docs = self.doc_ids[start:end]
+                tf = self.tfs[start:end].astype(np.float32)
+                idf = np.log(1 + (n - (end - start) + 0.5) / ((end - start) + 0.5))
+                scores[docs] += count * idf * tf * (self.k1 + 1) / (tf + self.norms[docs])
+        mask = scores > 0
+        filter_mask = self.matches(filter)
+        if filter_mask is not None:
+            mask &= filter_mask
+        rows = np.flatnonzero(mask)
+        if len(rows) == 0 or top <= 0:
+            return [], len(rows)
+        k = min(top, len(rows))
+        best = rows[np.argpartition(-scores[rows], k - 1)[:k]]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(float(scores[i]), self.sections[i]) for i in best], len(rows)
+
+class LocalSearchResults:
+    """Async iterable of the results, with the get_count() and get_answers() of the Cognitive Search results."""
+
+    def __init__(self, docs: list[dict[str, Any]], count: int):
+        self.docs = docs
+        self.count = count
+
+    def __aiter__(self) -> AsyncIterator[dict[str, Any]]:
+        async def iterate():
+            for doc in self.docs:
+                yield doc
+        return iterate()
+
+    async def get_count(self) -> int:
+        return self.count
+
+    async def get_answers(self) -> Optional[list]:
+        return None
+
+class LocalSearchClient:
+    """
+    Stand-in for the async Cognitive Search SearchClient that searches a local index, for development, load testing
+    and small deployments. Semantic ranking isn't available: semantic queries are ranked with BM25, captions are the
+    start of the content and there are no semantic answers.
+    """
+
+    def __init__(self, index: LocalSearchIndex, caption_length: int = 200):
+        self.index = index
+        self.caption_length = caption_length
+
+    async def search(self, search_text: str, filter: Optional[str] = None, top: Optional[int] = None, skip: int = 0, query_caption: Optional[str] = None,
+                     select: Optional[Sequence[str]] = None, **kwargs) -> LocalSearchResults:
+        results, count = self.index.search(search_text or "", (top or 50) + skip, filter)
+        docs = []
+        for score, section in results[skip:]:
+            fields = {name: section.get(name) for name in select} if select else section
+            doc = {**fields, "@search.score": score, "@search.reranker_score": None, "@search.highlights": None, "@search.captions": None}
+            if query_caption:
+                doc["@search.captions"] = [types.SimpleNamespace(text=section["content"][:self.caption_length], highlights=None)]
+            docs.append(doc)
+        return LocalSearchResults(docs, count)
+
+    async def get_document(self, key: str, selected_fields: Optional[Sequence[str]] = None, **kwargs) -> dict[str, Any]:
+        section = self.index.document(key)
+        if section is None:
+            raise ResourceNotFoundError(f"Document {key} not found")
+        return {name: section.get(name) for name in selected_fields} if selected_fields else dict(section)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self) -> "LocalSearchClient":
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
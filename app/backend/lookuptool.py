@@ -1,20 +1,96 @@
+import bisect
 import csv
+import os
+import threading
+import time
 from pathlib import Path
 from langchain.agents import Tool
 from langchain.callbacks.manager import Callbacks
-from typing import Optional, Union
+from typing import Any, Optional, Union
+
+from cache import normalize_text
+
+class CsvTable:
+    """
+    The rows of a CSV file stored by column, with the normalized values of the key column sorted for exact and prefix
+    lookups. A table is never modified once built, reloading the file builds a new one.
+    """
+
+    def __init__(self, filename: Union[str, Path], key_field: str):
+        with open(filename, newline='', encoding="utf-8-sig") as csvfile:
+            reader = csv.reader(csvfile)
+            self.fields = next(reader, [])
+            rows = [row + [""] * (len(self.fields) - len(row)) for row in reader]
+        # One list per column, the rows don't each keep a dict of their field names
+        self.columns = [[row[i] for row in rows] for i in range(len(self.fields))]
+        key_column = self.columns[self.fields.index(key_field)] if rows else []
+        index = sorted((normalize_text(key), i) for i, key in enumerate(key_column))
+        self.keys = [key for key, _ in index]
+        self.row_ids = [i for _, i in index]
+
+    def row(self, i: int) -> str:
+        return "\n".join(f"{field}:{column[i]}" for field, column in zip(self.fields, self.columns))
+
+    def find(self, key: str, max_matches: int) -> list[int]:
+        """Rows whose key is the given key, ignoring case, or else the first max_matches rows whose key starts with it."""
+        key = normalize_text(key)
+        if not key:
+            return []
+        start = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_right(self.keys, key)
+        if end == start:
+            end = bisect.bisect_left(self.keys, key + "\U0010ffff", start)
+        return self.row_ids[start:min(end, start + max_matches)]
+
+class CsvStore:
+    """Loads a CSV file into a CsvTable, and loads it again when the file is modified."""
+
+    def __init__(self, filename: Union[str, Path], key_field: str, check_interval_seconds: float = 1.0):
+        self.filename = filename
+        self.key_field = key_field
+        self.check_interval_seconds = check_interval_seconds
+        self.lock = threading.Lock()
+        self.mtime = os.stat(filename).st_mtime_ns
+        self.table = CsvTable(filename, key_field)
+        self.checked_at = time.monotonic()
+
+    def get(self) -> CsvTable:
+        if time.monotonic() - self.checked_at >= self.check_interval_seconds:
+            with self.lock:
+                if time.monotonic() - self.checked_at >= self.check_interval_seconds:
+                    mtime = os.stat(self.filename).st_mtime_ns
+                    if mtime != self.mtime:
+                        # Readers keep using the previous table until the new one is complete
+                        self.table = CsvTable(self.filename, self.key_field)
+                        self.mtime = mtime
+                    self.checked_at = time.monotonic()
+        return self.table
+
+# One store per file and key column, shared by every tool and request of the process
+stores: dict[tuple[str, str], CsvStore] = {}
+stores_lock = threading.Lock()
+
+def get_store(filename: Union[str, Path], key_field: str) -> CsvStore:
+    key = (os.path.abspath(filename), key_field)
+    with stores_lock:
+        if key not in stores:
+            stores[key] = CsvStore(filename, key_field)
+        return stores[key]
 
 class CsvLookupTool(Tool):
-    data: dict[str, str] = {}
+    """
+    Looks up the rows of a CSV file by their key, ignoring case, falling back to the keys that start with the input.
+    Tools for the same file share one store, which is loaded once and reloaded when the file changes.
+    """
+    store: Any = None
+    max_matches: int = 5
 
-    def __init__(self, filename: Union[str, Path], key_field: str, name: str = "lookup", 
+    def __init__(self, filename: Union[str, Path], key_field: str, name: str = "lookup",
                  description: str = "useful to look up details given an input key as opposite to searching data with an unstructured question",
                  callbacks: Callbacks = None):
         super().__init__(name, self.lookup, description, callbacks=callbacks)
-        with open(filename, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                self.data[row[key_field]] =  "\n".join([f"{i}:{row[i]}" for i in row])
+        self.store = get_store(filename, key_field)
 
     def lookup(self, key: str) -> Optional[str]:
-        return self.data.get(key, "")
+        table = self.store.get()
+        return "\n\n".join(table.row(i) for i in table.find(key, self.max_matches))
@@ -0,0 +1,281 @@
+import asyncio
+import collections
+import logging
+import random
+import time
+from typing import Any, AsyncGenerator, Optional, Sequence
+
+import aiohttp
+import openai
+import tiktoken
+
+import telemetry
+
+# Errors worth sending again, to another deployment if one is available
+RETRIABLE_ERRORS = (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout,
+                    openai.error.TryAgain, openai.error.APIConnectionError)
+
+# Window over which the tokens-per-minute budgets are enforced, like the rate limiter of Azure OpenAI
+TPM_WINDOW_SECONDS = 60.0
+
+def parse_tpm_limits(value: Optional[str]) -> dict[str, int]:
+    """Parses "chat=120000,davinci=60000" into the tokens-per-minute budget of each deployment name."""
+    limits = {}
+    for item in (value or "").split(","):
+        if item.strip():
+            name, _, tpm = item.partition("=")
+            limits[name.strip()] = int(tpm)
+    return limits
+
+def estimate_tokens(kwargs: dict[str, Any]) -> int:
+    """
+    Tokens a request counts against a deployment's budget. Like Azure OpenAI, counts the prompt and the maximum
+    number of tokens of every completion, estimating the prompt from its UTF-8 size since the deployments may
+    serve different models.
+    """
+    prompts = prompt_texts(kwargs)
+    prompt_bytes = sum(len(p.encode("utf-8")) for p in prompts)
+    return prompt_bytes // 3 + (kwargs.get("max_tokens") or 16) * (kwargs.get("n") or 1) * len(prompts)
+
+def prompt_texts(kwargs: dict[str, Any]) -> list[str]:
+    """The prompts of a completion request, or the content of the messages of a chat completion request."""
+    prompt = kwargs.get("prompt") or ""
+    prompts = prompt if isinstance(prompt, list) else [prompt]
+    messages = kwargs.get("messages") or []
+    return [str(p) for p in prompts] + [str(m.get("content", "")) for m in messages]
+
+def chunk_text(chunk: Any) -> str:
+    """Text generated in a chunk of a streamed completion or chat completion."""
+    text = []
+    for choice in chunk.get("choices") or []:
+        text.append(choice.get("text") or (choice.get("delta") or {}).get("content") or "")
+    return "".join(text)
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    headers = getattr(error, "headers", None) or {}
+    for name in ("retry-after-ms", "Retry-After"):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) / (1000 if name == "retry-after-ms" else 1)
+            except ValueError:
+                pass
+    return None
+
+class Backend:
+    """One deployment on one Azure OpenAI service, with its token budget, throttling state and metrics."""
+
+    def __init__(self, service: str, deployment: str, tpm: Optional[int] = None):
+        self.service = service
+        self.deployment = deployment
+        # A service is the name of an Azure OpenAI resource, or the URL of an endpoint such as a gateway in front of it
+        self.api_base = service if service.startswith(("http://", "https://")) else f"https://{service}.openai.azure.com"
+        self.tpm = tpm
+        self.window: collections.deque[tuple[float, int]] = collections.deque()
+        self.window_tokens = 0
+        self.throttled_until = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies: collections.deque[float] = collections.deque(maxlen=1000)
+
+    @property
+    def name(self) -> str:
+        return f"{self.service}/{self.deployment}"
+
+    def used_tokens(self, now: float) -> int:
+        while self.window and self.window[0][0] <= now - TPM_WINDOW_SECONDS:
+            self.window_tokens -= self.window.popleft()[1]
+        return self.window_tokens
+
+    def remaining(self, now: float) -> float:
+        """Fraction of the budget left in the current window, 1.0 for deployments without a budget."""
+        if not self.tpm:
+            return 1.0
+        return max(0.0, 1.0 - self.used_tokens(now) / self.tpm)
+
+    def available_at(self, now: float, tokens: int) -> float:
+        """When the deployment can take a request of this many tokens, now if it can already."""
+        at = max(now, self.throttled_until)
+        if self.tpm and self.used_tokens(now) + tokens > self.tpm and self.window:
+            # Wait for enough of the window to expire, or for all of it if the request is larger than the budget
+            needed = self.window_tokens + tokens - self.tpm
+            for timestamp, used in self.window:
+                needed -= used
+                if needed <= 0:
+                    break
+            at = max(at, timestamp + TPM_WINDOW_SECONDS)
+        return at
+
+    def reserve(self, now: float, tokens: int):
+        self.window.append((now, tokens))
+        self.window_tokens += tokens
+
+    def stats(self) -> dict[str, Any]:
+        latencies = sorted(self.latencies)
+        percentile = lambda p: round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 4) if latencies else None
+        now = time.monotonic()
+        return {"requests": self.requests, "throttled": self.throttled, "errors": self.errors, "in_flight": self.in_flight,
+                "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens,
+                "tpm": self.tpm, "tpm_used": self.used_tokens(now), "throttled_for": round(max(0.0, self.throttled_until - now), 3),
+                "latency_p50": percentile(0.5), "latency_p95": percentile(0.95)}
+
+class PooledResource:
+    """Stands in for openai.Completion or openai.ChatCompletion, sending their requests through the pool."""
+
+    def __init__(self, pool: "OpenAIPool", resource: Any):
+        self.pool = pool
+        self.resource = resource
+
+    async def acreate(self, **kwargs) -> Any:
+        return await self.pool.acreate(self.resource, **kwargs)
+
+    def create(self, **kwargs) -> Any:
+        raise NotImplementedError("The OpenAI pool only supports async requests")
+
+class OpenAIPool:
+    """
+    Spreads the completion requests for a deployment over the same deployment on several Azure OpenAI services (for
+    example in different regions). Each request goes to the deployment with the most of its tokens-per-minute budget
+    left, deployments that return 429 are skipped until their Retry-After has passed, and failed requests are retried
+    with jittered exponential backoff, to another deployment when there is one. The requests of a process share one
+    HTTP connection pool. Every deployment must exist with the same name on each of the services.
+    """
+
+    def __init__(self, services: Sequence[str], tpm_limits: Optional[dict[str, int]] = None, max_retries: int = 5,
+                 backoff_seconds: float = 1.0, max_backoff_seconds: float = 30.0, max_wait_seconds: float = 60.0,
+                 encoding: Optional[Any] = None):
+        self.services = list(services)
+        self.tpm_limits = tpm_limits or {}
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.backends: dict[str, list[Backend]] = {}
+        self.retries = 0
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.session_loop: Optional[asyncio.AbstractEventLoop] = None
+        # Counts the tokens of streamed completions, which come without usage. Loaded when first needed
+        self.encoding = encoding
+        self.completions = PooledResource(self, openai.Completion)
+        self.chat_completions = PooledResource(self, openai.ChatCompletion)
+
+    def backends_for(self, deployment: str) -> list[Backend]:
+        if deployment not in self.backends:
+            self.backends[deployment] = [Backend(service, deployment, self.tpm_limits.get(deployment)) for service in self.services]
+        return self.backends[deployment]
+
+    def choose(self, backends: list[Backend], tokens: int, now: float) -> tuple[Backend, float]:
+        """Picks the backend that can take the request the soonest, then the one with the most budget left."""
+        return min(((b, b.available_at(now, tokens)) for b in backends), key=lambda ba: (ba[1], -ba[0].remaining(now), ba[0].in_flight))
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt))
+
+    async def acreate(self, resource: Any, **kwargs) -> Any:
+        deployment = kwargs.pop("engine", None) or kwargs.pop("deployment_id")
+        with telemetry.span("openai.completion", deployment=deployment) as call_span:
+            return await self.send_with_retries(resource, deployment, kwargs, call_span)
+
+    async def send_with_retries(self, resource: Any, deployment: str, kwargs: dict[str, Any], call_span: Optional[telemetry.Span]) -> Any:
+        backends = self.backends_for(deployment)
+        tokens = estimate_tokens(kwargs)
+        deadline = time.monotonic() + self.max_wait_seconds
+        for attempt in range(self.max_retries + 1):
+            now = time.monotonic()
+            backend, available_at = self.choose(backends, tokens, now)
+            if available_at > now:
+                if available_at > deadline:
+                    raise openai.error.RateLimitError(f"All deployments of {deployment} are over their rate limit", http_status=429,
+                                                      headers={"Retry-After": str(int(available_at - now) + 1)})
+                # Spread the requests waiting for the same deployment, so they don't all get throttled again at once
+                await asyncio.sleep((available_at - now) * random.uniform(1, 2))
+            backend.reserve(time.monotonic(), tokens)
+            backend.requests += 1
+            backend.in_flight += 1
+            start = time.monotonic()
+            try:
+                response = await self.send(resource, backend, kwargs)
+            except RETRIABLE_ERRORS as e:
+                if isinstance(e, openai.error.RateLimitError):
+                    backend.throttled += 1
+                else:
+                    backend.errors += 1
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                delay = retry_after_seconds(e) or self.backoff(attempt)
+                backend.throttled_until = max(backend.throttled_until, time.monotonic() + delay)
+                logging.warning("OpenAI request to %s failed (%s), retrying", backend.name, e)
+                continue
+            except openai.error.APIError as e:
+                backend.errors += 1
+                if attempt == self.max_retries or (e.http_status or 500) < 500:
+                    raise
+                self.retries += 1
+                backend.throttled_until = max(backend.throttled_until, time.monotonic() + self.backoff(attempt))
+                continue
+            finally:
+                backend.in_flight -= 1
+            backend.latencies.append(time.monotonic() - start)
+            if call_span is not None:
+                call_span.set_attribute("openai.service", backend.service)
+                call_span.set_attribute("openai.attempts", attempt + 1)
+            if kwargs.get("stream"):
+                return self.count_streamed_tokens(response, backend, kwargs)
+            self.record_usage(backend, response.get("usage"), call_span)
+            return response
+
+    def record_usage(self, backend: Backend, usage: Optional[dict[str, Any]], call_span: Optional[telemetry.Span] = None):
+        if usage:
+            backend.prompt_tokens += usage.get("prompt_tokens", 0)
+            backend.completion_tokens += usage.get("completion_tokens", 0)
+        telemetry.record_tokens(backend.deployment, usage, call_span)
+
+    async def count_streamed_tokens(self, response: Any, backend: Backend, kwargs: dict[str, Any]) -> AsyncGenerator[Any, None]:
+        """
+        Passes the chunks of a streamed completion through, and records its usage once the stream is done (or closed
+        early), counting the tokens of the prompt and of the generated text since streams don't report their usage.
+        """
+        generated = []
+        try:
+            async for chunk in response:
+                generated.append(chunk_text(chunk))
+                yield chunk
+        finally:
+            prompt_tokens = sum(self.count_tokens(p) for p in prompt_texts(kwargs))
+            self.record_usage(backend, {"prompt_tokens": prompt_tokens, "completion_tokens": self.count_tokens("".join(generated))})
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding is None:
+            try:
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                # tiktoken downloads its encodings, without access to them estimate from the UTF-8 size like the budgets do
+                logging.warning("Could not load the cl100k_base encoding, estimating the tokens of streamed completions")
+                self.encoding = False
+        if self.encoding is False:
+            return len(text.encode("utf-8")) // 3
+        return len(self.encoding.encode(text))
+
+    async def send(self, resource: Any, backend: Backend, kwargs: dict[str, Any]) -> Any:
+        # Reuse the connections to the services rather than opening a new session for each request like the SDK does
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.session_loop is not loop:
+            self.session = aiohttp.ClientSession()
+            self.session_loop = loop
+        token = openai.aiosession.set(self.session)
+        try:
+            return await resource.acreate(engine=backend.deployment, api_base=backend.api_base, **kwargs)
+        finally:
+            openai.aiosession.reset(token)
+
+    def stats(self) -> dict[str, Any]:
+        return {"retries": self.retries, "deployments": {b.name: b.stats() for backends in self.backends.values() for b in backends}}
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
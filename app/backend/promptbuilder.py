@@ -0,0 +1,122 @@
+import functools
+from typing import Any, Callable, Optional, Sequence
+
+import tiktoken
+
+# Context window of the chat models, in tokens. The prompt and the completion must fit in it together
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-35-turbo": 4096,
+    "gpt-35-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+
+# Azure OpenAI model names differ from the OpenAI ones tiktoken knows about
+TIKTOKEN_MODEL_NAMES = {
+    "gpt-35-turbo": "gpt-3.5-turbo",
+    "gpt-35-turbo-16k": "gpt-3.5-turbo-16k",
+}
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Returns the tokenizer of the model. Loading an encoding is slow, so each one is only loaded once per process."""
+    if not model:
+        raise Exception("Expected AOAI chatGPT model name")
+    try:
+        return tiktoken.encoding_for_model(TIKTOKEN_MODEL_NAMES.get(model, model))
+    except KeyError:
+        # Newer models all use the same encoding as gpt-35-turbo and gpt-4
+        return tiktoken.get_encoding("cl100k_base")
+
+class PromptBuilder:
+    """
+    Fits a prompt made of a template, a list of sources and the chat history into a budget of max_prompt_tokens,
+    counting tokens with the model's own tokenizer. The latest turn of the conversation is always kept, older turns
+    are added newest first as long as the history stays within max_history_tokens, and the sources fill the rest of
+    the budget in rank order: the first source that doesn't fit is truncated and the lower-ranked ones are dropped.
+    """
+
+    def __init__(self, model: str, max_prompt_tokens: int, max_history_tokens: int = 1000, min_source_tokens: int = 50, encoding: Optional[Any] = None):
+        self.model = model
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_history_tokens = max_history_tokens
+        self.min_source_tokens = min_source_tokens
+        self._encoding = encoding
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            self._encoding = get_encoding(self.model)
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        tokens = self.encoding.encode(text)
+        return text if len(tokens) <= max_tokens else self.encoding.decode(tokens[:max_tokens])
+
+    def build(self, render: Callable[[str, str], str], sources: Sequence[str], history_turns: Sequence[str]) -> tuple[str, list[str], dict[str, Any]]:
+        """
+        Renders the prompt with render(sources_text, history_text). history_turns are the formatted turns of the
+        conversation, oldest first. Returns the prompt, the sources that made it into the prompt and the token usage.
+        """
+        template_tokens = self.count(render("", ""))
+
+        history = []
+        history_tokens = 0
+        for i, turn in enumerate(reversed(history_turns)):
+            turn_tokens = self.count(turn)
+            if i > 0 and history_tokens + turn_tokens > self.max_history_tokens:
+                break
+            history.insert(0, turn)
+            history_tokens += turn_tokens
+        history_text = "".join(history)
+
+        available = self.max_prompt_tokens - template_tokens - history_tokens
+        used_sources = []
+        sources_tokens = 0
+        for source in sources:
+            # Sources are joined with a newline, which is a token of its own
+            source_tokens = self.count(source) + (1 if used_sources else 0)
+            if sources_tokens + source_tokens <= available:
+                used_sources.append(source)
+                sources_tokens += source_tokens
+                continue
+            remaining = available - sources_tokens - (1 if used_sources else 0)
+            if remaining >= self.min_source_tokens:
+                used_sources.append(self.truncate(source, remaining))
+            break
+
+        prompt = render("\n".join(used_sources), history_text)
+        prompt_tokens = self.count(prompt)
+        # Tokens can merge across the boundaries of the pieces, so make sure the whole prompt is within budget
+        while prompt_tokens > self.max_prompt_tokens and used_sources:
+            last = used_sources.pop()
+            overflow = prompt_tokens - self.max_prompt_tokens
+            last_tokens = self.count(last)
+            truncated = last_tokens - overflow >= self.min_source_tokens
+            if truncated:
+                used_sources.append(self.truncate(last, last_tokens - overflow))
+            previous_tokens = prompt_tokens
+            prompt = render("\n".join(used_sources), history_text)
+            prompt_tokens = self.count(prompt)
+            if truncated and prompt_tokens >= previous_tokens:
+                # Decoding a cut in the middle of a character (e.g. Thai, to U+FFFD) can encode to as many tokens
+                # again, drop the source rather than truncate it forever
+                used_sources.pop()
+                prompt = render("\n".join(used_sources), history_text)
+                prompt_tokens = self.count(prompt)
+
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "template_tokens": template_tokens,
+            "history_tokens": history_tokens,
+            "history_turns": len(history),
+            "sources_tokens": self.count("\n".join(used_sources)),
+            "sources_used": len(used_sources),
+            "sources_truncated": sum(1 for used, source in zip(used_sources, sources) if used != source),
+            "sources_dropped": len(sources) - len(used_sources),
+        }
+        return prompt, used_sources, usage
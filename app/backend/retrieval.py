@@ -0,0 +1,321 @@
+import asyncio
+import logging
+import time
+import types
+from typing import Any, Optional
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import QueryType
+from azure.storage.blob.aio import ContainerClient
+import telemetry
+from cache import Cache, make_key
+from vectorindex import VectorIndex, reciprocal_rank_fusion
+
+# Name of the blob container metadata entry that prepdocs.py bumps after every run that changes the index
+INDEX_GENERATION_METADATA_KEY = "index_generation"
+
+class IndexGeneration:
+    """
+    Tracks the generation of the search index, as recorded by prepdocs.py in the metadata of the content container.
+    Search results cached under an older generation are never returned again. The metadata is re-read at most every
+    refresh_seconds, so a new ingestion run is picked up within that interval.
+    """
+
+    def __init__(self, blob_container: ContainerClient, refresh_seconds: float = 30):
+        self.blob_container = blob_container
+        self.refresh_seconds = refresh_seconds
+        self.generation = ""
+        self.checked_at = float("-inf")
+
+    async def get(self) -> str:
+        if time.monotonic() - self.checked_at >= self.refresh_seconds:
+            self.checked_at = time.monotonic()
+            try:
+                properties = await self.blob_container.get_container_properties()
+                self.generation = (properties.metadata or {}).get(INDEX_GENERATION_METADATA_KEY, "")
+            except Exception:
+                # Keep serving with the last known generation, entries still expire through the cache TTL
+                logging.exception("Could not read the search index generation")
+        return self.generation
+
+# Tokens of section content, estimated from its UTF-8 size like the OpenAI pool does since the sections are mostly Thai
+def estimate_content_tokens(text: str) -> int:
+    return len(text.encode("utf-8")) // 3
+
+# Scores of a result, from the most to the least specific to how it was ranked: the semantic ranker (0 to 4), then BM25
+# for keyword search or cosine similarity for vector search. The reciprocal rank fusion of hybrid search isn't one of
+# them, it's at most 2 / 61 whatever the relevance, so hybrid searches are cut on the scores of the fused rankings
+SCORE_FIELDS = ("@search.reranker_score", "@search.score")
+
+def relevance_score(doc: dict[str, Any]) -> float:
+    for field in SCORE_FIELDS:
+        if doc.get(field) is not None:
+            return doc[field]
+    return 0.0
+
+# Values of the retrieval_mode override: keyword search in Cognitive Search, the local vector index, or both fused
+RETRIEVAL_MODES = ("text", "vectors", "hybrid")
+
+class RetrievalService:
+    """
+    Single entry point for the approaches to query Cognitive Search. Builds the search arguments from the request
+    overrides and, when a cache is provided, reuses the results of identical queries made against the same index
+    generation. With a local vector index, the retrieval_mode override selects keyword search, vector search or a
+    reciprocal rank fusion of both, which finds the relevant sections of Thai documents that share few exact terms
+    with the question.
+
+    Searches only return the fields the approaches use, the content isn't downloaded when semantic captions replace
+    it. In two-phase mode, the ranking is done without any content, which is then fetched in rank order for the
+    sections that fit in content_token_budget tokens.
+
+    In adaptive mode, searches fetch at least adaptive_candidates results and keep the ones scoring at least
+    relative_score_cutoff times the best score, within content_token_budget, rather than a fixed top. No result is
+    kept when the best one scores below the minimum, so the approaches can answer that they don't know without a
+    completion. Keyword rankings (BM25, or 0 to 4 with the semantic ranker) are held to min_score and vector rankings
+    (cosine similarity, at most 1) to min_vector_score. Hybrid searches cut both rankings before fusing what's left.
+    """
+
+    def __init__(self, search_client: SearchClient, cache: Optional[Cache] = None, index_generation: Optional[IndexGeneration] = None,
+                 vector_index: Optional[VectorIndex] = None, embedder: Optional[Any] = None, default_mode: Optional[str] = None, nprobe: Optional[int] = 16,
+                 sourcepage_field: str = "sourcepage", content_field: str = "content", two_phase: bool = False,
+                 content_token_budget: Optional[int] = 2000, expected_section_tokens: int = 650,
+                 adaptive: bool = False, adaptive_candidates: int = 10, relative_score_cutoff: float = 0.5, min_score: float = 0.0,
+                 min_vector_score: float = 0.0):
+        self.search_client = search_client
+        self.cache = cache
+        self.index_generation = index_generation
+        self.vector_index = vector_index
+        self.embedder = embedder
+        self.default_mode = default_mode or ("hybrid" if vector_index is not None else "text")
+        self.nprobe = nprobe
+        self.sourcepage_field = sourcepage_field
+        self.content_field = content_field
+        self.two_phase = two_phase
+        self.content_token_budget = content_token_budget
+        # prepdocs.py splits documents into sections of at most about 650 characters, so about as many tokens of Thai
+        # text. This sizes the first content fetch of a two-phase search
+        self.expected_section_tokens = expected_section_tokens
+        self.adaptive = adaptive
+        self.adaptive_candidates = adaptive_candidates
+        self.relative_score_cutoff = relative_score_cutoff
+        self.min_score = min_score
+        self.min_vector_score = min_vector_score
+
+    @staticmethod
+    def build_filter(overrides: dict[str, Any]) -> Optional[str]:
+        exclude_category = overrides.get("exclude_category") or None
+        return "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+
+    async def cache_key(self, *parts: Any) -> str:
+        generation = await self.index_generation.get() if self.index_generation else ""
+        return make_key(generation, *parts)
+
+    def is_adaptive(self, overrides: dict[str, Any]) -> bool:
+        adaptive = overrides.get("adaptive_retrieval")
+        return self.adaptive if adaptive is None else bool(adaptive)
+
+    def select(self, with_content: bool) -> list[str]:
+        return ["id", self.sourcepage_field] + ([self.content_field] if with_content else [])
+
+    def retrieval_mode(self, overrides: dict[str, Any]) -> str:
+        mode = overrides.get("retrieval_mode") or self.default_mode
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval_mode '{mode}', expected one of {', '.join(RETRIEVAL_MODES)}")
+        if mode != "text" and self.vector_index is None:
+            raise ValueError(f"retrieval_mode '{mode}' needs a local vector index, set VECTOR_INDEX_DIR")
+        return mode
+
+    async def search(self, q: str, overrides: dict[str, Any]) -> list[dict[str, Any]]:
+        """
+        Returns the top documents for the query, honoring the top, exclude_category, semantic_*, retrieval_mode,
+        two_phase_search, adaptive_retrieval, minimum_search_score and minimum_vector_score overrides. With semantic captions, the
+        documents have no content.
+        """
+        use_semantic_ranker = True if overrides.get("semantic_ranker") else False
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        top = overrides.get("top") or 3
+        filter = self.build_filter(overrides)
+        mode = self.retrieval_mode(overrides)
+        two_phase = overrides.get("two_phase_search")
+        two_phase = (self.two_phase if two_phase is None else two_phase) and not use_semantic_captions
+        select = self.select(with_content=not use_semantic_captions and not two_phase)
+        adaptive = self.is_adaptive(overrides)
+        min_score = overrides.get("minimum_search_score")
+        min_score = self.min_score if min_score is None else float(min_score)
+        min_vector_score = overrides.get("minimum_vector_score")
+        min_vector_score = self.min_vector_score if min_vector_score is None else float(min_vector_score)
+        if adaptive:
+            # How many results are kept is decided from their scores, top only sets the minimum number of candidates
+            top = max(top, self.adaptive_candidates)
+
+        with telemetry.span("search", mode=mode, top=top) as search_span:
+            if self.cache:
+                key = await self.cache_key("search", q, filter, top, use_semantic_ranker, use_semantic_captions, mode, two_phase, adaptive,
+                                           (min_score, min_vector_score) if adaptive else None)
+                docs = await self.cache.get(key)
+                if search_span is not None:
+                    search_span.set_attribute("cache_hit", docs is not None)
+                if docs is not None:
+                    return docs
+
+            if mode == "text":
+                docs = await self.text_search(q, filter, top, use_semantic_ranker, use_semantic_captions, select)
+            elif mode == "vectors":
+                docs = await self.vector_search(q, overrides.get("exclude_category") or None, top)
+            else:
+                # Fuse deeper candidate lists than needed, a document ranked low by both can still make the top
+                candidates = max(top * 3, 10)
+                text_docs, vector_docs = await asyncio.gather(
+                    self.text_search(q, filter, candidates, use_semantic_ranker, use_semantic_captions, select),
+                    self.vector_search(q, overrides.get("exclude_category") or None, candidates))
+                if adaptive:
+                    text_docs, vector_docs = self.cut_by_score(text_docs, min_score), self.cut_by_score(vector_docs, min_vector_score)
+                docs = reciprocal_rank_fusion([text_docs, vector_docs], top)
+            if adaptive and mode != "hybrid":
+                docs = self.cut_by_score(docs, min_score if mode == "text" else min_vector_score)
+            if two_phase:
+                docs = await self.fetch_contents(docs)
+            elif adaptive:
+                docs = self.within_budget(docs, use_semantic_captions)
+            if search_span is not None:
+                search_span.set_attribute("results", len(docs))
+
+            if self.cache:
+                await self.cache.set(key, docs)
+            return docs
+
+    async def text_search(self, q: str, filter: Optional[str], top: int, use_semantic_ranker: bool, use_semantic_captions: bool,
+                          select: Optional[list[str]] = None) -> list[dict[str, Any]]:
+        with telemetry.span("search.query", semantic_ranker=use_semantic_ranker):
+            if use_semantic_ranker:
+                r = await self.search_client.search(q,
+                                                    filter=filter,
+                                                    query_type=QueryType.SEMANTIC,
+                                                    query_language="en-us",
+                                                    query_speller="lexicon",
+                                                    semantic_configuration_name="default",
+                                                    top=top,
+                                                    select=select,
+                                                    query_caption="extractive|highlight-false" if use_semantic_captions else None)
+            else:
+                r = await self.search_client.search(q, filter=filter, top=top, select=select)
+        # The results are paged, iterating them can make more round trips to the search service
+        with telemetry.span("search.results"):
+            return [doc async for doc in r]
+
+    def cut_by_score(self, docs: list[dict[str, Any]], min_score: float) -> list[dict[str, Any]]:
+        """Keeps the documents scoring at least relative_score_cutoff times the best one, none if it's below min_score."""
+        if not docs:
+            return docs
+        best = max(relevance_score(doc) for doc in docs)
+        if best < min_score or best <= 0:
+            return []
+        cutoff = max(best * self.relative_score_cutoff, min_score)
+        return [doc for doc in docs if relevance_score(doc) >= cutoff]
+
+    def within_budget(self, docs: list[dict[str, Any]], use_semantic_captions: bool) -> list[dict[str, Any]]:
+        """Keeps the documents in rank order while their captions or content fit in content_token_budget, and at least one."""
+        if not self.content_token_budget:
+            return docs
+        kept: list[dict[str, Any]] = []
+        used = 0
+        for doc in docs:
+            text = " ".join(c.text for c in doc.get("@search.captions") or []) if use_semantic_captions else doc.get(self.content_field) or ""
+            tokens = estimate_content_tokens(text)
+            if kept and used + tokens > self.content_token_budget:
+                break
+            kept.append(doc)
+            used += tokens
+        return kept
+
+    async def fetch_contents(self, docs: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """
+        Second phase of a two-phase search: adds the content to the ranked documents, keeping them in rank order
+        until content_token_budget is used (the first one is always kept). The content is fetched in batches sized
+        by the average section seen so far, usually in one batch of concurrent lookups, so the sections past the
+        budget are mostly never downloaded.
+        """
+        with telemetry.span("search.contents", candidates=len(docs)):
+            budget = self.content_token_budget or None
+            kept: list[dict[str, Any]] = []
+            used = seen_tokens = seen = i = 0
+            while i < len(docs) and (budget is None or used < budget):
+                if budget is None:
+                    batch = docs[i:]
+                else:
+                    section_tokens = seen_tokens // seen if seen else self.expected_section_tokens
+                    count = (budget - used) // max(section_tokens, 1)
+                    if count == 0 and kept:
+                        # What's left of the budget is unlikely to fit another section
+                        break
+                    batch = docs[i:i + max(count, 1)]
+                i += len(batch)
+                # Sections of the local vector index come with their content
+                missing = [doc["id"] for doc in batch if doc.get(self.content_field) is None]
+                contents = await self.get_contents(missing) if missing else {}
+                for doc in batch:
+                    content = doc.get(self.content_field)
+                    content = contents.get(doc["id"]) if content is None else content
+                    if content is None:
+                        # Deleted from the index since it was ranked
+                        continue
+                    tokens = estimate_content_tokens(content)
+                    seen_tokens += tokens
+                    seen += 1
+                    if budget is not None and kept and used + tokens > budget:
+                        return kept
+                    kept.append({**doc, self.content_field: content})
+                    used += tokens
+            return kept
+
+    async def get_contents(self, ids: list[str]) -> dict[str, str]:
+        """
+        Returns the content of the documents with these ids, looked up by key concurrently: the id field of the
+        index created by prepdocs.py isn't filterable, so it can't be matched with search.in.
+        """
+        async def get_content(id: str) -> Optional[str]:
+            try:
+                doc = await self.search_client.get_document(id, selected_fields=["id", self.content_field])
+            except ResourceNotFoundError:
+                return None
+            return doc.get(self.content_field)
+
+        contents = await asyncio.gather(*[get_content(id) for id in ids])
+        return {id: content for id, content in zip(ids, contents) if content is not None}
+
+    async def vector_search(self, q: str, exclude_category: Optional[str], top: int) -> list[dict[str, Any]]:
+        with telemetry.span("search.embed"):
+            query_vector = (await self.embedder.aembed([q]))[0]
+        # The vector index is memory-mapped, scanning it may fault pages in from disk so keep it off the event loop
+        with telemetry.span("search.vectors"):
+            results = await asyncio.to_thread(self.vector_index.search, query_vector, top, exclude_category, self.nprobe)
+        # Local sections have no semantic captions, their content stands in for the caption
+        return [{**section, "@search.score": score, "@search.captions": [types.SimpleNamespace(text=section["content"], highlights=None)]} for score, section in results]
+
+    async def semantic_answers(self, q: str) -> tuple[list[str], list[dict[str, Any]]]:
+        """Returns the extractive semantic answers for the query, and the top document in case there are none."""
+        if self.cache:
+            key = await self.cache_key("answers", q)
+            result = await self.cache.get(key)
+            if result is not None:
+                return result
+
+        with telemetry.span("search.answers"):
+            r = await self.search_client.search(q,
+                                                top=1,
+                                                include_total_count=True,
+                                                query_type=QueryType.SEMANTIC,
+                                                query_language="en-us",
+                                                query_speller="lexicon",
+                                                semantic_configuration_name="default",
+                                                select=self.select(with_content=True),
+                                                query_answer="extractive|count-1",
+                                                query_caption="extractive|highlight-false")
+            answers = [a.text for a in (await r.get_answers() or [])]
+            docs = [doc async for doc in r] if not answers and await r.get_count() > 0 else []
+            result = (answers, docs)
+
+        if self.cache:
+            await self.cache.set(key, result)
+        return result
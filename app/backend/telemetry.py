@@ -0,0 +1,166 @@
+import contextlib
+import contextvars
+import time
+from typing import Any, AsyncGenerator, AsyncIterator, ContextManager, Iterator, Optional
+
+# OpenTelemetry tracer and metrics sink set by configure(), both are None when telemetry is off
+tracer: Any = None
+metrics: Optional["Metrics"] = None
+
+# Returned by span() when telemetry is off, so instrumented code only pays for a function call
+NOOP_SPAN = contextlib.nullcontext()
+
+class TokenUsage:
+    """Tokens used by the OpenAI calls of one request."""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+# Usage of the request being served in the current asyncio task, only set while telemetry is on
+current_usage: contextvars.ContextVar[Optional[TokenUsage]] = contextvars.ContextVar("current_usage", default=None)
+
+class Metrics:
+    """Receives the measurements of the app. This base class drops them, PrometheusMetrics exports them."""
+
+    def observe_stage(self, stage: str, seconds: float):
+        pass
+
+    def add_tokens(self, deployment: str, prompt_tokens: int, completion_tokens: int):
+        pass
+
+    def observe_request(self, route: str, approach: str, seconds: float, usage: TokenUsage):
+        pass
+
+class PrometheusMetrics(Metrics):
+    """Exports the measurements in the Prometheus text format. Requires the optional "prometheus-client" package."""
+
+    def __init__(self, registry: Any = None):
+        try:
+            import prometheus_client
+        except ImportError:
+            raise Exception("The prometheus-client package is required to export metrics, install it with 'pip install prometheus-client'")
+        self.prometheus_client = prometheus_client
+        self.registry = registry or prometheus_client.CollectorRegistry()
+        self.stage_seconds = prometheus_client.Histogram("app_stage_duration_seconds", "Duration of each step of answering a request",
+                                                         ["stage"], registry=self.registry)
+        self.tokens = prometheus_client.Counter("app_openai_tokens_total", "Tokens used by OpenAI completions",
+                                                ["deployment", "kind"], registry=self.registry)
+        self.request_seconds = prometheus_client.Histogram("app_request_duration_seconds", "Duration of the requests",
+                                                           ["route", "approach"], registry=self.registry)
+        self.request_tokens = prometheus_client.Histogram("app_request_tokens", "OpenAI tokens used to answer a request", ["route", "approach", "kind"],
+                                                          buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000), registry=self.registry)
+
+    def observe_stage(self, stage: str, seconds: float):
+        self.stage_seconds.labels(stage).observe(seconds)
+
+    def add_tokens(self, deployment: str, prompt_tokens: int, completion_tokens: int):
+        self.tokens.labels(deployment, "prompt").inc(prompt_tokens)
+        self.tokens.labels(deployment, "completion").inc(completion_tokens)
+
+    def observe_request(self, route: str, approach: str, seconds: float, usage: TokenUsage):
+        self.request_seconds.labels(route, approach).observe(seconds)
+        if usage.calls:
+            self.request_tokens.labels(route, approach, "prompt").observe(usage.prompt_tokens)
+            self.request_tokens.labels(route, approach, "completion").observe(usage.completion_tokens)
+
+    def render(self) -> tuple[bytes, str]:
+        return self.prometheus_client.generate_latest(self.registry), self.prometheus_client.CONTENT_TYPE_LATEST
+
+def create_tracer(service_name: str) -> Any:
+    """
+    Sets up OpenTelemetry to export spans with OTLP over HTTP, to the endpoint in the standard OTEL_EXPORTER_OTLP_*
+    environment variables. Requires the optional "opentelemetry-sdk" and "opentelemetry-exporter-otlp-proto-http" packages.
+    """
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        raise Exception("The opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http packages are required for tracing, install them with pip")
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer(__name__)
+
+def configure(tracer_: Any = None, metrics_: Optional[Metrics] = None):
+    global tracer, metrics
+    tracer = tracer_
+    metrics = metrics_
+
+class Span:
+    """Times a step for the metrics, and traces it as an OpenTelemetry span nested in the span of its caller."""
+
+    def __init__(self, name: str, attributes: dict[str, Any]):
+        self.name = name
+        self.attributes = {k: v for k, v in attributes.items() if v is not None}
+        self.span_context: Any = None
+        self.span: Any = None
+
+    def __enter__(self) -> "Span":
+        if tracer is not None:
+            self.span_context = tracer.start_as_current_span(self.name, attributes=self.attributes)
+            self.span = self.span_context.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> Optional[bool]:
+        if metrics is not None:
+            metrics.observe_stage(self.name, time.perf_counter() - self.start)
+        if self.span_context is not None:
+            return self.span_context.__exit__(*exc_info)
+        return None
+
+    def set_attribute(self, key: str, value: Any):
+        if self.span is not None and value is not None:
+            self.span.set_attribute(key, value)
+
+def span(name: str, **attributes: Any) -> ContextManager:
+    if tracer is None and metrics is None:
+        return NOOP_SPAN
+    return Span(name, attributes)
+
+@contextlib.contextmanager
+def request(route: str, approach: str) -> Iterator[None]:
+    """Traces a request with its approach, and records its duration and the tokens its OpenAI calls used."""
+    if tracer is None and metrics is None:
+        yield
+        return
+    usage = TokenUsage()
+    token = current_usage.set(usage)
+    start = time.perf_counter()
+    try:
+        with Span(route, {"approach": approach}) as request_span:
+            yield
+            request_span.set_attribute("openai.calls", usage.calls)
+            request_span.set_attribute("openai.prompt_tokens", usage.prompt_tokens)
+            request_span.set_attribute("openai.completion_tokens", usage.completion_tokens)
+    finally:
+        current_usage.reset(token)
+        if metrics is not None:
+            metrics.observe_request(route, approach, time.perf_counter() - start, usage)
+
+async def streamed_request(route: str, approach: str, events: AsyncIterator[Any]) -> AsyncGenerator[Any, None]:
+    """Same as request, for a response streamed from events: the request lasts until the stream is done or closed."""
+    with request(route, approach):
+        async for event in events:
+            yield event
+
+def record_tokens(deployment: str, usage: Optional[dict[str, Any]], call_span: Any = None):
+    """Adds the usage of an OpenAI completion to its span, to the request being served and to the metrics."""
+    if (tracer is None and metrics is None) or not usage:
+        return
+    prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    if isinstance(call_span, Span):
+        call_span.set_attribute("openai.prompt_tokens", prompt_tokens)
+        call_span.set_attribute("openai.completion_tokens", completion_tokens)
+    request_usage = current_usage.get()
+    if request_usage is not None:
+        request_usage.calls += 1
+        request_usage.prompt_tokens += prompt_tokens
+        request_usage.completion_tokens += completion_tokens
+    if metrics is not None:
+        metrics.add_tokens(deployment, prompt_tokens, completion_tokens)
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import time
+import types
+
+import openai
+import pytest
+
+import app as backend
+from approaches.approach import Approach
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.retrievethenread import RetrieveThenReadApproach
+from conftest import CharEncoding, FakeRetrieval
+
+@pytest.fixture
+def completions(monkeypatch):
+    calls = []
+    async def acreate(**kwargs):
+        calls.append(kwargs["prompt"])
+        prompts = kwargs["prompt"] if isinstance(kwargs["prompt"], list) else [kwargs["prompt"]]
+        # Answer in reverse order to make sure choices are matched to prompts by index
+        choices = [types.SimpleNamespace(index=i, text="answer to " + p.split("Question: '")[-1].split("'")[0]) for i, p in enumerate(prompts)]
+        return types.SimpleNamespace(choices=list(reversed(choices)))
+    monkeypatch.setattr(openai.Completion, "acreate", acreate)
+    return calls
+
+async def collect(generator):
+    return [r async for r in generator]
+
+def test_batch_packs_prompts_into_completion_calls(completions):
+    impl = RetrieveThenReadApproach(FakeRetrieval(), "davinci", "sourcepage", "content")
+    questions = [f"question {i}" for i in range(40)] + ["boom"]
+    results = asyncio.run(collect(impl.run_batch(questions, {}, max_concurrency=2)))
+
+    assert len(completions) == 3
+    # Groups run concurrently, so the calls can be made in any order
+    assert sorted(len(prompts) for prompts in completions) == [8, 16, 16]
+    results = sorted(results, key=lambda r: r["index"])
+    assert [r["question"] for r in results] == questions
+    assert all(r["answer"] == "answer to " + r["question"] for r in results[:40])
+    assert results[0]["data_points"] == ["question 0.pdf: about question 0"]
+    assert results[40]["error"] == "search failed"
+
+def test_default_batch_runs_questions_concurrently():
+    class SlowApproach(Approach):
+        async def run(self, q, overrides):
+            await asyncio.sleep(0.1)
+            return {"answer": q.upper()}
+
+    start = time.perf_counter()
+    results = asyncio.run(collect(SlowApproach().run_batch(["a", "b", "c", "d"], {}, max_concurrency=4)))
+    assert time.perf_counter() - start < 0.3
+    assert sorted(r["answer"] for r in results) == ["A", "B", "C", "D"]
+
+def test_ask_batch_streams_ndjson(completions, monkeypatch):
+    monkeypatch.setitem(backend.app.config, backend.CONFIG_OPENAI_TOKEN, types.SimpleNamespace(expires_on=time.time() + 3600))
+    monkeypatch.setitem(backend.app.config, backend.CONFIG_ASK_APPROACHES, {"rtr": RetrieveThenReadApproach(FakeRetrieval(), "davinci", "sourcepage", "content")})
+
+    async def post(body):
+        response = await backend.app.test_client().post("/ask_batch", json=body)
+        return response, await response.get_data(as_text=True)
+
+    response, data = asyncio.run(post({"approach": "rtr", "questions": ["ค่าธรรมเนียม", "บัตรเดบิต"], "overrides": {"top": 1}}))
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in data.splitlines()]
+    assert sorted(line["answer"] for line in lines) == ["answer to ค่าธรรมเนียม", "answer to บัตรเดบิต"]
+
+    response, _ = asyncio.run(post({"approach": "rtr", "questions": "not a list"}))
+    assert response.status_code == 400
+
+def test_adaptive_retrieval_answers_without_a_completion_when_nothing_is_relevant(completions):
+    class AdaptiveRetrieval(FakeRetrieval):
+        async def search(self, q, overrides):
+            return [] if "unknown" in q else await super().search(q, overrides)
+
+        def is_adaptive(self, overrides):
+            return True
+
+    impl = RetrieveThenReadApproach(AdaptiveRetrieval(), "davinci", "sourcepage", "content")
+    assert asyncio.run(impl.run("unknown product", {}))["answer"] == impl.no_answer
+    assert completions == []
+
+    results = sorted(asyncio.run(collect(impl.run_batch(["question 1", "unknown product", "question 2"], {}))), key=lambda r: r["index"])
+    assert [r["answer"] for r in results] == ["answer to question 1", impl.no_answer, "answer to question 2"]
+    assert len(completions[0]) == 2
+
+def test_chat_stream_sends_the_sources_then_the_answer_as_ndjson(monkeypatch):
+    async def acreate(**kwargs):
+        if not kwargs.get("stream"):
+            # Query rewriting
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(text="ค่าธรรมเนียมบัตรเดบิต")])
+        async def chunks():
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(text="ฟรี")])
+            # Content filter results come without choices
+            yield types.SimpleNamespace(choices=[])
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(text="ครับ")])
+            if "boom" in kwargs["prompt"]:
+                raise openai.error.APIConnectionError("connection reset")
+        if "busy" in kwargs["prompt"]:
+            raise openai.error.RateLimitError("All deployments of chat are over their rate limit", http_status=429, headers={"Retry-After": "7"})
+        return chunks()
+    monkeypatch.setattr(openai.Completion, "acreate", acreate)
+    monkeypatch.setitem(backend.app.config, backend.CONFIG_OPENAI_TOKEN, types.SimpleNamespace(expires_on=time.time() + 3600))
+    impl = ChatReadRetrieveReadApproach(FakeRetrieval(), "chat", "gpt-35-turbo", "davinci", "sourcepage", "content")
+    impl.prompt_builder._encoding = CharEncoding()
+    monkeypatch.setitem(backend.app.config, backend.CONFIG_CHAT_APPROACHES, {"rrr": impl})
+
+    async def post(body):
+        response = await backend.app.test_client().post("/chat_stream", json=body)
+        return response, await response.get_data(as_text=True)
+
+    response, data = asyncio.run(post({"approach": "rrr", "history": [{"user": "ค่าธรรมเนียม"}], "overrides": {"include_thoughts": True}}))
+    assert response.mimetype == "application/x-ndjson"
+    assert data.endswith("\n")
+    first, *deltas = [json.loads(line) for line in data.splitlines()]
+    assert first["answer"] == ""
+    assert first["data_points"] == ["ค่าธรรมเนียมบัตรเดบิต.pdf: about ค่าธรรมเนียมบัตรเดบิต"]
+    assert "Searched for:<br>ค่าธรรมเนียมบัตรเดบิต" in first["thoughts"]
+    assert deltas == [{"delta": "ฟรี"}, {"delta": "ครับ"}]
+
+    # Headers are sent with the first line, a failure after that is reported as the last line
+    response, data = asyncio.run(post({"approach": "rrr", "history": [{"user": "boom"}]}))
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in data.splitlines()]
+    assert lines[1:3] == [{"delta": "ฟรี"}, {"delta": "ครับ"}]
+    assert lines[3] == {"error": "connection reset"}
+
+    # Throttling can't be a 429 any more either, the error line says when to retry
+    response, data = asyncio.run(post({"approach": "rrr", "history": [{"user": "busy"}]}))
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in data.splitlines()]
+    assert lines[-1] == {"error": "The service is busy, please retry later", "retry_after": 7}
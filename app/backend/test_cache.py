@@ -0,0 +1,52 @@
+import asyncio
+import types
+
+import openai
+from cache import InMemoryCache, make_key, normalize_text
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+
+def test_normalize_text():
+    assert normalize_text("  What is  TTB All Free?\n") == "what is ttb all free?"
+    # full-width characters are folded to their ASCII equivalent
+    assert normalize_text("ＴＴＢ") == "ttb"
+    assert make_key("davinci", normalize_text("Hello  World")) == make_key("davinci", "hello world")
+    assert make_key("davinci", "q") != make_key("chat", "q")
+
+def test_lru_eviction_and_counters():
+    async def scenario():
+        cache = InMemoryCache("test", max_entries=2)
+        await cache.set("a", 1)
+        await cache.set("b", 2)
+        assert await cache.get("a") == 1
+        # "b" is now the least recently used entry and gets evicted
+        await cache.set("c", 3)
+        assert await cache.get("b") is None
+        assert await cache.get("c") == 3
+        return cache.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["entries"] == 2
+
+def test_ttl_expiry():
+    async def scenario():
+        cache = InMemoryCache("test", ttl_seconds=-1)
+        await cache.set("a", 1)
+        return await cache.get("a")
+
+    assert asyncio.run(scenario()) is None
+
+def test_query_rewrite_is_cached(monkeypatch):
+    calls = []
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(text="บัตรเดบิต ttb all free")])
+    monkeypatch.setattr(openai.Completion, "acreate", acreate)
+
+    impl = ChatReadRetrieveReadApproach(None, "chat", "gpt-35-turbo", "davinci", "sourcepage", "content", query_cache=InMemoryCache("query"))
+    first = asyncio.run(impl.generate_search_query("บัตรเดบิต ttb all free มีค่าธรรมเนียมไหม"))
+    second = asyncio.run(impl.generate_search_query("  บัตรเดบิต TTB all free มีค่าธรรมเนียมไหม "))
+    assert first == second == "บัตรเดบิต ttb all free"
+    assert len(calls) == 1
+    assert impl.query_cache.stats()["hits"] == 1
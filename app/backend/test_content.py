@@ -0,0 +1,115 @@
+import asyncio
+import types
+
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+import app as backend
+from contentcache import DiskBlobCache, parse_range
+
+class FakeDownloader:
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    async def chunks(self):
+        for i in range(0, len(self.data), self.chunk_size):
+            yield self.data[i:i + self.chunk_size]
+
+class FakeBlobClient:
+    def __init__(self, container, name):
+        self.container = container
+        self.blob_name = name
+
+    async def get_blob_properties(self):
+        if self.blob_name not in self.container.blobs:
+            raise ResourceNotFoundError("not found")
+        data, etag = self.container.blobs[self.blob_name]
+        return types.SimpleNamespace(etag=etag, size=len(data), content_settings=types.SimpleNamespace(content_type="application/octet-stream"))
+
+    async def download_blob(self, offset, length, etag, match_condition):
+        data, current_etag = self.container.blobs[self.blob_name]
+        assert etag == current_etag
+        self.container.downloads.append((self.blob_name, offset, length))
+        return FakeDownloader(data[offset:offset + length], 4)
+
+class FakeContainerClient:
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.downloads = []
+
+    def get_blob_client(self, name):
+        return FakeBlobClient(self, name)
+
+@pytest.fixture
+def container(monkeypatch):
+    container = FakeContainerClient({"ttb-all-free-0.pdf": (b"%PDF-1.4 ttb all free", '"0x1"')})
+    monkeypatch.setitem(backend.app.config, backend.CONFIG_BLOB_CONTAINER, container)
+    monkeypatch.setitem(backend.app.config, backend.CONFIG_CACHES, {})
+    return container
+
+def get(path, headers=None):
+    async def request():
+        response = await backend.app.test_client().get(path, headers=headers or {})
+        return response, await response.get_data()
+    return asyncio.run(request())
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    with pytest.raises(ValueError):
+        parse_range("bytes=100-", 100)
+
+def test_content_is_streamed_with_etag(container):
+    response, data = get("/content/ttb-all-free-0.pdf")
+    assert response.status_code == 200
+    assert data == b"%PDF-1.4 ttb all free"
+    assert response.mimetype == "application/pdf"
+    assert response.headers["ETag"] == '"0x1"'
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert "max-age" in response.headers["Cache-Control"]
+
+    response, data = get("/content/ttb-all-free-0.pdf", {"If-None-Match": '"0x1"'})
+    assert response.status_code == 304
+    assert data == b""
+    assert len(container.downloads) == 1
+
+    response, _ = get("/content/missing.pdf")
+    assert response.status_code == 404
+
+def test_content_range_requests(container):
+    response, data = get("/content/ttb-all-free-0.pdf", {"Range": "bytes=9-11"})
+    assert response.status_code == 206
+    assert data == b"ttb"
+    assert response.headers["Content-Range"] == "bytes 9-11/21"
+    assert container.downloads == [("ttb-all-free-0.pdf", 9, 3)]
+
+    # A range for an older version of the blob gets the whole new version
+    response, data = get("/content/ttb-all-free-0.pdf", {"Range": "bytes=9-11", "If-Range": '"0x0"'})
+    assert response.status_code == 200
+    assert len(data) == 21
+
+    response, _ = get("/content/ttb-all-free-0.pdf", {"Range": "bytes=100-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */21"
+
+def test_content_disk_cache(container, tmp_path):
+    content_cache = DiskBlobCache(str(tmp_path), max_bytes=40, max_file_bytes=30)
+    backend.app.config[backend.CONFIG_CACHES]["content"] = content_cache
+
+    assert get("/content/ttb-all-free-0.pdf")[1] == b"%PDF-1.4 ttb all free"
+    assert get("/content/ttb-all-free-0.pdf")[1] == b"%PDF-1.4 ttb all free"
+    assert get("/content/ttb-all-free-0.pdf", {"Range": "bytes=-4"})[1] == b"free"
+    assert len(container.downloads) == 1
+    assert content_cache.stats()["hits"] == 2
+
+    # A new version of the blob is downloaded again, and the old one is evicted to stay within max_bytes
+    container.blobs["ttb-all-free-0.pdf"] = (b"%PDF-1.4 ttb all free v2", '"0x2"')
+    assert get("/content/ttb-all-free-0.pdf")[1] == b"%PDF-1.4 ttb all free v2"
+    assert len(container.downloads) == 2
+    assert content_cache.stats()["entries"] == 1
+    assert len(list(tmp_path.iterdir())) == 1
@@ -0,0 +1,32 @@
+from langchain.schema import AgentAction
+
+from langchainadapters import HtmlCallbackHandler
+
+def test_events_are_rendered_escaped():
+    handler = HtmlCallbackHandler()
+    handler.on_llm_start({}, ["Question: <b>ค่าธรรมเนียม</b>\nThought:", "second"])
+    handler.on_agent_action(AgentAction("Search", "fee", "Search[fee & limit]"), color="green")
+    handler.on_tool_end("fee.pdf: 100 บาท", color="green", observation_prefix="Observation: ", llm_prefix="Thought:")
+    assert handler.render() == ("LLM prompts:<br>Question: &lt;b&gt;ค่าธรรมเนียม&lt;/b&gt;<br>Thought:<br>second<br>"
+                                "<span style='color:green'>Search[fee &amp; limit]</span><br>"
+                                "Observation: <br><span style='color:green'>fee.pdf: 100 บาท</span><br>Thought:<br>")
+
+def test_handlers_dont_share_events():
+    first, second = HtmlCallbackHandler(), HtmlCallbackHandler()
+    first.on_text("first")
+    assert second.render() == ""
+
+def test_log_is_capped():
+    handler = HtmlCallbackHandler(max_events=10, max_chars=1000)
+    for i in range(100):
+        handler.on_llm_start({}, ["x" * 300])
+    assert len(handler.events) == 4
+    assert handler.chars == 1000
+    assert handler.events[-1][2][0].endswith("x [...]")
+    assert handler.render().endswith("96 more steps omitted</span><br>")
+
+    handler = HtmlCallbackHandler(max_events=10, max_chars=1000)
+    for i in range(100):
+        handler.on_chain_end({})
+    assert len(handler.events) == 10
+    assert handler.omitted == 90
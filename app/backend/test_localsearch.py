@@ -0,0 +1,140 @@
+import asyncio
+
+import pytest
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+
+from conftest import section
+from localsearch import LocalSearchClient, LocalSearchIndex, LocalSearchIndexWriter, parse_filter, tokenize
+from retrieval import RetrievalService
+
+@pytest.fixture
+def client(tmp_path):
+    writer = LocalSearchIndexWriter(str(tmp_path))
+    writer.replace_file("ttb.pdf", [
+        section("fee", "ค่าธรรมเนียมบัตรเดบิต ttb all free ฟรีค่าธรรมเนียมรายปี"),
+        section("atm", "กดเงินสดที่ตู้ ATM ต่างธนาคาร ฟรี"),
+        section("draft", "ร่าง ค่าธรรมเนียม", category="o'clock")])
+    writer.replace_file("tc.pdf", [section("insurance", "ประกันอุบัติเหตุ คุ้มครองค่ารักษาพยาบาล", "tc.pdf")])
+    writer.save()
+    return LocalSearchClient(LocalSearchIndex.load(str(tmp_path)))
+
+def search(client, q, **kwargs):
+    async def run():
+        r = await client.search(q, **kwargs)
+        return [doc async for doc in r], await r.get_count()
+    return asyncio.run(run())
+
+def test_tokenize_indexes_thai_as_bigrams():
+    assert tokenize("บัตร ATM-Free") == ["บั", "ัต", "ตร", "atm", "free"]
+
+def test_parse_filter():
+    assert parse_filter("category ne 'o''clock'") == [("category", "ne", "o'clock")]
+    assert parse_filter("category ne 'a' and sourcefile eq 'b.pdf'") == [("category", "ne", "a"), ("sourcefile", "eq", "b.pdf")]
+    assert parse_filter("search.in(id, 'fee,atm', ',') and category ne 'a'") == [("id", "in", ["fee", "atm"]), ("category", "ne", "a")]
+    with pytest.raises(ValueError):
+        parse_filter("search.ismatch('x')")
+
+def test_bm25_ranks_thai_sections(client):
+    docs, count = search(client, "ค่าธรรมเนียมบัตรเดบิต", top=2)
+    assert [doc["id"] for doc in docs] == ["fee", "draft"]
+    # Like the "any" search mode of Cognitive Search, sections matching any term count, ค่ารักษา shares ค่
+    assert count == 4
+    assert docs[0]["@search.score"] > docs[1]["@search.score"] > 0
+
+    docs, _ = search(client, "ค่าธรรมเนียม", filter="category ne 'o''clock'", query_caption="extractive|highlight-false")
+    assert docs[0]["id"] == "fee"
+    assert "draft" not in [doc["id"] for doc in docs]
+    assert docs[0]["@search.captions"][0].text.startswith("ค่าธรรมเนียมบัตรเดบิต")
+
+    docs, count = search(client, "", filter="sourcefile eq 'tc.pdf'")
+    assert [doc["id"] for doc in docs] == ["insurance"]
+    assert search(client, "mortgage")[1] == 0
+
+def test_writer_replaces_sections_of_changed_files(client, tmp_path):
+    writer = LocalSearchIndexWriter(str(tmp_path))
+    writer.replace_file("ttb.pdf", [section("fee-v2", "ค่าธรรมเนียมบัตรเครดิต")])
+    writer.save()
+    docs, _ = search(LocalSearchClient(LocalSearchIndex.load(str(tmp_path))), "*", top=10)
+    assert sorted(doc["id"] for doc in docs) == ["fee-v2", "insurance"]
+
+def test_retrieval_service_on_local_search(client):
+    retrieval = RetrievalService(client)
+    docs = asyncio.run(retrieval.search("กดเงินสด ATM", {"top": 1, "semantic_ranker": True, "semantic_captions": True}))
+    assert docs[0]["sourcepage"] == "ttb.pdf#page=1"
+    assert docs[0]["@search.captions"][0].text.startswith("กดเงินสด")
+    answers, docs = asyncio.run(retrieval.semantic_answers("ประกันอุบัติเหตุ"))
+    assert answers == []
+    assert docs[0]["id"] == "insurance"
+
+# Fields declared filterable in the index created by prepdocs.py, the key field "id" isn't
+FILTERABLE_FIELDS = {"category", "sourcepage", "sourcefile"}
+
+class CountingClient:
+    """Records the calls, and rejects filters on fields that Cognitive Search wouldn't let us filter on."""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+        self.lookups = []
+
+    async def search(self, q, **kwargs):
+        for name, _, _ in parse_filter(kwargs.get("filter")):
+            if name not in FILTERABLE_FIELDS:
+                raise HttpResponseError(f"Invalid expression: The field '{name}' is not filterable")
+        self.calls.append(kwargs)
+        return await self.client.search(q, **kwargs)
+
+    async def get_document(self, key, selected_fields=None):
+        self.lookups.append((key, selected_fields))
+        return await self.client.get_document(key, selected_fields=selected_fields)
+
+def test_searches_only_download_the_fields_they_use(client):
+    search_client = CountingClient(client)
+    retrieval = RetrievalService(search_client)
+
+    async def scenario():
+        return (await retrieval.search("ค่าธรรมเนียม", {"semantic_ranker": True, "semantic_captions": True}),
+                await retrieval.search("ค่าธรรมเนียม", {}))
+
+    with_captions, with_content = asyncio.run(scenario())
+    assert [call["select"] for call in search_client.calls] == [["id", "sourcepage"], ["id", "sourcepage", "content"]]
+    assert "content" not in with_captions[0] and with_captions[0]["@search.captions"]
+    assert with_content[0]["content"] == "ร่าง ค่าธรรมเนียม"
+
+def test_two_phase_search_fetches_the_content_that_fits_the_budget(client):
+    search_client = CountingClient(client)
+    # The sections are 45, 29 and 38 tokens, the budget fits the first two
+    retrieval = RetrievalService(search_client, two_phase=True, content_token_budget=80, expected_section_tokens=30)
+
+    docs = asyncio.run(retrieval.search("ค่าธรรมเนียม ฟรี", {"top": 3, "exclude_category": "o'clock"}))
+    assert [doc["id"] for doc in docs] == ["fee", "atm"]
+    assert docs[1]["content"] == "กดเงินสดที่ตู้ ATM ต่างธนาคาร ฟรี"
+    [ranking] = search_client.calls
+    assert ranking["select"] == ["id", "sourcepage"]
+    # The content of the two sections the first estimate expects to fit is looked up by key, the third isn't fetched
+    assert search_client.lookups == [("fee", ["id", "content"]), ("atm", ["id", "content"])]
+
+def test_two_phase_search_skips_sections_deleted_since_ranking(client):
+    class DeletingClient(CountingClient):
+        async def get_document(self, key, selected_fields=None):
+            if key == "fee":
+                raise ResourceNotFoundError("Document not found")
+            return await super().get_document(key, selected_fields)
+
+    retrieval = RetrievalService(DeletingClient(client), two_phase=True)
+    docs = asyncio.run(retrieval.search("ค่าธรรมเนียม ฟรี", {"top": 2, "exclude_category": "o'clock"}))
+    assert [doc["id"] for doc in docs] == ["atm"]
+
+def test_adaptive_search_keeps_results_close_to_the_best(client):
+    retrieval = RetrievalService(client, adaptive=True, relative_score_cutoff=0.5)
+
+    async def scenario():
+        ranked = await RetrievalService(client).search("บัตรเดบิต", {"top": 10})
+        return ranked, await retrieval.search("บัตรเดบิต", {"top": 1}), await retrieval.search("บัตรเดบิต", {"minimum_search_score": 1000})
+
+    ranked, adaptive, unanswerable = asyncio.run(scenario())
+    best = ranked[0]["@search.score"]
+    # top only sets the minimum number of candidates, every result within half of the best score is kept
+    assert [doc["id"] for doc in adaptive] == [doc["id"] for doc in ranked if doc["@search.score"] >= best / 2]
+    assert len(adaptive) < len(ranked)
+    assert unanswerable == []
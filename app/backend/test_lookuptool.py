@@ -0,0 +1,30 @@
+import os
+
+from lookuptool import CsvLookupTool, CsvStore
+
+def write_csv(path, rows):
+    path.write_text("name,title,insurance\n" + "".join(f"{','.join(row)}\n" for row in rows), encoding="utf-8")
+
+def test_lookup_ignores_case_and_falls_back_to_prefixes(tmp_path):
+    path = tmp_path / "employees.csv"
+    write_csv(path, [("Employee1", "Program Manager", "Plus"), ("Employee2", "Software Engineer", "Standard"), ("สมชาย ใจดี", "ผู้จัดการ", "Plus")])
+    tool = CsvLookupTool(path, "name")
+    assert tool.lookup("employee1") == "name:Employee1\ntitle:Program Manager\ninsurance:Plus"
+    assert tool.lookup(" EMPLOYEE ") == "name:Employee1\ntitle:Program Manager\ninsurance:Plus\n\nname:Employee2\ntitle:Software Engineer\ninsurance:Standard"
+    assert tool.lookup("สมชาย").startswith("name:สมชาย ใจดี\n")
+    assert tool.lookup("Employee3") == ""
+    assert tool.lookup("") == ""
+
+def test_tools_share_a_store_that_reloads_when_the_file_changes(tmp_path):
+    path = tmp_path / "employees.csv"
+    write_csv(path, [("Employee1", "Program Manager", "Plus")])
+    first, second = CsvLookupTool(path, "name"), CsvLookupTool(path, "name")
+    assert first.store is second.store
+
+    store = CsvStore(path, "name", check_interval_seconds=0)
+    table = store.get()
+    assert store.get() is table
+    write_csv(path, [("Employee1", "Director", "Plus")])
+    os.utime(path, ns=(store.mtime + 1_000_000_000, store.mtime + 1_000_000_000))
+    assert store.get() is not table
+    assert store.get().row(0) == "name:Employee1\ntitle:Director\ninsurance:Plus"
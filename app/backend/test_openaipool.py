@@ -0,0 +1,77 @@
+import asyncio
+
+import openai
+import pytest
+
+from openaipool import OpenAIPool, estimate_tokens, parse_tpm_limits
+
+class FakeCompletion:
+    """Records the service of each request, and throttles the services in `throttled` with a Retry-After."""
+
+    def __init__(self, throttled=(), retry_after="30"):
+        self.calls = []
+        self.throttled = set(throttled)
+        self.retry_after = retry_after
+
+    async def acreate(self, engine, api_base, **kwargs):
+        service = api_base.split("//")[1].split(".")[0]
+        self.calls.append((service, engine))
+        if service in self.throttled:
+            raise openai.error.RateLimitError("Rate limit is exceeded.", http_status=429, headers={"Retry-After": self.retry_after})
+        return {"choices": [{"text": "ฟรี"}], "usage": {"prompt_tokens": 10, "completion_tokens": 2}}
+
+def test_parse_tpm_limits():
+    assert parse_tpm_limits("chat=120000, davinci=60000") == {"chat": 120000, "davinci": 60000}
+    assert parse_tpm_limits(None) == {}
+
+def test_estimate_tokens_counts_prompt_and_max_tokens():
+    assert estimate_tokens({"prompt": "abcdef", "max_tokens": 100}) == 102
+    assert estimate_tokens({"prompt": ["abc", "abc"], "max_tokens": 10}) == 22
+
+def test_throttled_service_is_skipped_until_retry_after():
+    pool = OpenAIPool(["eastus", "westeurope"])
+    completion = FakeCompletion(throttled={"eastus"})
+
+    async def scenario():
+        results = [await pool.acreate(completion, engine="chat", prompt="ค่าธรรมเนียม", max_tokens=10) for _ in range(4)]
+        await pool.close()
+        return results
+
+    results = asyncio.run(scenario())
+    assert all(r["choices"][0]["text"] == "ฟรี" for r in results)
+    # eastus is tried once, then left alone while it asks for 30 seconds
+    assert [service for service, _ in completion.calls].count("eastus") == 1
+    assert completion.calls[-1] == ("westeurope", "chat")
+    stats = pool.stats()
+    assert stats["retries"] == 1
+    assert stats["deployments"]["eastus/chat"]["throttled"] == 1
+    assert stats["deployments"]["westeurope/chat"]["requests"] == 4
+    assert stats["deployments"]["westeurope/chat"]["completion_tokens"] == 8
+
+def test_requests_go_to_the_deployment_with_the_most_budget_left():
+    pool = OpenAIPool(["eastus", "westeurope"], {"chat": 1000})
+    completion = FakeCompletion()
+
+    async def scenario():
+        for _ in range(6):
+            await pool.acreate(completion, engine="chat", prompt="", max_tokens=300)
+        await pool.close()
+
+    asyncio.run(scenario())
+    assert [service for service, _ in completion.calls] == ["eastus", "westeurope", "eastus", "westeurope", "eastus", "westeurope"]
+    assert pool.stats()["deployments"]["eastus/chat"]["tpm_used"] == 900
+
+def test_rate_limit_error_when_every_deployment_is_throttled_too_long():
+    pool = OpenAIPool(["eastus"], max_retries=2, max_wait_seconds=1)
+    completion = FakeCompletion(throttled={"eastus"})
+
+    async def scenario():
+        try:
+            await pool.acreate(completion, engine="chat", prompt="", max_tokens=10)
+        finally:
+            await pool.close()
+
+    with pytest.raises(openai.error.RateLimitError) as e:
+        asyncio.run(scenario())
+    assert int(e.value.headers["Retry-After"]) > 1
+    assert len(completion.calls) == 1
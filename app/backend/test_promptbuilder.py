@@ -0,0 +1,73 @@
+import asyncio
+import types
+
+import openai
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from conftest import CharEncoding
+from promptbuilder import PromptBuilder
+
+def render(sources, history):
+    return f"S:{sources}|H:{history}"
+
+def test_sources_are_dropped_lowest_ranked_first():
+    builder = PromptBuilder("gpt-35-turbo", max_prompt_tokens=60, min_source_tokens=5, encoding=CharEncoding())
+    sources = ["a.pdf: " + "a" * 20, "b.pdf: " + "b" * 20, "c.pdf: " + "c" * 20]
+    prompt, used, usage = builder.build(render, sources, ["q?"])
+
+    # 5 template tokens and 2 history tokens leave 53 for the sources: the first one, a newline and 25 of the second
+    assert used == [sources[0], "b.pdf: " + "b" * 18]
+    assert len(prompt) == 60
+    assert usage["prompt_tokens"] == 60
+    assert (usage["sources_used"], usage["sources_truncated"], usage["sources_dropped"]) == (2, 1, 1)
+
+def test_sources_whose_truncation_doesnt_shrink_are_dropped():
+    class ReplacementEncoding(CharEncoding):
+        """Decoding a cut sequence adds replacement characters, like a cut in the middle of a multi-byte character."""
+        def decode(self, tokens):
+            return super().decode(tokens) + "\ufffd" * 3
+
+    builder = PromptBuilder("gpt-35-turbo", max_prompt_tokens=60, min_source_tokens=5, encoding=ReplacementEncoding())
+    sources = ["a.pdf: " + "a" * 20, "b.pdf: " + "b" * 20, "c.pdf: " + "c" * 20]
+    prompt, used, usage = builder.build(render, sources, ["q?"])
+    assert used == [sources[0]]
+    assert usage["prompt_tokens"] == len(prompt) <= 60
+
+def test_sources_too_short_to_be_useful_are_dropped():
+    builder = PromptBuilder("gpt-35-turbo", max_prompt_tokens=40, min_source_tokens=10, encoding=CharEncoding())
+    sources = ["a.pdf: " + "a" * 20, "b.pdf: " + "b" * 20]
+    _, used, usage = builder.build(render, sources, ["q?"])
+    assert used == [sources[0]]
+    assert usage["sources_dropped"] == 1
+    assert usage["sources_truncated"] == 0
+
+def test_history_keeps_latest_turn_and_newest_turns_within_budget():
+    builder = PromptBuilder("gpt-35-turbo", max_prompt_tokens=1000, max_history_tokens=25, encoding=CharEncoding())
+    turns = ["first turn.", "second turn.", "third turn.", "this latest turn is over the budget on its own."]
+    prompt, _, usage = builder.build(render, [], turns)
+    assert prompt.endswith("|H:" + turns[-1])
+    assert usage["history_turns"] == 1
+
+    builder.max_history_tokens = 40
+    prompt, _, usage = builder.build(render, [], turns[:3])
+    assert prompt.endswith("|H:" + "".join(turns[:3]))
+    assert usage["history_turns"] == 3
+
+def test_chat_approach_reports_token_usage(monkeypatch):
+    async def acreate(**kwargs):
+        if kwargs["max_tokens"] == 120:
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(text="ค่าธรรมเนียม")])
+        assert len(kwargs["prompt"]) <= 3000
+        return openai.openai_object.OpenAIObject.construct_from({"choices": [{"text": "ฟรีครับ [ttb-1.pdf]"}], "usage": {"completion_tokens": 8, "total_tokens": 2908}})
+    monkeypatch.setattr(openai.Completion, "acreate", acreate)
+
+    class Retrieval:
+        async def search(self, q, overrides):
+            return [{"sourcepage": f"ttb-{i}.pdf", "content": "ค่าธรรมเนียม " * 100} for i in range(5)]
+
+    impl = ChatReadRetrieveReadApproach(Retrieval(), "chat", "gpt-35-turbo", "davinci", "sourcepage", "content", max_prompt_tokens=3000)
+    impl.prompt_builder._encoding = CharEncoding()
+    r = asyncio.run(impl.run([{"user": "ค่าธรรมเนียมบัตรเดบิต"}], {}))
+    assert r["token_usage"]["prompt_tokens"] <= 3000
+    assert r["token_usage"]["completion_tokens"] == 8
+    # Only the sources that made it into the prompt are returned as data points
+    assert len(r["data_points"]) == r["token_usage"]["sources_used"] < 5
@@ -0,0 +1,65 @@
+import asyncio
+
+from langchain.llms.fake import FakeListLLM
+from langchain.schema import AgentFinish
+
+from approaches import readdecomposeask
+from approaches.readdecomposeask import ParallelReActOutputParser, ReadDecomposeAsk, query_entities
+
+class RecordingLLM(FakeListLLM):
+    prompts: list = []
+
+    async def _acall(self, prompt, stop=None, run_manager=None):
+        self.prompts.append(prompt)
+        return await super()._acall(prompt, stop, run_manager)
+
+class ConcurrentSearchRetrieval:
+    """Searches only complete once every search of the step has started, so they must run concurrently."""
+
+    def __init__(self, concurrent_searches):
+        self.started = []
+        self.lookups = []
+        self.concurrent_searches = concurrent_searches
+        self.all_started = asyncio.Event()
+
+    async def search(self, q, overrides):
+        self.started.append(q)
+        if len(self.started) == self.concurrent_searches:
+            self.all_started.set()
+        await asyncio.wait_for(self.all_started.wait(), 1)
+        return [{"sourcepage": f"{q}.pdf", "content": f"{q} ฟรีค่าธรรมเนียมรายปี"}]
+
+    async def semantic_answers(self, q):
+        self.lookups.append(q)
+        return [], [{"content": f"{q} คุ้มครอง 2,000 บาท"}]
+
+def test_parser_returns_every_action_of_a_step():
+    parser = ParallelReActOutputParser(max_actions=2)
+    text = " I need both cards.\nAction: Search[ttb all free]\nAction: Search[ttb so fast]\nAction: Search[ttb reserve]"
+    actions = parser.parse(text)
+    assert [(a.tool, a.tool_input) for a in actions] == [("Search", "ttb all free"), ("Search", "ttb so fast")]
+    assert actions[0].log == text and actions[1].log == ""
+    assert isinstance(parser.parse(" Done.\nAction: Finish[ฟรี <ttb.pdf>]"), AgentFinish)
+
+def test_query_entities():
+    assert query_entities("ttb all free และ ttb so fast") == ["ttb all free และ ttb so fast", "ttb all free", "ttb so fast"]
+    assert query_entities("ค่าธรรมเนียมรายปี") == ["ค่าธรรมเนียมรายปี"]
+
+def test_parallel_actions_run_concurrently_and_prefetch_lookups(monkeypatch):
+    llm = RecordingLLM(responses=[
+        " I need to search both cards.\nAction: Search[ttb all free]\nAction: Search[ttb so fast]",
+        " I need the insurance of ttb all free.\nAction: Lookup[ttb all free]",
+        " Both are free.\nAction: Finish[ฟรีทั้งสองใบ <ttb all free.pdf><ttb so fast.pdf>]",
+    ], prompts=[])
+    monkeypatch.setattr(readdecomposeask, "AzureOpenAI", lambda **kwargs: llm)
+    retrieval = ConcurrentSearchRetrieval(concurrent_searches=2)
+    impl = ReadDecomposeAsk(retrieval, "chat", "sourcepage", "content", parallel_actions=True)
+
+    result = asyncio.run(impl.run("บัตรไหนฟรีค่าธรรมเนียม", {}))
+    assert result["answer"] == "ฟรีทั้งสองใบ [ttb all free.pdf][ttb so fast.pdf]"
+    assert sorted(result["data_points"]) == ["ttb all free.pdf:ttb all free ฟรีค่าธรรมเนียมรายปี", "ttb so fast.pdf:ttb so fast ฟรีค่าธรรมเนียมรายปี"]
+    # The lookup the agent asked for was already running since the search, so it wasn't sent again
+    assert sorted(retrieval.lookups) == ["ttb all free", "ttb so fast"]
+    assert llm.prompts[1].endswith("Action: Search[ttb so fast]\nObservation: ttb all free.pdf:ttb all free ฟรีค่าธรรมเนียมรายปี\n"
+                                   "Observation: ttb so fast.pdf:ttb so fast ฟรีค่าธรรมเนียมรายปี\nThought:")
+    assert llm.prompts[2].endswith("Action: Lookup[ttb all free]\nObservation: ttb all free คุ้มครอง 2,000 บาท\nThought:")
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langchain.llms.base import LLM
+
+from approaches import readdecomposeask, readretrieveread
+from approaches.readdecomposeask import ReadDecomposeAsk
+from approaches.readretrieveread import ReadRetrieveReadApproach
+from conftest import FakeRetrieval
+
+class ScriptedLLM(LLM):
+    """Searches for the question of the prompt, then answers with it, after a random delay so requests interleave."""
+    search_action: str
+    finish_action: str
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _call(self, prompt, stop=None, run_manager=None):
+        raise NotImplementedError
+
+    async def _acall(self, prompt, stop=None, run_manager=None):
+        await asyncio.sleep(random.random() * 0.01)
+        question = re.findall(r"Question: (.*)", prompt)[-1]
+        if "Observation:" in prompt.rsplit("Question: ", 1)[1]:
+            return self.finish_action.format(question)
+        return self.search_action.format(question)
+
+@pytest.fixture(params=["rrr", "rda", "rda-parallel"])
+def approach(request, monkeypatch):
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if request.param == "rrr":
+        llm = ScriptedLLM(search_action=" Search.\nAction: CognitiveSearch\nAction Input: {}", finish_action=" Done.\nFinal Answer: {}")
+        monkeypatch.setattr(readretrieveread, "AzureOpenAI", lambda **kwargs: llm)
+        return ReadRetrieveReadApproach(FakeRetrieval(), "chat", "sourcepage", "content")
+    llm = ScriptedLLM(search_action=" Search.\nAction: Search[{}]", finish_action=" Done.\nAction: Finish[{}]")
+    monkeypatch.setattr(readdecomposeask, "AzureOpenAI", lambda **kwargs: llm)
+    return ReadDecomposeAsk(FakeRetrieval(), "chat", "sourcepage", "content", parallel_actions=request.param == "rda-parallel")
+
+def test_concurrent_requests_in_tasks_dont_share_state(approach):
+    questions = [f"question-{i}" for i in range(50)]
+
+    async def ask_all():
+        return await asyncio.gather(*[approach.run(q, {}) for q in questions])
+
+    for q, result in zip(questions, asyncio.run(ask_all())):
+        assert result["answer"] == q
+        assert result["data_points"] == [f"{q}.pdf:about {q}"]
+        # The thoughts only mention the question of their own request, including the observations of the shared tools
+        assert set(re.findall(r"question-\d+", result["thoughts"])) == {q}
+        assert f"{q}.pdf:about {q}" in result["thoughts"]
+
+def test_concurrent_requests_in_threads_dont_share_state(approach):
+    questions = [f"question-{i}" for i in range(40)]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda q: asyncio.run(approach.run(q, {})), questions))
+    for q, result in zip(questions, results):
+        assert result["answer"] == q
+        assert result["data_points"] == [f"{q}.pdf:about {q}"]
+
+def test_agents_are_compiled_once_per_request_shape(approach):
+    async def ask_all():
+        for overrides in ({}, {}, {"temperature": 0.3}, {"temperature": 0.7}, {"temperature": 0.7, "prompt_template_prefix": "Be brief.", "prompt_template": "Be brief."}):
+            assert (await approach.run("question-1", overrides))["answer"] == "question-1"
+
+    asyncio.run(ask_all())
+    assert approach.agent_cache.stats()["misses"] == 3
+    assert approach.agent_cache.stats()["hits"] == 2
+
+def test_thoughts_can_be_left_out(approach):
+    result = asyncio.run(approach.run("question-1", {"include_thoughts": False}))
+    assert result["answer"] == "question-1"
+    assert result["thoughts"] is None
@@ -0,0 +1,108 @@
+import asyncio
+
+from cache import InMemoryCache
+from retrieval import RetrievalService
+from vectorindex import HashEmbedder, VectorIndex, VectorIndexWriter
+
+class FakeResults:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __aiter__(self):
+        async def gen():
+            for doc in self.docs:
+                yield doc
+        return gen()
+
+class FakeSearchClient:
+    def __init__(self):
+        self.calls = []
+
+    async def search(self, q, **kwargs):
+        self.calls.append((q, kwargs))
+        return FakeResults([{"id": "ttb-0", "sourcepage": "ttb-0.pdf", "content": q}])
+
+class FakeGeneration:
+    def __init__(self):
+        self.generation = "1"
+
+    async def get(self):
+        return self.generation
+
+def test_search_results_are_cached_per_query_and_options():
+    search_client = FakeSearchClient()
+    retrieval = RetrievalService(search_client, cache=InMemoryCache("search"))
+
+    async def scenario():
+        first = await retrieval.search("ค่าธรรมเนียม", {"top": 3})
+        second = await retrieval.search("ค่าธรรมเนียม", {"top": 3})
+        await retrieval.search("ค่าธรรมเนียม", {"top": 5})
+        await retrieval.search("ค่าธรรมเนียม", {"top": 3, "exclude_category": "o'clock"})
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == second
+    assert len(search_client.calls) == 3
+    assert search_client.calls[2][1]["filter"] == "category ne 'o''clock'"
+
+def test_new_index_generation_invalidates_results():
+    search_client = FakeSearchClient()
+    generation = FakeGeneration()
+    retrieval = RetrievalService(search_client, cache=InMemoryCache("search"), index_generation=generation)
+
+    async def scenario():
+        await retrieval.search("บัตรเดบิต", {})
+        await retrieval.search("บัตรเดบิต", {})
+        generation.generation = "2"
+        await retrieval.search("บัตรเดบิต", {})
+
+    asyncio.run(scenario())
+    assert len(search_client.calls) == 2
+
+def test_hybrid_search_fuses_keyword_and_vector_results(tmp_path):
+    writer = VectorIndexWriter(str(tmp_path), HashEmbedder())
+    writer.replace_file("ttb.pdf", [
+        {"id": "fee", "content": "ค่าธรรมเนียมบัตรเดบิต ฟรี", "category": None, "sourcepage": "ttb-1.pdf", "sourcefile": "ttb.pdf"},
+        {"id": "insurance", "content": "ประกันอุบัติเหตุ", "category": "insurance", "sourcepage": "ttb-2.pdf", "sourcefile": "ttb.pdf"}])
+    writer.save()
+    search_client = FakeSearchClient()
+    retrieval = RetrievalService(search_client, vector_index=VectorIndex.load(str(tmp_path)), embedder=HashEmbedder())
+
+    docs = asyncio.run(retrieval.search("ค่าธรรมเนียมบัตรเดบิต", {"top": 2}))
+    assert [doc["sourcepage"] for doc in docs] == ["ttb-0.pdf", "ttb-1.pdf"]
+    assert docs[1]["@search.captions"][0].text == "ค่าธรรมเนียมบัตรเดบิต ฟรี"
+    assert search_client.calls[0][1]["top"] == 10
+
+    docs = asyncio.run(retrieval.search("ประกัน", {"retrieval_mode": "vectors", "exclude_category": "insurance"}))
+    assert [doc["id"] for doc in docs] == ["fee"]
+    assert len(search_client.calls) == 1
+
+class ScoredSearchClient:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def search(self, q, **kwargs):
+        return FakeResults([{"id": id, "sourcepage": f"{id}.pdf", "content": id, "@search.score": score} for id, score in self.docs.get(q, [])])
+
+def test_adaptive_hybrid_search_cuts_each_ranking_before_fusion(tmp_path):
+    writer = VectorIndexWriter(str(tmp_path), HashEmbedder())
+    writer.replace_file("ttb.pdf", [
+        {"id": "fee", "content": "ค่าธรรมเนียมบัตรเดบิต ฟรี", "category": None, "sourcepage": "ttb-1.pdf", "sourcefile": "ttb.pdf"},
+        {"id": "insurance", "content": "ประกันอุบัติเหตุ", "category": "insurance", "sourcepage": "ttb-2.pdf", "sourcefile": "ttb.pdf"}])
+    writer.save()
+    # BM25 scores, the vector ranking scores fee about 0.94 and insurance about 0.3 for the first question
+    search_client = ScoredSearchClient({"ค่าธรรมเนียมบัตรเดบิต": [("atm", 8.0), ("branch", 1.0)], "สินเชื่อบ้าน": [("branch", 0.3)]})
+    # A BM25 minimum above 1 would empty any cosine ranking, so the vector ranking has its own
+    retrieval = RetrievalService(search_client, vector_index=VectorIndex.load(str(tmp_path)), embedder=HashEmbedder(),
+                                 adaptive=True, min_score=2.0, min_vector_score=0.5)
+
+    # Fused scores are at most 2 / 61, they'd all be below the minimum
+    docs = asyncio.run(retrieval.search("ค่าธรรมเนียมบัตรเดบิต", {}))
+    assert sorted(doc["id"] for doc in docs) == ["atm", "fee"]
+
+    docs = asyncio.run(retrieval.search("ค่าธรรมเนียมบัตรเดบิต", {"minimum_search_score": 10}))
+    assert [doc["id"] for doc in docs] == ["fee"]
+    docs = asyncio.run(retrieval.search("ค่าธรรมเนียมบัตรเดบิต", {"minimum_vector_score": 0.99}))
+    assert [doc["id"] for doc in docs] == ["atm"]
+
+    assert asyncio.run(retrieval.search("สินเชื่อบ้าน", {})) == []
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+import telemetry
+from conftest import CharEncoding
+from openaipool import OpenAIPool
+
+class RecordingMetrics(telemetry.Metrics):
+    def __init__(self):
+        self.stages = []
+        self.tokens = []
+        self.requests = []
+
+    def observe_stage(self, stage, seconds):
+        self.stages.append(stage)
+
+    def add_tokens(self, deployment, prompt_tokens, completion_tokens):
+        self.tokens.append((deployment, prompt_tokens, completion_tokens))
+
+    def observe_request(self, route, approach, seconds, usage):
+        self.requests.append((route, approach, usage.calls, usage.prompt_tokens, usage.completion_tokens))
+
+class FakeCompletion:
+    async def acreate(self, engine, api_base, **kwargs):
+        return {"choices": [{"text": "ฟรี"}], "usage": {"prompt_tokens": 10, "completion_tokens": 2}}
+
+class FakeStreamingCompletion:
+    async def acreate(self, engine, api_base, stream, **kwargs):
+        async def chunks():
+            for text in ["ค่า", "ธรรมเนียม", "ฟรี"]:
+                yield {"choices": [{"text": text}]}
+            # Content filter results come without choices
+            yield {"choices": []}
+        return chunks()
+
+@pytest.fixture
+def metrics():
+    metrics = RecordingMetrics()
+    telemetry.configure(metrics_=metrics)
+    yield metrics
+    telemetry.configure()
+
+def test_spans_are_free_when_telemetry_is_off():
+    telemetry.configure()
+    assert telemetry.span("search", top=3) is telemetry.NOOP_SPAN
+    with telemetry.request("/ask", "rtr"):
+        assert telemetry.current_usage.get() is None
+
+def test_tokens_are_counted_per_request(metrics):
+    pool = OpenAIPool(["eastus"])
+
+    async def ask(question):
+        with telemetry.request("/chat", "rrr"):
+            with telemetry.span("chat.query_rewrite"):
+                await pool.acreate(FakeCompletion(), engine="davinci", prompt=question, max_tokens=10)
+            await pool.acreate(FakeCompletion(), engine="chat", prompt=question, max_tokens=10)
+
+    async def scenario():
+        # Concurrent requests keep their own counts
+        await asyncio.gather(ask("ค่าธรรมเนียม"), ask("บัตรเดบิต"))
+        await pool.close()
+
+    asyncio.run(scenario())
+    assert metrics.requests == [("/chat", "rrr", 2, 20, 4)] * 2
+    assert sorted(metrics.tokens) == [("chat", 10, 2)] * 2 + [("davinci", 10, 2)] * 2
+    assert metrics.stages.count("openai.completion") == 4
+    assert metrics.stages.count("chat.query_rewrite") == 2
+    assert telemetry.current_usage.get() is None
+
+def test_streamed_completions_are_counted_when_the_stream_is_done(metrics):
+    pool = OpenAIPool(["eastus"], encoding=CharEncoding())
+
+    async def answer():
+        response = await pool.acreate(FakeStreamingCompletion(), engine="chat", prompt="บัตรเดบิต", max_tokens=10, stream=True)
+        async for chunk in response:
+            if chunk["choices"]:
+                yield chunk["choices"][0]["text"]
+
+    async def scenario():
+        stream = telemetry.streamed_request("/chat_stream", "rrr", answer())
+        deltas = [await stream.__anext__()]
+        # The request isn't over until the last chunk is sent
+        assert metrics.requests == []
+        deltas += [delta async for delta in stream]
+        await pool.close()
+        return deltas
+
+    assert asyncio.run(scenario()) == ["ค่า", "ธรรมเนียม", "ฟรี"]
+    assert metrics.tokens == [("chat", 9, 15)]
+    assert metrics.requests == [("/chat_stream", "rrr", 1, 9, 15)]
+    assert pool.stats()["deployments"]["eastus/chat"]["completion_tokens"] == 15
+
+def test_prometheus_metrics_render():
+    pytest.importorskip("prometheus_client")
+    prometheus = telemetry.PrometheusMetrics()
+    prometheus.observe_stage("search", 0.05)
+    prometheus.add_tokens("chat", 100, 10)
+    body, content_type = prometheus.render()
+    assert b'app_openai_tokens_total{deployment="chat",kind="prompt"} 100.0' in body
+    assert content_type.startswith("text/plain")
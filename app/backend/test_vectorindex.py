@@ -0,0 +1,65 @@
+import numpy as np
+
+from conftest import section
+from vectorindex import HashEmbedder, VectorIndex, VectorIndexWriter, reciprocal_rank_fusion
+
+class CountingEmbedder(HashEmbedder):
+    def __init__(self):
+        super().__init__(64)
+        self.embedded = []
+
+    def embed(self, texts):
+        self.embedded.extend(texts)
+        return super().embed(texts)
+
+def test_hash_embedder_is_deterministic_and_matches_thai_text():
+    embedder = HashEmbedder()
+    docs = embedder.embed(["ค่าธรรมเนียมบัตรเดบิต ttb all free ฟรีทุกรายการ", "ประกันอุบัติเหตุ คุ้มครองค่ารักษาพยาบาล"])
+    query = embedder.embed(["ค่าธรรมเนียมบัตรเดบิต"])[0]
+    assert np.allclose(np.linalg.norm(docs, axis=1), 1)
+    assert np.array_equal(query, HashEmbedder().embed(["ค่าธรรมเนียมบัตรเดบิต"])[0])
+    assert docs[0] @ query > docs[1] @ query
+
+def test_writer_only_embeds_changed_sections(tmp_path):
+    embedder = CountingEmbedder()
+    writer = VectorIndexWriter(str(tmp_path), embedder)
+    writer.replace_file("ttb.pdf", [section("a", "บัตรเดบิต"), section("b", "ค่าธรรมเนียม")])
+    writer.save()
+
+    writer = VectorIndexWriter(str(tmp_path), embedder)
+    assert writer.replace_file("ttb.pdf", [section("a", "บัตรเดบิต"), section("c", "โอนเงินฟรี")]) == 1
+    writer.replace_file("other.pdf", [section("d", "ประกัน", "other.pdf")])
+    writer.remove_file("other.pdf")
+    writer.save()
+    assert embedder.embedded == ["บัตรเดบิต", "ค่าธรรมเนียม", "โอนเงินฟรี", "ประกัน"]
+
+    index = VectorIndex.load(str(tmp_path))
+    assert [s["id"] for s in index.sections] == ["a", "c"]
+    assert np.allclose(index.vectors, embedder.embed(["บัตรเดบิต", "โอนเงินฟรี"]))
+
+def test_ivf_search_finds_the_same_sections_as_exact_search(tmp_path):
+    rng = np.random.default_rng(1)
+    words = ["บัตร", "เดบิต", "ค่าธรรมเนียม", "ฟรี", "ประกัน", "อุบัติเหตุ", "โอน", "เงิน", "ดอกเบี้ย", "เงินฝาก", "สินเชื่อ", "ATM"]
+    sections = [section(str(i), " ".join(rng.choice(words, 6)), category="tc" if i % 2 else None) for i in range(400)]
+    writer = VectorIndexWriter(str(tmp_path), HashEmbedder(), min_rows_for_ivf=100)
+    writer.replace_file("ttb.pdf", sections)
+    writer.save()
+
+    index = VectorIndex.load(str(tmp_path))
+    assert isinstance(index.vectors, np.memmap)
+    assert len(index.centroids) == 20
+    for s in sections[:20]:
+        query = writer.vectors[s["id"]]
+        # A section is stored in the cluster of its closest centroid, so probing a single cluster finds it
+        assert index.search(query, 1, nprobe=1)[0][0] > 0.999
+        exact = index.search(query, 5, nprobe=None)
+        assert index.search(query, 5, nprobe=len(index.centroids))[0] == exact[0]
+        assert all(s["category"] != "tc" for _, s in index.search(query, 5, exclude_category="tc"))
+
+def test_reciprocal_rank_fusion():
+    text = [{"id": "a"}, {"id": "b"}, {"id": "c"}]
+    vectors = [{"id": "c"}, {"id": "d"}, {"id": "a"}]
+    fused = reciprocal_rank_fusion([text, vectors], top=3)
+    # b and d tie, the first list wins ties
+    assert [d["id"] for d in fused] == ["a", "c", "b"]
+    assert fused[0]["@search.rrf_score"] == 1 / 61 + 1 / 63
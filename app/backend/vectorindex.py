@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from typing import Any, Optional, Sequence
+
+import numpy as np
+
+from indexfiles import write_index_files
+
+# Version of the on-disk layout written by VectorIndexWriter
+VECTOR_INDEX_FORMAT = 1
+
+class HashEmbedder:
+    """
+    Deterministic embedder that hashes the character 1 to 3-grams of the text into a fixed number of dimensions. Needs
+    no model or network access, so it's used for tests and offline runs. Character n-grams also work for Thai text,
+    which has no spaces between words.
+    """
+    name = "hash"
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def config(self) -> dict[str, Any]:
+        return {"name": self.name, "dim": self.dim}
+
+    def embed_one(self, text: str) -> np.ndarray:
+        text = " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for n in (1, 2, 3):
+            for i in range(len(text) - n + 1):
+                digest = hashlib.blake2b(text[i:i + n].encode("utf-8"), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        return vector
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        return normalize(np.stack([self.embed_one(t) for t in texts])) if texts else np.zeros((0, self.dim), dtype=np.float32)
+
+    async def aembed(self, texts: Sequence[str]) -> np.ndarray:
+        return self.embed(texts)
+
+class OpenAIEmbedder:
+    """Embeds text with an Azure OpenAI embedding deployment, e.g. text-embedding-ada-002 (1536 dimensions)."""
+    name = "openai"
+
+    def __init__(self, deployment: str, dim: int = 1536, batch_size: int = 16):
+        self.deployment = deployment
+        self.dim = dim
+        self.batch_size = batch_size
+
+    def config(self) -> dict[str, Any]:
+        return {"name": self.name, "dim": self.dim, "deployment": self.deployment}
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        import openai
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            r = openai.Embedding.create(engine=self.deployment, input=list(texts[i:i + self.batch_size]))
+            vectors.extend(d["embedding"] for d in sorted(r["data"], key=lambda d: d["index"]))
+        return normalize(np.array(vectors, dtype=np.float32).reshape(-1, self.dim))
+
+    async def aembed(self, texts: Sequence[str]) -> np.ndarray:
+        import openai
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            r = await openai.Embedding.acreate(engine=self.deployment, input=list(texts[i:i + self.batch_size]))
+            vectors.extend(d["embedding"] for d in sorted(r["data"], key=lambda d: d["index"]))
+        return normalize(np.array(vectors, dtype=np.float32).reshape(-1, self.dim))
+
+def create_embedder(config: dict[str, Any], openai_deployment: Optional[str] = None):
+    """Creates the embedder described by config, as recorded in the index, so queries are embedded like the sections."""
+    if config["name"] == HashEmbedder.name:
+        return HashEmbedder(config["dim"])
+    if config["name"] == OpenAIEmbedder.name:
+        return OpenAIEmbedder(openai_deployment or config["deployment"], config["dim"])
+    raise ValueError(f"Unknown embedder '{config['name']}'")
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = 10, sample_size: int = 50000, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on a sample of the (normalized) vectors, returns the normalized centroids."""
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        empty = ~sums.any(axis=1)
+        # Restart empty clusters from random points so every list gets used
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+class VectorIndexWriter:
+    """
+    Builds the local vector index in a directory: one normalized float32 vector per section in vectors.f32 (read
+    back as a memory-mapped matrix), the sections in the same order in sections.jsonl, and meta.json. For larger
+    indexes the rows are grouped by k-means cluster (an IVF layout): centroids.npy holds the cluster centroids and
+    lists.npy the offset of each cluster's rows, so a query only scans the rows of the clusters closest to it.
+    The vectors of an index already in the directory are kept when the same embedder made them, so re-ingesting a
+    file only embeds its new or changed sections. Embedding happens outside of the lock, so the pipeline's index
+    workers can embed several files at a time.
+    """
+
+    def __init__(self, directory: str, embedder, min_rows_for_ivf: int = 2000):
+        self.directory = directory
+        self.embedder = embedder
+        self.min_rows_for_ivf = min_rows_for_ivf
+        self.sections: dict[str, dict[str, Any]] = {}
+        self.vectors: dict[str, np.ndarray] = {}
+        self.lock = threading.Lock()
+        meta_path = os.path.join(directory, "meta.json")
+        if os.path.exists(meta_path):
+            index = VectorIndex.load(directory)
+            if index.embedder_config == embedder.config():
+                for row, section in enumerate(index.sections):
+                    self.sections[section["id"]] = section
+                    self.vectors[section["id"]] = np.array(index.vectors[row])
+
+    def replace_file(self, sourcefile: str, sections: Sequence[dict[str, Any]]):
+        """
+        Replaces the sections of a file. Only sections whose content is new or changed are embedded, the vectors of
+        the others are kept from the existing index.
+        """
+        sections = [{k: s[k] for k in ("id", "content", "category", "sourcepage", "sourcefile")} for s in sections]
+        with self.lock:
+            changed = [s for s in sections if self.sections.get(s["id"], {}).get("content") != s["content"]]
+        # Embed outside of the lock, so several files can be embedded at the same time
+        vectors = self.embedder.embed([s["content"] for s in changed]) if changed else []
+        with self.lock:
+            ids = set(s["id"] for s in sections)
+            for id in [id for id, s in self.sections.items() if s["sourcefile"] == sourcefile and id not in ids]:
+                del self.sections[id]
+                del self.vectors[id]
+            for section in sections:
+                self.sections[section["id"]] = section
+            for section, vector in zip(changed, vectors):
+                self.vectors[section["id"]] = vector
+        return len(changed)
+
+    def remove_file(self, sourcefile: str) -> int:
+        """Removes the sections of a file, returns how many there were."""
+        with self.lock:
+            removed = [id for id, s in self.sections.items() if s["sourcefile"] == sourcefile]
+            for id in removed:
+                del self.sections[id]
+                del self.vectors[id]
+            return len(removed)
+
+    def clear(self) -> int:
+        with self.lock:
+            removed = len(self.sections)
+            self.sections = {}
+            self.vectors = {}
+            return removed
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        ids = sorted(self.sections)
+        vectors = np.stack([self.vectors[id] for id in ids]).astype(np.float32) if ids else np.zeros((0, self.embedder.dim), dtype=np.float32)
+        nlist = int(np.sqrt(len(ids))) if len(ids) >= self.min_rows_for_ivf else 0
+        if nlist:
+            centroids = kmeans(vectors, nlist)
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            order = np.argsort(assignments, kind="stable")
+            ids = [ids[i] for i in order]
+            vectors = vectors[order]
+            lists = np.searchsorted(assignments[order], np.arange(nlist + 1)).astype(np.int64)
+
+        files = [("vectors.f32", lambda f: f.write(vectors.tobytes())),
+                 ("sections.jsonl", lambda f: f.writelines((json.dumps(self.sections[id], ensure_ascii=False) + "\n").encode("utf-8") for id in ids))]
+        if nlist:
+            files += [("centroids.npy", lambda f: np.save(f, centroids)), ("lists.npy", lambda f: np.save(f, lists))]
+        meta = {"format": VECTOR_INDEX_FORMAT, "count": len(ids), "dim": int(vectors.shape[1]), "nlist": nlist, "embedder": self.embedder.config()}
+        files.append(("meta.json", lambda f: f.write(json.dumps(meta).encode("utf-8"))))
+        write_index_files(self.directory, files)
+
+class VectorIndex:
+    """
+    Read side of the local vector index. Vectors are memory-mapped, so loading is instant and the OS page cache
+    decides what stays in memory. search() does an exact scan of all rows, or of the nprobe closest clusters when the
+    index has an IVF layout.
+    """
+
+    def __init__(self, vectors: np.ndarray, sections: list[dict[str, Any]], embedder_config: dict[str, Any], centroids: Optional[np.ndarray] = None, lists: Optional[np.ndarray] = None):
+        self.vectors = vectors
+        self.sections = sections
+        self.embedder_config = embedder_config
+        self.centroids = centroids
+        self.lists = lists
+        self.categories = np.array([s.get("category") or "" for s in sections], dtype=object)
+
+    @classmethod
+    def load(cls, directory: str) -> "VectorIndex":
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["format"] != VECTOR_INDEX_FORMAT:
+            raise ValueError(f"Unsupported vector index format {meta['format']}, rebuild the index with prepdocs.py")
+        if meta["count"]:
+            vectors = np.memmap(os.path.join(directory, "vectors.f32"), dtype=np.float32, mode="r", shape=(meta["count"], meta["dim"]))
+        else:
+            vectors = np.zeros((0, meta["dim"]), dtype=np.float32)
+        with open(os.path.join(directory, "sections.jsonl"), encoding="utf-8") as f:
+            sections = [json.loads(line) for line in f]
+        centroids = lists = None
+        if meta["nlist"]:
+            centroids = np.load(os.path.join(directory, "centroids.npy"))
+            lists = np.load(os.path.join(directory, "lists.npy"))
+        return cls(vectors, sections, meta["embedder"], centroids, lists)
+
+    def __len__(self) -> int:
+        return len(self.sections)
+
+    def search(self, query_vector: np.ndarray, top: int, exclude_category: Optional[str] = None, nprobe: Optional[int] = 16) -> list[tuple[float, dict[str, Any]]]:
+        """Returns the top (score, section) pairs by cosine similarity. nprobe=None forces an exact search."""
+        if self.centroids is not None and nprobe is not None and nprobe < len(self.centroids):
+            closest = np.argpartition(-(self.centroids @ query_vector), nprobe - 1)[:nprobe]
+            rows = np.concatenate([np.arange(self.lists[c], self.lists[c + 1]) for c in closest])
+            scores = self.vectors[rows] @ query_vector
+        else:
+            # Scan the matrix in place rather than gathering a copy of every row
+            rows = np.arange(len(self.sections))
+            scores = self.vectors @ query_vector
+        if exclude_category:
+            keep = self.categories[rows] != exclude_category
+            rows, scores = rows[keep], scores[keep]
+        if len(rows) == 0:
+            return []
+        k = min(top, len(rows))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(float(scores[i]), self.sections[rows[i]]) for i in best]
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[dict[str, Any]]], top: int, k: int = 60) -> list[dict[str, Any]]:
+    """Fuses ranked lists of documents by summing 1 / (k + rank) over the lists each document appears in."""
+    scores: dict[str, float] = {}
+    docs: dict[str, dict[str, Any]] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            scores[doc["id"]] = scores.get(doc["id"], 0.0) + 1.0 / (k + rank + 1)
+            docs.setdefault(doc["id"], doc)
+    best = sorted(scores, key=lambda id: -scores[id])[:top]
+    return [{**docs[id], "@search.rrf_score": scores[id]} for id in best]
@@ -1,4 +1,4 @@
-import { AskRequest, AskResponse, ChatRequest } from "./models";
+import { AskRequest, AskResponse, ChatRequest, ChatStreamEvent } from "./models";
 
 export async function askApi(options: AskRequest): Promise<AskResponse> {
     const response = await fetch("/ask", {
@@ -17,7 +17,15 @@ export async function askApi(options: AskRequest): Promise<AskResponse> {
                 prompt_template: options.overrides?.promptTemplate,
                 prompt_template_prefix: options.overrides?.promptTemplatePrefix,
                 prompt_template_suffix: options.overrides?.promptTemplateSuffix,
-                exclude_category: options.overrides?.excludeCategory
+                exclude_category: options.overrides?.excludeCategory,
+                retrieval_mode: options.overrides?.retrievalMode,
+                two_phase_search: options.overrides?.twoPhaseSearch,
+                adaptive_retrieval: options.overrides?.adaptiveRetrieval,
+                minimum_search_score: options.overrides?.minimumSearchScore,
+                minimum_vector_score: options.overrides?.minimumVectorScore,
+                parallel_actions: options.overrides?.parallelActions,
+                prefetch_lookups: options.overrides?.prefetchLookups,
+                include_thoughts: options.overrides?.includeThoughts
             }
         })
     });
@@ -48,7 +56,13 @@ export async function chatApi(options: ChatRequest): Promise<AskResponse> {
                 prompt_template_prefix: options.overrides?.promptTemplatePrefix,
                 prompt_template_suffix: options.overrides?.promptTemplateSuffix,
                 exclude_category: options.overrides?.excludeCategory,
-                suggest_followup_questions: options.overrides?.suggestFollowupQuestions
+                retrieval_mode: options.overrides?.retrievalMode,
+                two_phase_search: options.overrides?.twoPhaseSearch,
+                adaptive_retrieval: options.overrides?.adaptiveRetrieval,
+                minimum_search_score: options.overrides?.minimumSearchScore,
+                minimum_vector_score: options.overrides?.minimumVectorScore,
+                suggest_followup_questions: options.overrides?.suggestFollowupQuestions,
+                include_thoughts: options.overrides?.includeThoughts
             }
         })
     });
@@ -61,6 +75,66 @@ export async function chatApi(options: ChatRequest): Promise<AskResponse> {
     return parsedResponse;
 }
 
+export async function* chatStreamApi(options: ChatRequest): AsyncGenerator<ChatStreamEvent> {
+    const response = await fetch("/chat_stream", {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json"
+        },
+        body: JSON.stringify({
+            history: options.history,
+            approach: options.approach,
+            overrides: {
+                semantic_ranker: options.overrides?.semanticRanker,
+                semantic_captions: options.overrides?.semanticCaptions,
+                top: options.overrides?.top,
+                temperature: options.overrides?.temperature,
+                prompt_template: options.overrides?.promptTemplate,
+                prompt_template_prefix: options.overrides?.promptTemplatePrefix,
+                prompt_template_suffix: options.overrides?.promptTemplateSuffix,
+                exclude_category: options.overrides?.excludeCategory,
+                retrieval_mode: options.overrides?.retrievalMode,
+                two_phase_search: options.overrides?.twoPhaseSearch,
+                adaptive_retrieval: options.overrides?.adaptiveRetrieval,
+                minimum_search_score: options.overrides?.minimumSearchScore,
+                minimum_vector_score: options.overrides?.minimumVectorScore,
+                suggest_followup_questions: options.overrides?.suggestFollowupQuestions,
+                include_thoughts: options.overrides?.includeThoughts
+            }
+        })
+    });
+
+    if (response.status > 299 || !response.ok || !response.body) {
+        const parsedResponse: AskResponse = await response.json();
+        throw Error(parsedResponse.error || "Unknown error");
+    }
+
+    // The response is newline-delimited JSON: the first event carries data_points and thoughts,
+    // every following event carries the next piece of the answer in "delta"
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+        const { done, value } = await reader.read();
+        buffer += decoder.decode(value, { stream: !done });
+        const lines = buffer.split("\n");
+        buffer = done ? "" : lines.pop() || "";
+        for (const line of lines) {
+            if (!line.trim()) {
+                continue;
+            }
+            const event: ChatStreamEvent = JSON.parse(line);
+            if (event.error) {
+                throw Error(event.error);
+            }
+            yield event;
+        }
+        if (done) {
+            break;
+        }
+    }
+}
+
 export function getCitationFilePath(citation: string): string {
     return `/content/${citation}`;
 }
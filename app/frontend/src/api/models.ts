@@ -4,16 +4,30 @@ export const enum Approaches {
     ReadDecomposeAsk = "rda"
 }
 
+export const enum RetrievalMode {
+    Text = "text",
+    Vectors = "vectors",
+    Hybrid = "hybrid"
+}
+
 export type AskRequestOverrides = {
     semanticRanker?: boolean;
     semanticCaptions?: boolean;
     excludeCategory?: string;
+    retrievalMode?: RetrievalMode;
+    twoPhaseSearch?: boolean;
+    adaptiveRetrieval?: boolean;
+    minimumSearchScore?: number;
+    minimumVectorScore?: number;
+    parallelActions?: boolean;
+    prefetchLookups?: boolean;
     top?: number;
     temperature?: number;
     promptTemplate?: string;
     promptTemplatePrefix?: string;
     promptTemplateSuffix?: string;
     suggestFollowupQuestions?: boolean;
+    includeThoughts?: boolean;
 };
 
 export type AskRequest = {
@@ -22,13 +36,35 @@ export type AskRequest = {
     overrides?: AskRequestOverrides;
 };
 
+export type TokenUsage = {
+    prompt_tokens: number;
+    max_prompt_tokens: number;
+    template_tokens: number;
+    history_tokens: number;
+    history_turns: number;
+    sources_tokens: number;
+    sources_used: number;
+    sources_truncated: number;
+    sources_dropped: number;
+    completion_tokens?: number;
+    total_tokens?: number;
+};
+
 export type AskResponse = {
     answer: string;
     thoughts: string | null;
     data_points: string[];
+    token_usage?: TokenUsage;
     error?: string;
 };
 
+export type ChatStreamDelta = {
+    delta?: string;
+    error?: string;
+};
+
+export type ChatStreamEvent = Partial<AskResponse> & ChatStreamDelta;
+
 export type ChatTurn = {
     user: string;
     bot?: string;
@@ -0,0 +1,77 @@
+"""
+Measures the per-request cost of the agent approaches (rrr and rda on /ask) with and without the cache of compiled
+prompts and agents, using completions that answer immediately so only the setup and agent overhead is left. With
+--profile, prints the functions that take the most time when agents are compiled for every request. No Azure
+resources are needed.
+
+Usage: python benchmarks/bench_agent_setup.py [--requests 300] [--profile]
+"""
+import argparse
+import asyncio
+import cProfile
+import os
+import pstats
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from langchain.llms.base import LLM
+
+from approaches import readdecomposeask, readretrieveread
+from approaches.readdecomposeask import ReadDecomposeAsk
+from approaches.readretrieveread import ReadRetrieveReadApproach
+from cache import InMemoryCache
+
+class AnsweringLLM(LLM):
+    answer: str
+
+    @property
+    def _llm_type(self) -> str:
+        return "answering"
+
+    def _call(self, prompt, stop=None, run_manager=None):
+        return self.answer
+
+    async def _acall(self, prompt, stop=None, run_manager=None):
+        return self.answer
+
+def approaches(agent_cache_entries: int) -> dict:
+    # max_entries=0 evicts every agent as soon as it's stored, so each request compiles its own like before
+    readretrieveread.AzureOpenAI = lambda **kwargs: AnsweringLLM(answer=" I know.\nFinal Answer: ฟรี")
+    readdecomposeask.AzureOpenAI = lambda **kwargs: AnsweringLLM(answer=" I know.\nAction: Finish[ฟรี]")
+    return {
+        "rrr": ReadRetrieveReadApproach(None, "chat", "sourcepage", "content", agent_cache=InMemoryCache("agents", agent_cache_entries, float("inf"))),
+        "rda": ReadDecomposeAsk(None, "chat", "sourcepage", "content", agent_cache=InMemoryCache("agents", agent_cache_entries, float("inf"))),
+    }
+
+async def ask_all(impl, requests: int) -> float:
+    start = time.perf_counter()
+    for i in range(requests):
+        await impl.run(f"ค่าธรรมเนียมบัตรเดบิต {i}", {"temperature": 0.3})
+    return (time.perf_counter() - start) / requests * 1000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--profile", action="store_true", help="Profile the requests without the cache")
+    args = parser.parse_args()
+
+    # EmployeeInfoTool reads its CSV relative to the backend directory, like when the app runs
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+    # The agents log every step to stdout, which would dominate the measurement
+    sys.stdout = open(os.devnull, "w")
+    uncached, cached = approaches(0), approaches(64)
+    # Best of a few alternating rounds, so warming up doesn't favor either side
+    results = {}
+    for name in uncached:
+        rounds = [(asyncio.run(ask_all(uncached[name], args.requests)), asyncio.run(ask_all(cached[name], args.requests))) for _ in range(3)]
+        results[name] = (min(r[0] for r in rounds), min(r[1] for r in rounds))
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(asyncio.run, ask_all(uncached["rda"], args.requests))
+    sys.stdout = sys.__stdout__
+
+    for name, (uncached_ms, cached_ms) in results.items():
+        print(f"{name}: {uncached_ms:.2f} ms/request compiling the agent, {cached_ms:.2f} ms/request cached ({uncached_ms / cached_ms:.1f}x)")
+    if args.profile:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
@@ -0,0 +1,62 @@
+"""
+Compares answering a list of questions by looping over /ask (one question at a time, which is what the evaluation
+jobs used to do) with a single /ask_batch request, using the local stub server of bench_async_backend.py that
+emulates the latency of Azure Cognitive Search and Azure OpenAI. No Azure resources are needed.
+
+Usage: python benchmarks/bench_ask_batch.py [--questions 64] [--concurrency 8]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import openai
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from approaches.retrievethenread import RetrieveThenReadApproach
+from bench_async_backend import DEPLOYMENT, INDEX, free_port, start_stub_server
+from retrieval import RetrievalService
+
+async def bench(endpoint: str, questions: list[str], concurrency: int) -> tuple[float, float]:
+    search_client = SearchClient(endpoint=endpoint, index_name=INDEX, credential=AzureKeyCredential("stub"))
+    impl = RetrieveThenReadApproach(RetrievalService(search_client), DEPLOYMENT, "sourcepage", "content")
+
+    start = time.perf_counter()
+    for q in questions:
+        await impl.run(q, {})
+    loop_qps = len(questions) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    answers = [r async for r in impl.run_batch(questions, {}, max_concurrency=concurrency)]
+    batch_qps = len(questions) / (time.perf_counter() - start)
+    assert len(answers) == len(questions) and not any("error" in a for a in answers)
+
+    await search_client.close()
+    return loop_qps, batch_qps
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark looping over /ask against /ask_batch with a local stub server.")
+    parser.add_argument("--questions", type=int, default=64, help="Number of questions to answer in each mode")
+    parser.add_argument("--concurrency", type=int, default=8, help="Groups of questions in flight for the batch mode")
+    parser.add_argument("--search-latency", type=float, default=0.1, help="Simulated search latency in seconds")
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="Simulated completion latency in seconds")
+    parser.add_argument("--openai-latency-per-prompt", type=float, default=0.05, help="Simulated extra latency for each additional prompt in a call")
+    args = parser.parse_args()
+
+    port = free_port()
+    start_stub_server(port, args.search_latency, args.openai_latency, args.openai_latency_per_prompt)
+    endpoint = f"http://127.0.0.1:{port}"
+
+    openai.api_type = "azure"
+    openai.api_base = endpoint
+    openai.api_version = "2023-05-15"
+    openai.api_key = "stub"
+
+    questions = [f"question {i}" for i in range(args.questions)]
+    loop_qps, batch_qps = asyncio.run(bench(endpoint, questions, args.concurrency))
+    print(f"loop over /ask: {loop_qps:8.1f} questions/s")
+    print(f"/ask_batch:     {batch_qps:8.1f} questions/s")
+    print(f"speedup: {batch_qps / loop_qps:.1f}x")
@@ -0,0 +1,114 @@
+"""
+Compares requests-per-second of the synchronous request path (one blocking call per worker thread, which is how the
+Flask backend used to serve /ask) against the asyncio approaches, using a local stub server that emulates the latency
+of Azure Cognitive Search and Azure OpenAI. No Azure resources are needed.
+
+Usage: python benchmarks/bench_async_backend.py [--requests 400] [--workers 8] [--concurrency 200]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+from aiohttp import web
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from approaches.retrievethenread import RetrieveThenReadApproach
+from retrieval import RetrievalService
+from text import nonewlines
+
+INDEX = "gptkbindex"
+DEPLOYMENT = "chat"
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_stub_server(port: int, search_latency: float, openai_latency: float, openai_latency_per_prompt: float = 0.0):
+    async def search(request: web.Request) -> web.Response:
+        await asyncio.sleep(search_latency)
+        docs = [{"@search.score": 1.0 / (i + 1), "id": f"doc-{i}", "sourcepage": f"factsheet-{i}.pdf", "content": "ttb all free " * 40} for i in range(3)]
+        return web.json_response({"value": docs})
+
+    async def completions(request: web.Request) -> web.Response:
+        # Multi-prompt calls get one choice per prompt, and take a little longer than single prompt ones
+        prompt = (await request.json())["prompt"]
+        prompts = len(prompt) if isinstance(prompt, list) else 1
+        await asyncio.sleep(openai_latency + openai_latency_per_prompt * (prompts - 1))
+        return web.json_response({
+            "id": "cmpl-stub", "object": "text_completion", "created": int(time.time()), "model": DEPLOYMENT,
+            "choices": [{"text": "stub answer [factsheet-0.pdf]", "index": i, "finish_reason": "stop", "logprobs": None} for i in range(prompts)],
+            "usage": {"prompt_tokens": 100 * prompts, "completion_tokens": 10 * prompts, "total_tokens": 110 * prompts}})
+
+    app = web.Application()
+    app.router.add_post("/indexes('{index}')/docs/search.post.search", search)
+    app.router.add_post("/openai/deployments/{deployment}/completions", completions)
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port, backlog=1024).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+def sync_ask(search_client: SearchClient, q: str) -> str:
+    # Mirrors the blocking code path of the former Flask backend
+    r = search_client.search(q, top=3)
+    results = [doc["sourcepage"] + ": " + nonewlines(doc["content"]) for doc in r]
+    prompt = RetrieveThenReadApproach.template.format(q=q, retrieved="\n".join(results))
+    completion = openai.Completion.create(engine=DEPLOYMENT, prompt=prompt, temperature=0.3, max_tokens=1024, n=1, stop=["\n"])
+    return completion.choices[0].text
+
+def bench_sync(endpoint: str, requests: int, workers: int) -> float:
+    search_client = SearchClient(endpoint=endpoint, index_name=INDEX, credential=AzureKeyCredential("stub"))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda i: sync_ask(search_client, f"question {i}"), range(requests)))
+    return requests / (time.perf_counter() - start)
+
+async def bench_async(endpoint: str, requests: int, concurrency: int) -> float:
+    search_client = AsyncSearchClient(endpoint=endpoint, index_name=INDEX, credential=AzureKeyCredential("stub"))
+    impl = RetrieveThenReadApproach(RetrievalService(search_client), DEPLOYMENT, "sourcepage", "content")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            return await impl.run(f"question {i}", {})
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    elapsed = time.perf_counter() - start
+    await search_client.close()
+    return requests / elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the sync vs. async /ask request path against a local stub server.")
+    parser.add_argument("--requests", type=int, default=400, help="Number of questions to answer in each mode")
+    parser.add_argument("--workers", type=int, default=8, help="Worker threads for the synchronous baseline")
+    parser.add_argument("--concurrency", type=int, default=200, help="Maximum in-flight requests for the async mode")
+    parser.add_argument("--search-latency", type=float, default=0.2, help="Simulated search latency in seconds")
+    parser.add_argument("--openai-latency", type=float, default=1.0, help="Simulated completion latency in seconds")
+    args = parser.parse_args()
+
+    port = free_port()
+    start_stub_server(port, args.search_latency, args.openai_latency)
+    endpoint = f"http://127.0.0.1:{port}"
+
+    openai.api_type = "azure"
+    openai.api_base = endpoint
+    openai.api_version = "2023-05-15"
+    openai.api_key = "stub"
+
+    sync_rps = bench_sync(endpoint, args.requests, args.workers)
+    print(f"sync  ({args.workers} worker threads): {sync_rps:8.1f} req/s")
+    async_rps = asyncio.run(bench_async(endpoint, args.requests, args.concurrency))
+    print(f"async ({args.concurrency} in flight):     {async_rps:8.1f} req/s")
+    print(f"speedup: {async_rps / sync_rps:.1f}x")
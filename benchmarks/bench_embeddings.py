@@ -0,0 +1,93 @@
+"""
+Compares embedding the sections of a document one request per section against the batched, concurrent embedding
+stage of prepdocs.py, and re-embedding the same sections with the embedding cache, using a local stub server that
+emulates the latency and rate limiting of an Azure OpenAI embedding deployment. No Azure resources are needed.
+
+Usage: python benchmarks/bench_embeddings.py [--sections 400] [--latency 0.05] [--max-in-flight 8]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import openai
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+import prepdocs
+from bench_async_backend import free_port
+from vectorindex import OpenAIEmbedder
+
+DEPLOYMENT = "embedding"
+DIM = 1536
+
+def start_stub_server(port: int, latency: float, latency_per_input: float, max_in_flight: int) -> dict:
+    stats = {"requests": 0, "throttled": 0, "in_flight": 0}
+
+    async def embeddings(request: web.Request) -> web.Response:
+        # Like a deployment over its rate limit, reject requests beyond max_in_flight and ask for a retry later
+        if stats["in_flight"] >= max_in_flight:
+            stats["throttled"] += 1
+            return web.json_response({"error": {"code": "429", "message": "Rate limit is exceeded."}}, status=429, headers={"Retry-After": "1"})
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        try:
+            inputs = (await request.json())["input"]
+            inputs = inputs if isinstance(inputs, list) else [inputs]
+            await asyncio.sleep(latency + latency_per_input * len(inputs))
+            data = [{"object": "embedding", "index": i, "embedding": [float(len(text) % 7 + 1)] + [0.0] * (DIM - 1)} for i, text in enumerate(inputs)]
+            return web.json_response({"object": "list", "data": data, "model": "ada", "usage": {"prompt_tokens": 100 * len(inputs), "total_tokens": 100 * len(inputs)}})
+        finally:
+            stats["in_flight"] -= 1
+
+    app = web.Application()
+    app.router.add_post("/openai/deployments/{deployment}/embeddings", embeddings)
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return stats
+
+def timed(stats: dict, embed, texts: list[str]) -> tuple[float, int]:
+    requests = stats["requests"]
+    start = time.perf_counter()
+    vectors = embed(texts)
+    assert len(vectors) == len(texts)
+    return time.perf_counter() - start, stats["requests"] - requests
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sections", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated latency of an embedding request in seconds")
+    parser.add_argument("--latency-per-input", type=float, default=0.002, help="Simulated latency per embedded section in seconds")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="Concurrent requests the stub accepts before throttling")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    port = free_port()
+    stats = start_stub_server(port, args.latency, args.latency_per_input, args.max_in_flight)
+    openai.api_type = "azure"
+    openai.api_base = f"http://127.0.0.1:{port}"
+    openai.api_version = "2023-05-15"
+    openai.api_key = "stub"
+    prepdocs.args = argparse.Namespace(verbose=False)
+
+    texts = [f"ส่วนที่ {i} ค่าธรรมเนียมบัตรเดบิต ttb all free " * 12 for i in range(args.sections)]
+
+    per_section = OpenAIEmbedder(DEPLOYMENT, batch_size=1)
+    elapsed, requests = timed(stats, lambda texts: [per_section.embed([text])[0] for text in texts], texts)
+    print(f"one request per section:  {elapsed:6.2f}s, {requests} requests")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for run in ("batched", "cached"):
+            batch_embedder = prepdocs.BatchEmbedder(OpenAIEmbedder(DEPLOYMENT), cache=prepdocs.EmbeddingCache(os.path.join(directory, "embeddings.sqlite")),
+                                                    max_concurrency=args.concurrency, backoff_seconds=0.1)
+            batch_elapsed, requests = timed(stats, batch_embedder.embed, texts)
+            print(f"{run:8} (16 per request): {batch_elapsed:6.2f}s, {requests} requests, {batch_embedder.retries} retried, {elapsed / batch_elapsed:.1f}x")
+            batch_embedder.close()
@@ -0,0 +1,91 @@
+"""
+Builds a local BM25 search index (prepdocs.py --localsearchindex) from synthetic Thai sections, measures its size
+and query latency, then answers questions through the full /ask approach with the local index and the OpenAI stub
+of bench_async_backend.py. No Azure resources are needed.
+
+Usage: python benchmarks/bench_local_search.py [--sections 20000] [--queries 500] [--requests 200]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+import openai
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from approaches.retrievethenread import RetrieveThenReadApproach
+from bench_async_backend import DEPLOYMENT, free_port, start_stub_server
+from localsearch import LocalSearchClient, LocalSearchIndex, LocalSearchIndexWriter
+from retrieval import RetrievalService
+
+WORDS = ["ค่าธรรมเนียม", "บัตรเดบิต", "บัตรเครดิต", "ฟรี", "รายปี", "ประกัน", "อุบัติเหตุ", "คุ้มครอง", "โอนเงิน", "ต่างธนาคาร",
+         "ดอกเบี้ย", "เงินฝาก", "สินเชื่อ", "บ้าน", "รถยนต์", "ผ่อน", "ชำระ", "ตู้", "กดเงินสด", "ttb", "all", "free", "ATM", "2,000", "บาท"]
+
+def synthetic_sections(count: int, rng: random.Random) -> list[dict]:
+    return [{"id": f"section-{i}", "content": " ".join(rng.choices(WORDS, k=60)), "category": None,
+             "sourcepage": f"doc-{i // 20}-{i % 20}.pdf", "sourcefile": f"doc-{i // 20}.pdf"} for i in range(count)]
+
+def directory_size(directory: str, names: list[str]) -> int:
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+
+async def bench_ask(client: LocalSearchClient, questions: list[str], concurrency: int) -> float:
+    impl = RetrieveThenReadApproach(RetrievalService(client), DEPLOYMENT, "sourcepage", "content")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(q: str):
+        async with semaphore:
+            return await impl.run(q, {"top": 3})
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(q) for q in questions])
+    return len(questions) / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sections", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--openai-latency", type=float, default=0.2, help="Simulated completion latency in seconds")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    questions = [" ".join(rng.choices(WORDS, k=4)) for _ in range(args.queries)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        writer = LocalSearchIndexWriter(directory)
+        sections = synthetic_sections(args.sections, rng)
+        for i in range(0, len(sections), 20):
+            writer.replace_file(sections[i]["sourcefile"], sections[i:i + 20])
+        writer.save()
+        print(f"Indexed {args.sections} sections in {time.perf_counter() - start:.1f}s, "
+              f"postings {directory_size(directory, ['terms.json', 'offsets.npy', 'doc_ids.npy', 'tfs.npy', 'doc_lengths.npy']) / 1e6:.1f} MB, "
+              f"sections {directory_size(directory, ['sections.jsonl']) / 1e6:.1f} MB")
+
+        start = time.perf_counter()
+        client = LocalSearchClient(LocalSearchIndex.load(directory))
+        print(f"Loaded index in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        async def search_all():
+            latencies = []
+            for q in questions:
+                start = time.perf_counter()
+                r = await client.search(q, filter="category ne 'internal'", top=3)
+                [doc async for doc in r]
+                latencies.append(time.perf_counter() - start)
+            return sorted(latencies)
+        latencies = asyncio.run(search_all())
+        print(f"search: p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, p95 {latencies[int(len(latencies) * 0.95)] * 1000:.2f} ms")
+
+        port = free_port()
+        start_stub_server(port, 0, args.openai_latency)
+        openai.api_type = "azure"
+        openai.api_base = f"http://127.0.0.1:{port}"
+        openai.api_version = "2023-05-15"
+        openai.api_key = "stub"
+        rps = asyncio.run(bench_ask(client, questions[:args.requests], args.concurrency))
+        print(f"/ask (rtr) on the local index with stub completions: {rps:.1f} req/s")
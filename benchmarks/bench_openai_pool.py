@@ -0,0 +1,104 @@
+"""
+Sends a burst of completion requests to local stub servers that emulate Azure OpenAI deployments with a limit on
+concurrent requests (beyond which they answer 429 with a Retry-After), comparing direct SDK calls to one deployment,
+the OpenAI pool with the same deployment, and the pool spreading requests over deployments in two regions. Reports
+failed requests, latency and the HTTP connections each setup opened. No Azure resources are needed.
+
+Usage: python benchmarks/bench_openai_pool.py [--requests 400] [--concurrency 64] [--max-in-flight 16]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import openai
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from bench_async_backend import DEPLOYMENT, free_port
+from openaipool import OpenAIPool
+
+def start_region(port: int, latency: float, max_in_flight: int, retry_after: float) -> dict:
+    stats = {"in_flight": 0, "throttled": 0, "connections": set()}
+
+    async def completions(request: web.Request) -> web.Response:
+        # A client port per TCP connection, to show the effect of reusing them
+        stats["connections"].add(request.transport.get_extra_info("peername"))
+        if stats["in_flight"] >= max_in_flight:
+            stats["throttled"] += 1
+            return web.json_response({"error": {"code": "429", "message": "Rate limit is exceeded."}}, status=429, headers={"Retry-After": str(retry_after)})
+        stats["in_flight"] += 1
+        try:
+            await asyncio.sleep(latency)
+            return web.json_response({"id": "cmpl-stub", "object": "text_completion", "created": int(time.time()), "model": DEPLOYMENT,
+                                      "choices": [{"text": "ฟรี", "index": 0, "finish_reason": "stop", "logprobs": None}],
+                                      "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110}})
+        finally:
+            stats["in_flight"] -= 1
+
+    app = web.Application()
+    app.router.add_post("/openai/deployments/{deployment}/completions", completions)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port, backlog=1024).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return stats
+
+async def burst(acreate, requests: int, concurrency: int) -> tuple[int, list[float]]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(i: int):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await acreate(engine=DEPLOYMENT, prompt=f"ค่าธรรมเนียมบัตรเดบิต {i}", max_tokens=16)
+                latencies.append(time.perf_counter() - start)
+            except openai.error.OpenAIError:
+                failures += 1
+
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    return failures, sorted(latencies)
+
+def report(name: str, failures: int, latencies: list[float], elapsed: float, regions: list[dict]):
+    p = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000 if latencies else float("nan")
+    connections = sum(len(r["connections"]) for r in regions)
+    print(f"{name:28} {failures:4} failed, p50 {p(0.5):6.0f} ms, p95 {p(0.95):6.0f} ms, {elapsed:5.1f}s total, {connections} connections")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--max-in-flight", type=int, default=16, help="Concurrent requests a deployment accepts before throttling")
+    parser.add_argument("--latency", type=float, default=0.1, help="Simulated completion latency in seconds")
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    args = parser.parse_args()
+
+    ports = [free_port(), free_port()]
+    regions = [start_region(port, args.latency, args.max_in_flight, args.retry_after) for port in ports]
+    services = [f"http://127.0.0.1:{port}" for port in ports]
+    openai.api_type = "azure"
+    openai.api_base = services[0]
+    openai.api_version = "2023-05-15"
+    openai.api_key = "stub"
+
+    async def run(name: str, pool=None):
+        for region in regions:
+            region["connections"].clear()
+        start = time.perf_counter()
+        # The SDK retries nothing by itself, so the direct calls are the 429s surfacing as errors
+        failures, latencies = await burst(pool.completions.acreate if pool else openai.Completion.acreate, args.requests, args.concurrency)
+        report(name, failures, latencies, time.perf_counter() - start, regions)
+        if pool:
+            await pool.close()
+            for deployment, stats in pool.stats()["deployments"].items():
+                print(f"    {deployment}: {stats['requests']} requests, {stats['throttled']} throttled, p95 {stats['latency_p95']}s")
+
+    asyncio.run(run("direct, one region"))
+    asyncio.run(run("pool, one region", OpenAIPool(services[:1], backoff_seconds=0.1)))
+    asyncio.run(run("pool, two regions", OpenAIPool(services, backoff_seconds=0.1)))
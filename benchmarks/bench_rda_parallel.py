@@ -0,0 +1,69 @@
+"""
+Compares the wall-clock time of the rda approach answering comparison questions one action per step against the
+parallel_actions mode, with scripted completions and searches that sleep for a simulated latency. No Azure resources
+are needed.
+
+Usage: python benchmarks/bench_rda_parallel.py [--questions 20] [--entities 3] [--llm-latency 0.5] [--search-latency 0.3]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from langchain.llms.fake import FakeListLLM
+
+from approaches import readdecomposeask
+from approaches.readdecomposeask import ReadDecomposeAsk
+
+class SlowLLM(FakeListLLM):
+    latency: float = 0.5
+
+    async def _acall(self, prompt, stop=None, run_manager=None):
+        await asyncio.sleep(self.latency)
+        return await super()._acall(prompt, stop, run_manager)
+
+class SlowRetrieval:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def search(self, q, overrides):
+        await asyncio.sleep(self.latency)
+        return [{"sourcepage": f"{q}.pdf", "content": f"{q} ฟรีค่าธรรมเนียมรายปี"}]
+
+    async def semantic_answers(self, q):
+        await asyncio.sleep(self.latency)
+        return [], [{"content": f"{q} คุ้มครอง 2,000 บาท"}]
+
+def script(entities: list[str], parallel: bool) -> list[str]:
+    """Searches then looks up every entity, in one step each or all at once, then answers."""
+    answer = " Done.\nAction: Finish[ฟรี " + "".join(f"<{e}.pdf>" for e in entities) + "]"
+    if parallel:
+        return [" Search all.\n" + "\n".join(f"Action: Search[{e}]" for e in entities),
+                " Look up all.\n" + "\n".join(f"Action: Lookup[{e}]" for e in entities), answer]
+    return [f" Search.\nAction: Search[{e}]" for e in entities] + [f" Look up.\nAction: Lookup[{e}]" for e in entities] + [answer]
+
+async def answer_all(impl: ReadDecomposeAsk, args: argparse.Namespace, parallel: bool) -> float:
+    start = time.perf_counter()
+    for i in range(args.questions):
+        entities = [f"ttb card {i}-{j}" for j in range(args.entities)]
+        llm = SlowLLM(responses=script(entities, parallel), latency=args.llm_latency)
+        readdecomposeask.AzureOpenAI = lambda **kwargs: llm
+        result = await impl.run("Which cards are free?", {"parallel_actions": parallel})
+        assert result["answer"].startswith("ฟรี")
+    return (time.perf_counter() - start) / args.questions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--entities", type=int, default=3, help="Entities compared in each question")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Simulated completion latency in seconds")
+    parser.add_argument("--search-latency", type=float, default=0.3, help="Simulated search and lookup latency in seconds")
+    args = parser.parse_args()
+
+    impl = ReadDecomposeAsk(SlowRetrieval(args.search_latency), "chat", "sourcepage", "content")
+    sequential = asyncio.run(answer_all(impl, args, False))
+    print(f"one action per step:  {sequential:.2f} s/question")
+    parallel = asyncio.run(answer_all(impl, args, True))
+    print(f"parallel actions:     {parallel:.2f} s/question ({sequential / parallel:.1f}x)")
@@ -0,0 +1,80 @@
+"""
+Compares the search payload of the approaches with full documents, with field projection (semantic captions only
+need the source page) and with two-phase search (ranking without content, then content for the sections that fit
+the token budget). Searches a local index of large synthetic Thai sections through a client that charges each
+response a round trip plus its JSON size over the given bandwidth, like a call to Cognitive Search. No Azure
+resources are needed.
+
+Usage: python benchmarks/bench_search_payload.py [--sections 2000] [--words 100] [--top 10] [--budget 2000] [--section-tokens 650]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from bench_local_search import WORDS, synthetic_sections
+from localsearch import LocalSearchClient, LocalSearchIndex, LocalSearchIndexWriter
+from retrieval import RetrievalService
+
+class MeteredClient:
+    def __init__(self, client: LocalSearchClient, round_trip: float, bandwidth: float):
+        self.client = client
+        self.round_trip = round_trip
+        self.bandwidth = bandwidth
+        self.bytes = 0
+        self.calls = 0
+
+    async def search(self, q, **kwargs):
+        r = await self.client.search(q, **kwargs)
+        size = sum(len(json.dumps({k: v for k, v in doc.items() if k != "@search.captions"}, ensure_ascii=False).encode("utf-8")) for doc in r.docs)
+        size += sum(len(c.text.encode("utf-8")) for doc in r.docs for c in doc.get("@search.captions") or [])
+        self.bytes += size
+        self.calls += 1
+        await asyncio.sleep(self.round_trip + size / self.bandwidth)
+        return r
+
+async def run(retrieval: RetrievalService, questions: list[str], overrides: dict) -> float:
+    start = time.perf_counter()
+    for q in questions:
+        await retrieval.search(q, overrides)
+    return (time.perf_counter() - start) / len(questions) * 1000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sections", type=int, default=2000)
+    parser.add_argument("--words", type=int, default=100, help="Words per section, 100 is about the size of the sections of prepdocs.py")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--budget", type=int, default=2000, help="Content token budget of two-phase search")
+    parser.add_argument("--section-tokens", type=int, default=650, help="Expected section size of two-phase search")
+    parser.add_argument("--round-trip", type=float, default=0.01, help="Seconds per search call")
+    parser.add_argument("--bandwidth", type=float, default=5e6, help="Bytes per second")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    questions = [" ".join(rng.choices(WORDS, k=4)) for _ in range(args.queries)]
+    sections = synthetic_sections(args.sections, rng)
+    for s in sections:
+        s["content"] = " ".join(rng.choices(WORDS, k=args.words))
+
+    with tempfile.TemporaryDirectory() as directory:
+        writer = LocalSearchIndexWriter(directory)
+        writer.replace_file("synthetic.pdf", sections)
+        writer.save()
+        index = LocalSearchIndex.load(directory)
+        setups = [("full documents", {}, {}),
+                  ("captions, projected", {}, {"semantic_ranker": True, "semantic_captions": True}),
+                  ("two-phase", {"two_phase": True, "content_token_budget": args.budget, "expected_section_tokens": args.section_tokens}, {})]
+        for name, options, overrides in setups:
+            client = MeteredClient(LocalSearchClient(index, caption_length=300), args.round_trip, args.bandwidth)
+            # Full documents is the behavior before projection: select every field
+            retrieval = RetrievalService(client, **options)
+            if name == "full documents":
+                retrieval.select = lambda with_content: None
+            ms = asyncio.run(run(retrieval, questions, {"top": args.top, **overrides}))
+            print(f"{name:22} {client.bytes / args.queries / 1024:8.1f} KiB/query, {client.calls / args.queries:.1f} calls/query, {ms:6.1f} ms/query")
@@ -0,0 +1,115 @@
+"""
+Times the section splitter of scripts/prepdocs.py on a synthetic 1,000 page document, against a copy of the former
+implementation that looked up pages linearly and scanned the text character by character for every boundary. Both
+must produce the same sections.
+
+Usage: python benchmarks/bench_split_text.py [--pages 1000] [--repeat 3]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from prepdocs import MAX_SECTION_LENGTH, SECTION_OVERLAP, SENTENCE_SEARCH_LIMIT, TextSplitter
+
+WORDS = ["ttb", "all", "free", "account", "fee", "interest", "rate", "transfer", "ค่าธรรมเนียม", "บัตรเดบิต", "(baht)", "[1]"]
+
+def synthetic_document(pages: int, seed: int = 0) -> list[tuple[int, int, str]]:
+    rng = random.Random(seed)
+    page_map = []
+    offset = 0
+    for page_num in range(pages):
+        sentences = []
+        for _ in range(rng.randint(20, 40)):
+            sentences.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 20))) + rng.choice([".", "!", "?", ";"]))
+        if page_num % 10 == 0:
+            rows = "".join(f"<tr><td>{rng.choice(WORDS)}</td><td>{rng.randint(0, 999)}</td></tr>" for _ in range(rng.randint(5, 60)))
+            sentences.append(f"<table>{rows}</table>")
+        text = " ".join(sentences) + "\n"
+        page_map.append((page_num, offset, text))
+        offset += len(text)
+    return page_map
+
+def legacy_split_text(page_map):
+    # The splitter as it was before the boundary tables were introduced
+    SENTENCE_ENDINGS = ["!", "?"]
+    WORDS_BREAKS = [";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+    def find_page(offset):
+        l = len(page_map)
+        for i in range(l - 1):
+            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
+                return i
+        return l - 1
+
+    all_text = "".join(p[2] for p in page_map)
+    length = len(all_text)
+    start = 0
+    end = length
+    while start + SECTION_OVERLAP < length:
+        last_word = -1
+        end = start + MAX_SECTION_LENGTH
+
+        if end > length:
+            end = length
+        else:
+            # Try to find the end of the sentence
+            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
+                if all_text[end] in WORDS_BREAKS:
+                    last_word = end
+                end += 1
+            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                end = last_word # Fall back to at least keeping a whole word
+        if end < length:
+            end += 1
+
+        # Try to find the start of the sentence or at least a whole word boundary
+        last_word = -1
+        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
+            if all_text[start] in WORDS_BREAKS:
+                last_word = start
+            start -= 1
+        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+
+        last_table_start = section_text.rfind("<table")
+        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
+            # If the section ends with an unclosed table, we need to start the next section with the table.
+            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
+            # If last table starts inside SECTION_OVERLAP, keep overlapping
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+
+    if start + SECTION_OVERLAP < end:
+        yield (all_text[start:end], find_page(start))
+
+def timed(func, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the prepdocs.py section splitter on a synthetic document.")
+    parser.add_argument("--pages", type=int, default=1000, help="Number of pages in the synthetic document")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each splitter, the best time is reported")
+    args = parser.parse_args()
+
+    page_map = synthetic_document(args.pages)
+    print(f"{args.pages} pages, {sum(len(p[2]) for p in page_map)} characters")
+    legacy_time, legacy_sections = timed(lambda: list(legacy_split_text(page_map)), args.repeat)
+    print(f"legacy:       {legacy_time * 1000:8.1f} ms, {len(legacy_sections)} sections")
+    new_time, new_sections = timed(lambda: list(TextSplitter().split_pages(page_map)), args.repeat)
+    print(f"TextSplitter: {new_time * 1000:8.1f} ms, {len(new_sections)} sections")
+    assert new_sections == legacy_sections, "TextSplitter output differs from the legacy splitter"
+    print(f"speedup: {legacy_time / new_time:.1f}x")
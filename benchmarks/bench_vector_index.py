@@ -0,0 +1,66 @@
+"""
+Measures the query latency of the local vector index written by prepdocs.py --vectorindex, comparing an exact scan
+of every vector with the IVF layout probing a few clusters, and the recall@10 of the IVF search against the exact
+one. Uses synthetic clustered vectors, so no Azure resources are needed.
+
+Usage: python benchmarks/bench_vector_index.py [--sections 100000] [--dim 256] [--queries 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from vectorindex import VectorIndex, VectorIndexWriter, normalize
+
+class PrecomputedEmbedder:
+    """Returns the synthetic vector whose row number is the section content."""
+    name = "precomputed"
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+        self.dim = vectors.shape[1]
+
+    def config(self):
+        return {"name": self.name, "dim": self.dim}
+
+    def embed(self, texts):
+        return self.vectors[[int(t) for t in texts]]
+
+def synthetic_vectors(count: int, dim: int, topics: int, rng: np.random.Generator) -> np.ndarray:
+    centers = rng.standard_normal((topics, dim))
+    return normalize(centers[rng.integers(topics, size=count)] + 2.0 * rng.standard_normal((count, dim)))
+
+def time_queries(index: VectorIndex, queries: np.ndarray, nprobe) -> tuple[float, list[set[str]]]:
+    start = time.perf_counter()
+    results = [set(s["id"] for _, s in index.search(q, 10, nprobe=nprobe)) for q in queries]
+    return (time.perf_counter() - start) / len(queries) * 1000, results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sections", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = synthetic_vectors(args.sections, args.dim, 500, rng)
+    queries = normalize(vectors[rng.integers(args.sections, size=args.queries)] + 0.05 * rng.standard_normal((args.queries, args.dim)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        writer = VectorIndexWriter(directory, PrecomputedEmbedder(vectors))
+        writer.replace_file("synthetic.pdf", [{"id": f"{i:06d}", "content": str(i), "category": None, "sourcepage": "synthetic.pdf", "sourcefile": "synthetic.pdf"} for i in range(args.sections)])
+        writer.save()
+        print(f"Built index of {args.sections} x {args.dim} vectors in {time.perf_counter() - start:.1f}s")
+
+        index = VectorIndex.load(directory)
+        exact_ms, exact = time_queries(index, queries, None)
+        print(f"exact scan: {exact_ms:.2f} ms/query")
+        for nprobe in (4, 8, 16, 32):
+            ivf_ms, ivf = time_queries(index, queries, nprobe)
+            recall = np.mean([len(a & b) / len(a) for a, b in zip(ivf, exact)])
+            print(f"IVF nprobe={nprobe} of {len(index.centroids)} clusters: {ivf_ms:.2f} ms/query ({exact_ms / ivf_ms:.1f}x), recall@10 {recall:.3f}")
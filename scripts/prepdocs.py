@@ -1,24 +1,44 @@
 import argparse
+import array
 import base64
+import bisect
+import concurrent.futures
+import fnmatch
 import glob
+import hashlib
+import heapq
 import html
 import io
+import json
 import os
+import queue
+import random
 import re
+import sqlite3
+import sys
+import threading
 import time
 
+import numpy as np
+import requests
+from azure.ai import formrecognizer
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.identity import AzureDeveloperCliCredential
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import *
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobServiceClient, ContentSettings
 from pypdf import PdfReader, PdfWriter
 
 MAX_SECTION_LENGTH = 550
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
+# Container metadata entry read by the app to discard search results it cached before this run
+INDEX_GENERATION_METADATA_KEY = "index_generation"
+PAGES_PER_RENDER_TASK = 16
 
 
 def blob_name_from_file_page(filename, page = 0):
@@ -27,58 +47,313 @@ def blob_name_from_file_page(filename, page = 0):
     else:
         return os.path.basename(filename)
 
-def upload_blobs(filename):
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
-    if not blob_container.exists():
-        blob_container.create_container()
+def create_blob_container():
+    """Creates the container client shared by the whole run, with a connection pool large enough for the concurrent uploads."""
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(10, args.uploadworkers)))
+    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds, transport=RequestsTransport(session=session, session_owner=False))
+    container = blob_service.get_container_client(args.container)
+    if not container.exists():
+        container.create_container()
+    return container
 
+def render_pdf_pages(filename, page_numbers):
+    """Renders each of the pages as a separate PDF and returns (page number, PDF bytes) tuples. Runs in the page renderer processes."""
+    reader = PdfReader(filename)
+    rendered = []
+    for i in page_numbers:
+        f = io.BytesIO()
+        writer = PdfWriter()
+        writer.add_page(reader.pages[i])
+        writer.write(f)
+        rendered.append((i, f.getvalue()))
+    return rendered
+
+def rendered_pdf_pages(filename):
+    """Yields (page number, PDF bytes) for every page of the PDF, in completion order when the page renderer pool is used."""
+    page_count = len(PdfReader(filename).pages)
+    # Each task renders a chunk of pages so that the worker processes parse the PDF once per chunk rather than per page
+    chunks = [range(start, min(start + PAGES_PER_RENDER_TASK, page_count)) for start in range(0, page_count, PAGES_PER_RENDER_TASK)]
+    if page_renderer is None or len(chunks) < 2:
+        for chunk in chunks:
+            yield from render_pdf_pages(filename, chunk)
+    else:
+        for future in concurrent.futures.as_completed([page_renderer.submit(render_pdf_pages, filename, chunk) for chunk in chunks]):
+            yield from future.result()
+
+def existing_blob_hashes(filename):
+    """MD5 hash of the blobs already uploaded for the file, by name, from a single listing of the container."""
+    prefix = os.path.splitext(os.path.basename(filename))[0]
+    return {b.name: bytes(b.content_settings.content_md5).hex() for b in blob_container.list_blobs(name_starts_with=prefix)
+            if b.content_settings and b.content_settings.content_md5}
+
+def upload_blob(blob_name, data, md5):
+    # Record the MD5 on the blob, the service only computes it for uploads that fit in a single request
+    blob_container.upload_blob(blob_name, data, overwrite=True, content_settings=ContentSettings(content_md5=bytes.fromhex(md5)))
+
+def upload_blobs(filename, known_blobs = None):
+    """
+    Uploads the file, or each page as a separate blob if it's a PDF, and returns the MD5 hash of each blob by name.
+    Blobs whose hash matches the one recorded by a previous run or the MD5 of the blob already in the container are
+    skipped. When the hashes from a previous run are given, blobs that no longer exist (e.g. pages removed from the
+    PDF) are deleted. Pages are rendered in the page renderer processes and uploaded concurrently.
+    """
+    existing_blobs = existing_blob_hashes(filename)
+    def is_unchanged(blob_name, md5):
+        return (known_blobs or {}).get(blob_name) == md5 or existing_blobs.get(blob_name) == md5
+
+    blob_hashes = {}
     # if file is PDF split into pages and upload each page as a separate blob
     if os.path.splitext(filename)[1].lower() == ".pdf":
-        reader = PdfReader(filename)
-        pages = reader.pages
-        for i in range(len(pages)):
+        page_hashes = {}
+        uploads = []
+        for i, data in rendered_pdf_pages(filename):
             blob_name = blob_name_from_file_page(filename, i)
+            page_hashes[i] = hashlib.md5(data).hexdigest()
+            if is_unchanged(blob_name, page_hashes[i]):
+                if args.verbose: print(f"\tSkipping unchanged blob for page {i} -> {blob_name}")
+                continue
             if args.verbose: print(f"\tUploading blob for page {i} -> {blob_name}")
-            f = io.BytesIO()
-            writer = PdfWriter()
-            writer.add_page(pages[i])
-            writer.write(f)
-            f.seek(0)
-            blob_container.upload_blob(blob_name, f, overwrite=True)
+            uploads.append(upload_executor.submit(upload_blob, blob_name, data, page_hashes[i]))
+        for upload in uploads:
+            upload.result()
+        blob_hashes = {blob_name_from_file_page(filename, i): page_hashes[i] for i in sorted(page_hashes)}
     else:
         blob_name = blob_name_from_file_page(filename)
-        with open(filename,"rb") as data:
-            blob_container.upload_blob(blob_name, data, overwrite=True)
+        blob_hashes[blob_name] = file_hash(filename, hashlib.md5)
+        if not is_unchanged(blob_name, blob_hashes[blob_name]):
+            with open(filename,"rb") as data:
+                upload_blob(blob_name, data, blob_hashes[blob_name])
+
+    for blob_name in set(known_blobs or {}) - set(blob_hashes):
+        if args.verbose: print(f"\tRemoving blob {blob_name}")
+        blob_container.delete_blob(blob_name)
+    return blob_hashes
 
-def remove_blobs(filename):
+def remove_blobs(filename, blob_names = None):
+    """
+    Removes the blobs of the file, or of every file if filename is None. blob_names are the blobs a previous run
+    recorded for the file in the manifest, without them the blobs are found by name: the pages of a PDF or the file.
+    """
     if args.verbose: print(f"Removing blobs for '{filename or '<all>'}'")
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
-    if blob_container.exists():
-        if filename == None:
-            blobs = blob_container.list_blob_names()
-        else:
-            prefix = os.path.splitext(os.path.basename(filename))[0]
-            blobs = filter(lambda b: re.match(f"{prefix}-\d+\.pdf", b), blob_container.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0]))
-        for b in blobs:
-            if args.verbose: print(f"\tRemoving blob {b}")
+    if filename == None:
+        blobs = blob_container.list_blob_names()
+    elif blob_names is not None:
+        blobs = blob_names
+    elif os.path.splitext(filename)[1].lower() == ".pdf":
+        prefix = os.path.splitext(os.path.basename(filename))[0]
+        blobs = filter(lambda b: re.fullmatch(re.escape(prefix) + r"-\d+\.pdf", b), blob_container.list_blob_names(name_starts_with=prefix))
+    else:
+        blobs = filter(lambda b: b == blob_name_from_file_page(filename), blob_container.list_blob_names(name_starts_with=blob_name_from_file_page(filename)))
+    for b in blobs:
+        if args.verbose: print(f"\tRemoving blob {b}")
+        try:
             blob_container.delete_blob(b)
+        except ResourceNotFoundError:
+            # Already deleted, e.g. by hand or by an interrupted run
+            pass
+
+def update_index_generation():
+    if args.verbose: print(f"Updating index generation in container '{args.container}'")
+    metadata = blob_container.get_container_properties().metadata or {}
+    metadata[INDEX_GENERATION_METADATA_KEY] = str(time.time_ns())
+    blob_container.set_container_metadata(metadata)
 
 def table_to_html(table):
-    table_html = "<table>"
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    rows = [[] for _ in range(table.row_count)]
+    for cell in table.cells:
+        if 0 <= cell.row_index < table.row_count:
+            rows[cell.row_index].append(cell)
+    table_html = ["<table>"]
     for row_cells in rows:
-        table_html += "<tr>"
-        for cell in row_cells:
+        table_html.append("<tr>")
+        for cell in sorted(row_cells, key=lambda cell: cell.column_index):
             tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
             cell_spans = ""
             if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
             if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
-            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-        table_html +="</tr>"
-    table_html += "</table>"
-    return table_html
+            table_html.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+        table_html.append("</tr>")
+    table_html.append("</table>")
+    return "".join(table_html)
+
+def table_intervals(tables_on_page, page_offset, page_length):
+    """
+    Returns the sorted, non-overlapping (start, end, table_id) intervals of the page covered by tables, relative to
+    the page offset. Where the spans of several tables overlap, the table listed last wins.
+    """
+    spans = []
+    for table_id, table in enumerate(tables_on_page):
+        for span in table.spans:
+            start = max(span.offset - page_offset, 0)
+            end = min(span.offset - page_offset + span.length, page_length)
+            if start < end:
+                spans.append((start, end, table_id))
+    spans.sort()
+
+    # sweep over the span boundaries, each piece belongs to the highest table id covering it
+    boundaries = sorted(set(b for start, end, _ in spans for b in (start, end)))
+    covering = []
+    next_span = 0
+    intervals = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        while next_span < len(spans) and spans[next_span][0] <= start:
+            heapq.heappush(covering, (-spans[next_span][2], spans[next_span][1]))
+            next_span += 1
+        while covering and covering[0][1] <= start:
+            heapq.heappop(covering)
+        if not covering:
+            continue
+        table_id = -covering[0][0]
+        if intervals and intervals[-1][1] == start and intervals[-1][2] == table_id:
+            intervals[-1] = (intervals[-1][0], end, table_id)
+        else:
+            intervals.append((start, end, table_id))
+    return intervals
+
+def form_recognizer_page_map(form_recognizer_results, offset = 0):
+    """Builds the page map of a Form Recognizer layout analysis, with the tables of each page rendered as HTML in place of their text."""
+    # index the tables by page once, rather than scanning all tables for every page
+    tables_by_page = {}
+    for table in form_recognizer_results.tables or []:
+        tables_by_page.setdefault(table.bounding_regions[0].page_number, []).append(table)
+
+    content = form_recognizer_results.content
+    page_map = []
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        tables_on_page = tables_by_page.get(page_num + 1, [])
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+
+        # copy the text between tables as slices and replace each table with its html, where it first appears
+        page_text = []
+        added_tables = set()
+        position = 0
+        for start, end, table_id in table_intervals(tables_on_page, page_offset, page_length):
+            page_text.append(content[page_offset + position:page_offset + start])
+            if not table_id in added_tables:
+                page_text.append(table_to_html(tables_on_page[table_id]))
+                added_tables.add(table_id)
+            position = end
+        page_text.append(content[page_offset + position:page_offset + page_length])
+        page_text.append(" ")
+
+        page_text = "".join(page_text)
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+
+    return page_map
+
+def retry_delay(retry_after, attempt, backoff_seconds):
+    """Seconds to wait before retrying a throttled request: the Retry-After the service asks for, or jittered exponential backoff."""
+    return float(retry_after) if retry_after and retry_after.isdigit() else backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.5)
+
+class FormRecognizerCache:
+    """
+    On-disk cache of Form Recognizer analysis results, one JSON file per document content, model and locale. Layout
+    analysis is the slowest and most expensive part of ingestion, so re-runs reuse the results of documents that
+    haven't changed, whatever their file name.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, hash, model, locale):
+        key = hashlib.sha256(f"{hash}|{model}|{locale}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, hash, model, locale):
+        path = self.path(hash, model, locale)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                return formrecognizer.AnalyzeResult.from_dict(json.load(f))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"\tIgnoring unreadable Form Recognizer cache entry '{path}': {e}")
+            return None
+
+    def set(self, hash, model, locale, result):
+        # Write to a temporary file first so that concurrent or interrupted runs never leave a truncated entry behind
+        path = self.path(hash, model, locale)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(result.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+class FormRecognizerAnalyzer:
+    """
+    Analyzes documents with one shared Form Recognizer client. At most max_concurrency analyses are in flight at a
+    time, analyses throttled with a 429 are retried with exponential backoff (or after the Retry-After the service
+    asks for), and results are read from and written to the optional cache. prefetch() starts the analyses of
+    upcoming files in the background, analyze() returns the result of a file, waiting for its prefetch if any.
+    """
+    def __init__(self, client, model = "prebuilt-layout", locale = "th", cache = None, max_concurrency = 4, max_retries = 5, backoff_seconds = 2.0):
+        self.client = client
+        self.model = model
+        self.locale = locale
+        self.cache = cache
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="formrecognizer")
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.analyzed = 0
+        self.cached = 0
+        self.retries = 0
+
+    def prefetch(self, filenames):
+        with self.lock:
+            for filename in filenames:
+                if filename not in self.futures:
+                    self.futures[filename] = self.executor.submit(self.analyze_document, filename)
+
+    def analyze(self, filename):
+        with self.lock:
+            future = self.futures.pop(filename, None)
+        return future.result() if future else self.analyze_document(filename)
+
+    def analyze_document(self, filename):
+        hash = file_hash(filename) if self.cache else None
+        if self.cache:
+            result = self.cache.get(hash, self.model, self.locale)
+            if result is not None:
+                if args.verbose: print(f"Using cached Form Recognizer results for '{filename}'")
+                with self.lock:
+                    self.cached += 1
+                return result
+
+        if args.verbose: print(f"Extracting text from '{filename}' using Azure Form Recognizer")
+        with self.semaphore:
+            result = self.begin_with_retries(filename)
+        with self.lock:
+            self.analyzed += 1
+        if self.cache:
+            self.cache.set(hash, self.model, self.locale, result)
+        return result
+
+    def begin_with_retries(self, filename):
+        attempt = 0
+        while True:
+            try:
+                with open(filename, "rb") as f:
+                    poller = self.client.begin_analyze_document(self.model, document = f, locale = self.locale)
+                return poller.result()
+            except HttpResponseError as e:
+                if e.status_code != 429 or attempt >= self.max_retries:
+                    raise
+                retry_after = e.response.headers.get("Retry-After") if e.response is not None else None
+                delay = retry_delay(retry_after, attempt, self.backoff_seconds)
+                print(f"\tForm Recognizer is throttling requests, retrying '{filename}' in {delay:.1f}s")
+                with self.lock:
+                    self.retries += 1
+                attempt += 1
+                time.sleep(delay)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.client.close()
 
 def get_document_text(filename):
     offset = 0
@@ -91,102 +366,107 @@ def get_document_text(filename):
             page_map.append((page_num, offset, page_text))
             offset += len(page_text)
     else:
-        if args.verbose: print(f"Extracting text from '{filename}' using Azure Form Recognizer")
-        form_recognizer_client = DocumentAnalysisClient(endpoint=f"https://{args.formrecognizerservice}.cognitiveservices.azure.com/", credential=formrecognizer_creds, headers={"x-ms-useragent": "azure-search-chat-demo/1.0.0"})
-        with open(filename, "rb") as f:
-            poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document = f, locale = 'th')
-        form_recognizer_results = poller.result()
-
-        for page_num, page in enumerate(form_recognizer_results.pages):
-            tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
-
-            # mark all positions of the table spans in the page
-            page_offset = page.spans[0].offset
-            page_length = page.spans[0].length
-            table_chars = [-1]*page_length
-            for table_id, table in enumerate(tables_on_page):
-                for span in table.spans:
-                    # replace all table spans with "table_id" in table_chars array
-                    for i in range(span.length):
-                        idx = span.offset - page_offset + i
-                        if idx >=0 and idx < page_length:
-                            table_chars[idx] = table_id
-
-            # build page text by replacing charcters in table spans with table html
-            page_text = ""
-            added_tables = set()
-            for idx, table_id in enumerate(table_chars):
-                if table_id == -1:
-                    page_text += form_recognizer_results.content[page_offset + idx]
-                elif not table_id in added_tables:
-                    page_text += table_to_html(tables_on_page[table_id])
-                    added_tables.add(table_id)
-
-            page_text += " "
-            page_map.append((page_num, offset, page_text))
-            offset += len(page_text)
+        form_recognizer_results = form_recognizer.analyze(filename)
+        page_map = form_recognizer_page_map(form_recognizer_results, offset)
 
     return page_map
 
-def split_text(page_map):
+class TextSplitter:
+    """
+    Splits the text of a document into overlapping sections of roughly max_section_length characters, preferring
+    to cut at the end of a sentence, or at least between words, within sentence_search_limit characters of the
+    target boundary. The sentence endings and page start offsets are indexed once per document, so finding each
+    boundary and the page a section starts on is a binary search instead of a scan. Word breaks are only needed when
+    there is no sentence ending nearby, they are searched for within the sentence_search_limit window.
+    """
     SENTENCE_ENDINGS = ["!", "?"]
     WORDS_BREAKS = [";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
-    if args.verbose: print(f"Splitting '{filename}' into sections")
 
-    def find_page(offset):
-        l = len(page_map)
-        for i in range(l - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return l - 1
-
-    all_text = "".join(p[2] for p in page_map)
-    length = len(all_text)
-    start = 0
-    end = length
-    while start + SECTION_OVERLAP < length:
-        last_word = -1
-        end = start + MAX_SECTION_LENGTH
+    def __init__(self, max_section_length = MAX_SECTION_LENGTH, sentence_search_limit = SENTENCE_SEARCH_LIMIT, section_overlap = SECTION_OVERLAP, verbose = False):
+        if section_overlap >= max_section_length:
+            raise ValueError(f"Section overlap ({section_overlap}) must be smaller than the section length ({max_section_length})")
+        self.max_section_length = max_section_length
+        self.sentence_search_limit = sentence_search_limit
+        self.section_overlap = section_overlap
+        self.verbose = verbose
+        self.sentence_endings_re = re.compile("[" + re.escape("".join(self.SENTENCE_ENDINGS)) + "]")
+        self.word_breaks_re = re.compile("[" + re.escape("".join(self.WORDS_BREAKS)) + "]")
 
+    def find_end(self, all_text, start, sentence_endings):
+        """End (exclusive) of the section starting at start: after the first sentence ending within the search limit, else after the last word."""
+        length = len(all_text)
+        end = start + self.max_section_length
         if end > length:
-            end = length
+            return length
+        limit = min(length, end + self.sentence_search_limit)
+        i = bisect.bisect_left(sentence_endings, end)
+        if i < len(sentence_endings) and sentence_endings[i] < limit:
+            end = sentence_endings[i]
         else:
-            # Try to find the end of the sentence
-            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word # Fall back to at least keeping a whole word
+            # No sentence ending in range, fall back to at least keeping a whole word
+            last_word = -1
+            for match in self.word_breaks_re.finditer(all_text, end, limit):
+                last_word = match.start()
+            end = limit
+            if end < length and all_text[end] not in self.SENTENCE_ENDINGS and last_word > 0:
+                end = last_word
         if end < length:
             end += 1
+        return end
 
-        # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
+    def find_start(self, all_text, start, end, sentence_endings):
+        """Moves start back to just after the closest sentence ending, else to the first whole word, within the search limit."""
+        lower_bound = max(0, end - self.max_section_length - 2 * self.sentence_search_limit)
+        if start > lower_bound:
+            i = bisect.bisect_right(sentence_endings, start) - 1
+            if i >= 0 and sentence_endings[i] > lower_bound:
+                start = sentence_endings[i]
+            else:
+                match = self.word_breaks_re.search(all_text, lower_bound + 1, start + 1)
+                last_word = match.start() if match else -1
+                start = lower_bound
+                if all_text[start] not in self.SENTENCE_ENDINGS and last_word > 0:
+                    start = last_word
         if start > 0:
             start += 1
+        return start
 
-        section_text = all_text[start:end]
-        yield (section_text, find_page(start))
+    def split_pages(self, page_map):
+        """Yields (section text, page number) tuples for the pages in page_map, a list of (page number, offset, text) tuples."""
+        page_offsets = [p[1] for p in page_map]
+        def find_page(offset):
+            i = bisect.bisect_right(page_offsets, offset) - 1
+            return i if i >= 0 else len(page_map) - 1
 
-        last_table_start = section_text.rfind("<table")
-        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
-            # If the section ends with an unclosed table, we need to start the next section with the table.
-            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
-            # If last table starts inside SECTION_OVERLAP, keep overlapping
-            if args.verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
-            start = min(end - SECTION_OVERLAP, start + last_table_start)
-        else:
-            start = end - SECTION_OVERLAP
-        
-    if start + SECTION_OVERLAP < end:
-        yield (all_text[start:end], find_page(start))
+        all_text = "".join(p[2] for p in page_map)
+        sentence_endings = array.array("q", (m.start() for m in self.sentence_endings_re.finditer(all_text)))
+        length = len(all_text)
+        start = 0
+        end = length
+        while start + self.section_overlap < length:
+            end = self.find_end(all_text, start, sentence_endings)
+            start = self.find_start(all_text, start, end, sentence_endings)
+
+            section_text = all_text[start:end]
+            yield (section_text, find_page(start))
+
+            last_table_start = section_text.rfind("<table")
+            if (last_table_start > 2 * self.sentence_search_limit and last_table_start > section_text.rfind("</table")):
+                # If the section ends with an unclosed table, we need to start the next section with the table.
+                # If table starts inside sentence_search_limit, we ignore it, as that will cause an infinite loop for tables longer than max_section_length
+                # If last table starts inside section_overlap, keep overlapping
+                if self.verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
+                start = min(end - self.section_overlap, start + last_table_start)
+            else:
+                start = end - self.section_overlap
+
+        if start + self.section_overlap < end:
+            yield (all_text[start:end], find_page(start))
+
+def split_text(page_map, filename):
+    if args.verbose: print(f"Splitting '{filename}' into sections")
+    splitter = TextSplitter(args.sectionlength, SENTENCE_SEARCH_LIMIT, args.sectionoverlap, args.verbose)
+    return splitter.split_pages(page_map)
 
 def filename_to_id(filename):
     filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", filename)
@@ -195,7 +475,7 @@ def filename_to_id(filename):
 
 def create_sections(filename, page_map):
     file_id = filename_to_id(filename)
-    for i, (section, pagenum) in enumerate(split_text(page_map)):
+    for i, (section, pagenum) in enumerate(split_text(page_map, filename)):
         yield {
             "id": f"{file_id}-page-{i}",
             "content": section,
@@ -205,6 +485,8 @@ def create_sections(filename, page_map):
         }
 
 def create_search_index():
+    if not args.searchservice:
+        return
     if args.verbose: print(f"Ensuring search index {args.index} exists")
     index_client = SearchIndexClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
                                      credential=search_creds)
@@ -229,7 +511,26 @@ def create_search_index():
     else:
         if args.verbose: print(f"Search index {args.index} already exists")
 
-def index_sections(filename, sections):
+def section_hash(section):
+    return hashlib.sha256(json.dumps(section, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def index_sections(filename, sections, known_sections = None):
+    """
+    Uploads the sections to the search index and returns the content hash of each section by id, and whether any
+    section was added, changed or removed. When the hashes from a previous run are given, unchanged sections are
+    skipped and sections that no longer exist are deleted. The sections also replace those of the file in the local
+    search index, if any.
+    """
+    section_hashes = {s["id"]: section_hash(s) for s in sections}
+    if known_sections is None:
+        changed = len(sections) > 0
+    else:
+        changed = section_hashes != known_sections
+    if args.localsearchindex:
+        local_search_index.replace_file(filename, sections)
+    if not args.searchservice:
+        # Only the local search index is used
+        return section_hashes, changed
     if args.verbose: print(f"Indexing sections from '{filename}' into search index '{args.index}'")
     search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
                                     index_name=args.index,
@@ -237,6 +538,8 @@ def index_sections(filename, sections):
     i = 0
     batch = []
     for s in sections:
+        if known_sections and known_sections.get(s["id"]) == section_hashes[s["id"]]:
+            continue
         batch.append(s)
         i += 1
         if i % 1000 == 0:
@@ -250,8 +553,336 @@ def index_sections(filename, sections):
         succeeded = sum([1 for r in results if r.succeeded])
         if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
 
+    stale_sections = set(known_sections or {}) - set(section_hashes)
+    if len(stale_sections) > 0:
+        r = search_client.delete_documents(documents=[{ "id": id } for id in stale_sections])
+        if args.verbose: print(f"\tRemoved {len(r)} stale sections from index")
+    return section_hashes, changed
+
+class EmbeddingCache:
+    """
+    On-disk cache of section embeddings in a SQLite database, keyed by the hash of the embedding model and the section
+    content. Sections that haven't changed are never embedded again, even when the file was renamed or the local
+    vector index was rebuilt from scratch.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(model, text):
+        return hashlib.sha256(f"{model}|{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        vectors = {}
+        with self.lock:
+            # Stay well below SQLite's limit on the number of query parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.connection.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                vectors.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+        return vectors
+
+    def set_many(self, items):
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                                        [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items])
+
+    def close(self):
+        self.connection.close()
+
+class BatchEmbedder:
+    """
+    Embeds sections for the local vector index with as few embedding calls as possible. Texts found in the optional
+    cache are not embedded again, the others are deduplicated and packed into batches of up to max_batch_size inputs
+    and max_batch_tokens tokens, and up to max_concurrency batches are embedded at a time. Throttled batches (429) are
+    retried with exponential backoff or after the Retry-After the service asks for, like Form Recognizer analyses.
+    Tokens are counted as UTF-8 bytes unless count_tokens is given, which never undercounts a byte-level BPE tokenizer.
+    """
+    def __init__(self, embedder, cache = None, max_batch_size = 16, max_batch_tokens = None, count_tokens = None, max_concurrency = 4, max_retries = 5, backoff_seconds = 2.0):
+        self.embedder = embedder
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.count_tokens = count_tokens or (lambda text: len(text.encode("utf-8")))
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="embeddings")
+        self.model = json.dumps(embedder.config(), sort_keys=True)
+        self.lock = threading.Lock()
+        self.embedded = 0
+        self.cached = 0
+        self.batches = 0
+        self.retries = 0
+
+    @property
+    def dim(self):
+        return self.embedder.dim
+
+    def config(self):
+        return self.embedder.config()
+
+    def make_batches(self, texts):
+        batches = []
+        batch, batch_tokens = [], 0
+        for text in texts:
+            tokens = self.count_tokens(text)
+            if batch and (len(batch) >= self.max_batch_size or (self.max_batch_tokens and batch_tokens + tokens > self.max_batch_tokens)):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def embed(self, texts):
+        keys = [EmbeddingCache.key(self.model, text) for text in texts]
+        vectors = self.cache.get_many(list(set(keys))) if self.cache else {}
+        missing = list({key: text for key, text in zip(keys, texts) if key not in vectors}.items())
+        with self.lock:
+            self.cached += sum(1 for key in keys if key in vectors)
+
+        missing_texts = [text for _, text in missing]
+        embedded = [vector for batch_vectors in self.executor.map(self.embed_with_retries, self.make_batches(missing_texts)) for vector in batch_vectors]
+        new_vectors = [(key, vector) for (key, _), vector in zip(missing, embedded)]
+        if self.cache and new_vectors:
+            self.cache.set_many(new_vectors)
+        vectors.update(new_vectors)
+        with self.lock:
+            self.embedded += len(missing)
+        return np.stack([vectors[key] for key in keys]) if keys else np.zeros((0, self.dim), dtype=np.float32)
+
+    def embed_with_retries(self, batch):
+        attempt = 0
+        while True:
+            try:
+                vectors = self.embedder.embed(batch)
+                with self.lock:
+                    self.batches += 1
+                return vectors
+            except Exception as e:
+                if getattr(e, "http_status", None) != 429 or attempt >= self.max_retries:
+                    raise
+                delay = retry_delay((getattr(e, "headers", None) or {}).get("Retry-After"), attempt, self.backoff_seconds)
+                if args.verbose: print(f"\tEmbedding requests are throttled, retrying a batch of {len(batch)} sections in {delay:.1f}s")
+                with self.lock:
+                    self.retries += 1
+                attempt += 1
+                time.sleep(delay)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.cache:
+            self.cache.close()
+
+def embed_sections(filename, sections):
+    """Adds the sections of the file to the local vector index, embedding the ones that are new or changed."""
+    embedded = vector_index.replace_file(filename, sections)
+    if args.verbose: print(f"\tEmbedded {embedded} new or changed sections of {len(sections)} into local vector index '{args.vectorindex}'")
+
+def file_hash(filename, algorithm = hashlib.sha256):
+    h = algorithm()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class IngestionManifest:
+    """
+    Local record of what previous runs ingested into an index: for each file (by base name, which is also what the
+    blob names and the sourcefile field are derived from) the hash of the file, of each blob and of each section.
+    Used by --incremental to skip unchanged files, replace only the sections that changed, and clean up after files
+    that were deleted. Safe to update from several pipeline workers.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.files = json.load(f).get("files", {})
+
+    def get(self, filename):
+        with self.lock:
+            return self.files.get(os.path.basename(filename), {})
+
+    def update(self, filename, hash, blobs, sections):
+        with self.lock:
+            self.files[os.path.basename(filename)] = {"path": os.path.abspath(filename), "hash": hash, "blobs": blobs, "sections": sections}
+            self.save()
+
+    def remove(self, filename):
+        with self.lock:
+            self.files.pop(os.path.basename(filename), None)
+            self.save()
+
+    def clear(self):
+        with self.lock:
+            self.files = {}
+            self.save()
+
+    def deleted_files(self, pattern, filenames):
+        """Files recorded under the glob pattern that are no longer part of the matching files."""
+        current = set(os.path.basename(f) for f in filenames)
+        with self.lock:
+            return [entry["path"] for name, entry in self.files.items()
+                    if name not in current and fnmatch.fnmatch(entry["path"], os.path.abspath(pattern))]
+
+    def save(self):
+        # Write to a temporary file first so an interrupted run never leaves a truncated manifest behind
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"index": args.index, "files": self.files}, f, ensure_ascii=False, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+class PipelineStage:
+    """
+    One step of the ingestion pipeline. Runs func(filename, payload) on up to `workers` files at a time, reading
+    from a bounded input queue so a fast stage can't run arbitrarily far ahead of a slow one.
+    """
+    def __init__(self, name, func, workers, queue_size):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.lock = threading.Lock()
+
+def run_pipeline(filenames, stages):
+    """
+    Pushes every file through the stages in order. Each stage hands its result to the next one, so different files
+    are in different stages at the same time. A file that fails in one stage is reported and skipped by later stages.
+    Returns the list of (filename, stage name, exception) failures.
+    """
+    failures = []
+    failures_lock = threading.Lock()
+
+    def worker(index):
+        stage = stages[index]
+        next_stage = stages[index + 1] if index + 1 < len(stages) else None
+        while True:
+            item = stage.queue.get()
+            if item is None:
+                break
+            filename, payload = item
+            start = time.perf_counter()
+            try:
+                result = stage.func(filename, payload)
+            except Exception as e:
+                print(f"\tFailed to {stage.name} '{filename}': {e}")
+                with failures_lock:
+                    failures.append((filename, stage.name, e))
+                continue
+            finally:
+                with stage.lock:
+                    stage.busy_seconds += time.perf_counter() - start
+            with stage.lock:
+                stage.items += 1
+            if next_stage:
+                next_stage.queue.put((filename, result))
+
+    threads = [[threading.Thread(target=worker, args=(i,), daemon=True) for _ in range(stage.workers)] for i, stage in enumerate(stages)]
+    for stage_threads in threads:
+        for t in stage_threads:
+            t.start()
+    for filename in filenames:
+        stages[0].queue.put((filename, None))
+    # Once every worker of a stage is done, nothing more can reach the next stage, so it's safe to tell its workers to stop
+    for stage, stage_threads in zip(stages, threads):
+        for _ in range(stage.workers):
+            stage.queue.put(None)
+        for t in stage_threads:
+            t.join()
+    return failures
+
+def parse_stage_workers(value, default):
+    workers = {"extract": default, "split": 1, "blobs": default, "index": default}
+    for entry in (value or "").split(","):
+        if entry.strip():
+            name, count = entry.split("=")
+            if name.strip() not in workers:
+                raise ValueError(f"Unknown pipeline stage '{name.strip()}', expected one of {', '.join(workers)}")
+            workers[name.strip()] = max(1, int(count))
+    return workers
+
+def process_files_in_pipeline(filenames, manifest = None, file_hashes = None):
+    """Processes the files in the ingestion pipeline, returns whether the sections of any index changed."""
+    stage_workers = parse_stage_workers(args.stageworkers, args.workers)
+    totals = {"pages": 0, "sections": 0, "files": 0, "changed": False}
+    totals_lock = threading.Lock()
+
+    def extract(filename, _):
+        page_map = get_document_text(filename)
+        with totals_lock:
+            totals["pages"] += len(page_map)
+        return page_map
+
+    def split(filename, page_map):
+        sections = list(create_sections(os.path.basename(filename), page_map))
+        with totals_lock:
+            totals["sections"] += len(sections)
+        return sections
+
+    def blobs(filename, sections):
+        known = manifest.get(filename) if manifest else {}
+        blob_hashes = known.get("blobs", {})
+        if not args.skipblobs:
+            blob_hashes = upload_blobs(filename, known.get("blobs") if args.incremental else None)
+        return sections, blob_hashes
+
+    def index(filename, payload):
+        sections, blob_hashes = payload
+        known = manifest.get(filename) if manifest else {}
+        section_hashes, changed = index_sections(os.path.basename(filename), sections, known.get("sections") if args.incremental else None)
+        if args.vectorindex:
+            embed_sections(os.path.basename(filename), sections)
+        if manifest:
+            manifest.update(filename, (file_hashes or {}).get(filename) or file_hash(filename), blob_hashes, section_hashes)
+        with totals_lock:
+            totals["changed"] = totals["changed"] or changed
+            totals["files"] += 1
+            print(f"\t[{totals['files']}/{len(filenames)}] Indexed '{filename}'")
+
+    # Page blobs are uploaded before the sections are indexed, so citations never point to a missing blob
+    stages = [PipelineStage("extract", extract, stage_workers["extract"], args.workers * 2),
+              PipelineStage("split", split, stage_workers["split"], args.workers * 2),
+              PipelineStage("blobs", blobs, stage_workers["blobs"], args.workers * 2),
+              PipelineStage("index", index, stage_workers["index"], args.workers * 2)]
+    start = time.perf_counter()
+    failures = run_pipeline(filenames, stages)
+    elapsed = time.perf_counter() - start
+
+    print(f"Processed {totals['files']} files ({totals['pages']} pages, {totals['sections']} sections) in {elapsed:.1f}s: "
+          f"{totals['files'] / elapsed:.2f} files/s, {totals['sections'] / elapsed:.1f} sections/s")
+    for stage in stages:
+        average = stage.busy_seconds / stage.items if stage.items else 0
+        print(f"\t{stage.name}: {stage.items} files, {stage.workers} workers, {stage.busy_seconds:.1f}s busy, {average:.2f}s per file")
+    if failures:
+        print(f"{len(failures)} files failed:")
+        for filename, stage_name, e in failures:
+            print(f"\t'{filename}' in stage {stage_name}: {e}")
+    return totals["changed"]
+
 def remove_from_index(filename):
+    """Removes the sections of the file, or of every file if filename is None, returns whether there were any."""
     if args.verbose: print(f"Removing sections from '{filename or '<all>'}' from search index '{args.index}'")
+    removed = 0
+    if args.vectorindex:
+        if filename == None:
+            removed += vector_index.clear()
+        else:
+            removed += vector_index.remove_file(os.path.basename(filename))
+    if args.localsearchindex:
+        if filename == None:
+            removed += local_search_index.clear()
+        else:
+            removed += local_search_index.remove_file(os.path.basename(filename))
+    if not args.searchservice:
+        return removed > 0
     search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
                                     index_name=args.index,
                                     credential=search_creds)
@@ -261,9 +892,11 @@ def remove_from_index(filename):
         if r.get_count() == 0:
             break
         r = search_client.delete_documents(documents=[{ "id": d["id"] } for d in r])
+        removed += len(r)
         if args.verbose: print(f"\tRemoved {len(r)} sections from index")
         # It can take a few seconds for search results to reflect changes, so wait a bit
         time.sleep(2)
+    return removed > 0
 
 
 if __name__ == "__main__":
@@ -279,7 +912,7 @@ if __name__ == "__main__":
     parser.add_argument("--container", help="Azure Blob Storage container name")
     parser.add_argument("--storagekey", required=False, help="Optional. Use this Azure Blob Storage account key instead of the current user identity to login (use az login to set current user for Azure)")
     parser.add_argument("--tenantid", required=False, help="Optional. Use this to define the Azure directory where to authenticate)")
-    parser.add_argument("--searchservice", help="Name of the Azure Cognitive Search service where content should be indexed (must exist already)")
+    parser.add_argument("--searchservice", help="Name of the Azure Cognitive Search service where content should be indexed (must exist already), can be omitted with --localsearchindex")
     parser.add_argument("--index", help="Name of the Azure Cognitive Search index where content should be indexed (will be created if it doesn't exist)")
     parser.add_argument("--searchkey", required=False, help="Optional. Use this Azure Cognitive Search account key instead of the current user identity to login (use az login to set current user for Azure)")
     parser.add_argument("--remove", action="store_true", help="Remove references to this document from blob storage and the search index")
@@ -287,6 +920,28 @@ if __name__ == "__main__":
     parser.add_argument("--localpdfparser", action="store_true", help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Form Recognizer service to extract text, tables and layout from the documents")
     parser.add_argument("--formrecognizerservice", required=False, help="Optional. Name of the Azure Form Recognizer service which will be used to extract text, tables and layout from the documents (must exist already)")
     parser.add_argument("--formrecognizerkey", required=False, help="Optional. Use this Azure Form Recognizer account key instead of the current user identity to login (use az login to set current user for Azure)")
+    parser.add_argument("--uploadworkers", type=int, default=8, help="Optional. Maximum number of page blobs uploaded at the same time (default 8)")
+    parser.add_argument("--renderworkers", type=int, default=os.cpu_count() or 1, help="Optional. Number of processes used to split PDFs into single page blobs (default: number of CPUs)")
+    parser.add_argument("--formrecognizerconcurrency", type=int, default=4, help="Optional. Maximum number of documents analyzed by Azure Form Recognizer at the same time (default 4)")
+    parser.add_argument("--formrecognizercache", required=False, help="Optional. Directory where Form Recognizer results are cached by document content, defaults to scripts/.prepdocs/formrecognizer")
+    parser.add_argument("--noformrecognizercache", action="store_true", help="Optional. Always analyze documents with Form Recognizer, even if results for the same content are cached")
+    parser.add_argument("--sectionlength", type=int, default=MAX_SECTION_LENGTH, help=f"Optional. Target length in characters of the sections indexed for each document (default {MAX_SECTION_LENGTH})")
+    parser.add_argument("--sectionoverlap", type=int, default=SECTION_OVERLAP, help=f"Optional. Number of characters shared by consecutive sections (default {SECTION_OVERLAP})")
+    parser.add_argument("--incremental", action="store_true", help="Optional. Skip files that haven't changed since the last run, only replace the sections of changed files that are different, and remove files that were deleted since the last run")
+    parser.add_argument("--manifest", required=False, help="Optional. Path of the file where content hashes are recorded for --incremental runs, defaults to scripts/.prepdocs/<index>.json")
+    parser.add_argument("--workers", type=int, default=1, help="Optional. Process this many files at a time, overlapping text extraction, splitting, blob upload and indexing across files")
+    parser.add_argument("--stageworkers", required=False, help="Optional. Per-stage concurrency limits when using --workers, e.g. 'extract=4,split=1,blobs=8,index=2'")
+    parser.add_argument("--localsearchindex", required=False, help="Optional. Directory of a local BM25 search index to add the sections to, which the app can search instead of Cognitive Search (LOCAL_SEARCH_INDEX_DIR). Without --searchservice only the local index is updated")
+    parser.add_argument("--vectorindex", required=False, help="Optional. Directory of a local vector index to add the sections to, for the vector and hybrid retrieval modes of the app (VECTOR_INDEX_DIR)")
+    parser.add_argument("--embedder", choices=["openai", "hash"], default="openai", help="Optional. Embed sections for --vectorindex with an Azure OpenAI embedding deployment, or with a deterministic hashing embedder that works offline (default openai)")
+    parser.add_argument("--openaiservice", required=False, help="Optional. Name of the Azure OpenAI service used to embed sections for --vectorindex")
+    parser.add_argument("--openaideployment", default="embedding", help="Optional. Name of the Azure OpenAI embedding deployment, e.g. of text-embedding-ada-002 (default embedding)")
+    parser.add_argument("--openaikey", required=False, help="Optional. Use this Azure OpenAI account key instead of the current user identity to login (use az login to set current user for Azure)")
+    parser.add_argument("--embeddingbatchsize", type=int, default=16, help="Optional. Maximum number of sections embedded per request (default 16, the limit of Azure OpenAI embedding deployments)")
+    parser.add_argument("--embeddingbatchtokens", type=int, default=32000, help="Optional. Maximum number of tokens embedded per request, counted as UTF-8 bytes (default 32000)")
+    parser.add_argument("--embeddingconcurrency", type=int, default=4, help="Optional. Maximum number of embedding requests in flight at the same time (default 4)")
+    parser.add_argument("--embeddingcache", required=False, help="Optional. Path of the database where section embeddings are cached by content, defaults to scripts/.prepdocs/embeddings.sqlite")
+    parser.add_argument("--noembeddingcache", action="store_true", help="Optional. Always embed sections, even if embeddings for the same content are cached")
     parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
     args = parser.parse_args()
 
@@ -294,35 +949,147 @@ if __name__ == "__main__":
     azd_credential = AzureDeveloperCliCredential() if args.tenantid == None else AzureDeveloperCliCredential(tenant_id=args.tenantid, process_timeout=60)
     default_creds = azd_credential if args.searchkey == None or args.storagekey == None else None
     search_creds = default_creds if args.searchkey == None else AzureKeyCredential(args.searchkey)
-    if not args.skipblobs:
+    # The container also holds the index generation, so it's needed to bump it even when the blobs are skipped
+    blob_container = None
+    if not args.skipblobs or args.storageaccount:
         storage_creds = default_creds if args.storagekey == None else args.storagekey
+        blob_container = create_blob_container()
+    if not args.skipblobs:
+        upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.uploadworkers), thread_name_prefix="upload")
+        page_renderer = concurrent.futures.ProcessPoolExecutor(max_workers=args.renderworkers) if args.renderworkers > 1 else None
     if not args.localpdfparser:
         # check if Azure Form Recognizer credentials are provided
         if args.formrecognizerservice == None:
             print("Error: Azure Form Recognizer service is not provided. Please provide formrecognizerservice or use --localpdfparser for local pypdf parser.")
             exit(1)
         formrecognizer_creds = default_creds if args.formrecognizerkey == None else AzureKeyCredential(args.formrecognizerkey)
+        form_recognizer_cache = None
+        if not args.noformrecognizercache:
+            form_recognizer_cache = FormRecognizerCache(args.formrecognizercache or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".prepdocs", "formrecognizer"))
+        form_recognizer = FormRecognizerAnalyzer(DocumentAnalysisClient(endpoint=f"https://{args.formrecognizerservice}.cognitiveservices.azure.com/", credential=formrecognizer_creds, headers={"x-ms-useragent": "azure-search-chat-demo/1.0.0"}),
+                                                 cache=form_recognizer_cache,
+                                                 max_concurrency=max(1, args.formrecognizerconcurrency))
+    if args.localsearchindex or args.vectorindex:
+        # The local indexes are shared with the app, which reads them with the same modules
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+    if args.localsearchindex:
+        from localsearch import LocalSearchIndexWriter
+        local_search_index = LocalSearchIndexWriter(args.localsearchindex)
+    if args.vectorindex:
+        from vectorindex import HashEmbedder, OpenAIEmbedder, VectorIndexWriter
+        if args.embedder == "openai":
+            if args.openaiservice == None:
+                print("Error: Azure OpenAI service is not provided. Please provide openaiservice or use --embedder hash for the offline embedder.")
+                exit(1)
+            import openai
+            openai.api_base = f"https://{args.openaiservice}.openai.azure.com"
+            openai.api_version = "2023-05-15"
+            if args.openaikey == None:
+                openai.api_type = "azure_ad"
+                openai.api_key = azd_credential.get_token("https://cognitiveservices.azure.com/.default").token
+            else:
+                openai.api_type = "azure"
+                openai.api_key = args.openaikey
+            embedder = OpenAIEmbedder(args.openaideployment, batch_size=args.embeddingbatchsize)
+        else:
+            embedder = HashEmbedder()
+        embedding_cache = None
+        if not args.noembeddingcache:
+            embedding_cache = EmbeddingCache(args.embeddingcache or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".prepdocs", "embeddings.sqlite"))
+        batch_embedder = BatchEmbedder(embedder,
+                                       cache=embedding_cache,
+                                       max_batch_size=max(1, args.embeddingbatchsize),
+                                       max_batch_tokens=args.embeddingbatchtokens,
+                                       max_concurrency=max(1, args.embeddingconcurrency))
+        vector_index = VectorIndexWriter(args.vectorindex, batch_embedder)
 
 
+    # The manifest is kept up to date whenever it exists, so that an --incremental run after a regular one is accurate
+    manifest_path = args.manifest or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".prepdocs", f"{args.index}.json")
+    manifest = IngestionManifest(manifest_path) if args.incremental or os.path.exists(manifest_path) else None
+
+    # Only runs that add, change or remove sections bump the index generation
+    index_changed = False
     if args.removeall:
-        remove_blobs(None)
-        remove_from_index(None)
+        if not args.skipblobs:
+            remove_blobs(None)
+        index_changed = remove_from_index(None)
+        if manifest: manifest.clear()
     else:
         if not args.remove:
             create_search_index()
         
         print(f"Processing files...")
-        for filename in glob.glob(args.files):
-            if args.verbose: print(f"Processing '{filename}'")
-            if args.remove:
-                remove_blobs(filename)
-                remove_from_index(filename)
-            elif args.removeall:
-                remove_blobs(None)
-                remove_from_index(None)
-            else:
+        filenames = glob.glob(args.files)
+        file_hashes = {}
+        if args.incremental and not args.remove:
+            for filename in manifest.deleted_files(args.files, filenames):
+                print(f"Removing '{filename}', which was deleted since the last run")
                 if not args.skipblobs:
-                    upload_blobs(filename)
-                page_map = get_document_text(filename)
-                sections = create_sections(os.path.basename(filename), page_map)
-                index_sections(os.path.basename(filename), sections)
+                    remove_blobs(filename, manifest.get(filename).get("blobs"))
+                index_changed = remove_from_index(filename) or index_changed
+                manifest.remove(filename)
+            changed_filenames = []
+            for filename in filenames:
+                file_hashes[filename] = file_hash(filename)
+                if manifest.get(filename).get("hash") == file_hashes[filename]:
+                    if args.verbose: print(f"Skipping unchanged '{filename}'")
+                else:
+                    changed_filenames.append(filename)
+            print(f"Skipping {len(filenames) - len(changed_filenames)} unchanged files, processing {len(changed_filenames)} new or changed files")
+            filenames = changed_filenames
+
+        if args.workers > 1 and not args.remove:
+            index_changed = process_files_in_pipeline(filenames, manifest, file_hashes) or index_changed
+        else:
+            for i, filename in enumerate(filenames):
+                if args.verbose: print(f"Processing '{filename}'")
+                if not args.localpdfparser and not args.remove:
+                    # Keep the analyses of the next files running while this one is uploaded and indexed
+                    form_recognizer.prefetch(filenames[i:i + 2 * args.formrecognizerconcurrency])
+                if args.remove:
+                    if not args.skipblobs:
+                        remove_blobs(filename, (manifest.get(filename) if manifest else {}).get("blobs"))
+                    index_changed = remove_from_index(filename) or index_changed
+                    if manifest: manifest.remove(filename)
+                elif args.removeall:
+                    if not args.skipblobs:
+                        remove_blobs(None)
+                    index_changed = remove_from_index(None) or index_changed
+                else:
+                    known = manifest.get(filename) if manifest else {}
+                    blob_hashes = known.get("blobs", {})
+                    if not args.skipblobs:
+                        blob_hashes = upload_blobs(filename, known.get("blobs") if args.incremental else None)
+                    page_map = get_document_text(filename)
+                    sections = list(create_sections(os.path.basename(filename), page_map))
+                    section_hashes, changed = index_sections(os.path.basename(filename), sections, known.get("sections") if args.incremental else None)
+                    index_changed = index_changed or changed
+                    if args.vectorindex:
+                        embed_sections(os.path.basename(filename), sections)
+                    if manifest:
+                        manifest.update(filename, file_hashes.get(filename) or file_hash(filename), blob_hashes, section_hashes)
+
+    if args.localsearchindex:
+        local_search_index.save()
+        print(f"Saved {len(local_search_index.sections)} sections to local search index '{args.localsearchindex}'")
+
+    if args.vectorindex:
+        vector_index.save()
+        print(f"Saved {len(vector_index.sections)} section vectors to local vector index '{args.vectorindex}', embedded {batch_embedder.embedded} sections "
+              f"in {batch_embedder.batches} requests, reused {batch_embedder.cached} cached embeddings, retried {batch_embedder.retries} throttled requests")
+        batch_embedder.close()
+
+    if index_changed:
+        if blob_container is not None:
+            update_index_generation()
+        else:
+            print("The index changed but --storageaccount wasn't given, the app will only see the changes once its cached search results expire")
+    if not args.skipblobs:
+        upload_executor.shutdown()
+        if page_renderer: page_renderer.shutdown()
+
+    if not args.localpdfparser:
+        if form_recognizer.analyzed or form_recognizer.cached:
+            print(f"Form Recognizer analyzed {form_recognizer.analyzed} documents, reused {form_recognizer.cached} cached results, retried {form_recognizer.retries} throttled requests")
+        form_recognizer.close()
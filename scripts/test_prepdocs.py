@@ -1,4 +1,21 @@
-from prepdocs import filename_to_id
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import types
+
+import numpy as np
+import openai
+import pytest
+from azure.ai.formrecognizer import AnalyzeResult
+from azure.core.exceptions import HttpResponseError
+
+import prepdocs
+from prepdocs import filename_to_id, run_pipeline, PipelineStage
 
 def test_filename_to_id():
     # test ascii filename
@@ -7,3 +24,309 @@ def test_filename_to_id():
     assert filename_to_id("foo\u00A9.txt") == "file-foo__txt-666F6FC2A92E747874"
     # test filenaming starting with unicode
     assert filename_to_id("ファイル名.pdf") == "file-______pdf-E38395E382A1E382A4E383ABE5908D2E706466"
+
+def test_run_pipeline():
+    indexed = []
+    lock = threading.Lock()
+    def extract(filename, _):
+        if filename == "bad.pdf":
+            raise ValueError("corrupt file")
+        time.sleep(0.01)
+        return filename.upper()
+    def index(filename, payload):
+        with lock:
+            indexed.append((filename, payload))
+
+    stages = [PipelineStage("extract", extract, 4, 2), PipelineStage("index", index, 2, 2)]
+    failures = run_pipeline([f"{i}.pdf" for i in range(10)] + ["bad.pdf"], stages)
+
+    assert sorted(indexed) == sorted((f"{i}.pdf", f"{i}.PDF") for i in range(10))
+    assert [(f, stage) for f, stage, _ in failures] == [("bad.pdf", "extract")]
+    assert stages[0].items == 10 and stages[1].items == 10
+
+class FakeSearchClient:
+    def __init__(self, *args, **kwargs):
+        self.uploaded = []
+        self.deleted = []
+        FakeSearchClient.instance = self
+    def upload_documents(self, documents):
+        self.uploaded.extend(documents)
+        return [types.SimpleNamespace(succeeded=True) for _ in documents]
+    def delete_documents(self, documents):
+        self.deleted.extend(documents)
+        return documents
+
+def test_index_sections_only_replaces_changed_sections(monkeypatch, tmp_path):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(verbose=False, searchservice="svc", index="idx", localsearchindex=None), raising=False)
+    monkeypatch.setattr(prepdocs, "search_creds", None, raising=False)
+    monkeypatch.setattr(prepdocs, "SearchClient", FakeSearchClient)
+
+    sections = [{"id": f"s-{i}", "content": f"section {i}"} for i in range(3)]
+    known, _ = prepdocs.index_sections("a.pdf", sections)
+    assert len(FakeSearchClient.instance.uploaded) == 3
+
+    changed = [sections[0], {"id": "s-1", "content": "section 1 v2"}]
+    prepdocs.index_sections("a.pdf", changed, known)
+    assert [s["id"] for s in FakeSearchClient.instance.uploaded] == ["s-1"]
+    assert FakeSearchClient.instance.deleted == [{"id": "s-2"}]
+
+def test_index_sections_reports_whether_the_index_changed(monkeypatch):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(verbose=False, searchservice="svc", index="idx", localsearchindex=None), raising=False)
+    monkeypatch.setattr(prepdocs, "search_creds", None, raising=False)
+    monkeypatch.setattr(prepdocs, "SearchClient", FakeSearchClient)
+
+    sections = [{"id": f"s-{i}", "content": f"section {i}"} for i in range(2)]
+    known, changed = prepdocs.index_sections("a.pdf", sections)
+    assert changed
+
+    _, changed = prepdocs.index_sections("a.pdf", sections, known)
+    assert not changed
+
+    _, changed = prepdocs.index_sections("a.pdf", sections[:1], known)
+    assert changed
+
+def test_manifest_deleted_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(index="idx"), raising=False)
+    manifest = prepdocs.IngestionManifest(str(tmp_path / "manifest.json"))
+    manifest.update(str(tmp_path / "data" / "a.pdf"), "h1", {}, {})
+    manifest.update(str(tmp_path / "data" / "b.pdf"), "h2", {}, {})
+    manifest.update(str(tmp_path / "other" / "c.pdf"), "h3", {}, {})
+
+    reloaded = prepdocs.IngestionManifest(str(tmp_path / "manifest.json"))
+    assert reloaded.get("a.pdf")["hash"] == "h1"
+    # c.pdf isn't covered by the glob pattern of this run, so it must not be considered deleted
+    assert reloaded.deleted_files(str(tmp_path / "data" / "*"), [str(tmp_path / "data" / "a.pdf")]) == [str(tmp_path / "data" / "b.pdf")]
+
+def test_text_splitter_cuts_at_sentence_endings():
+    sentences = [f"Sentence {i} is about fees!" for i in range(40)]
+    page_map = []
+    offset = 0
+    for page_num in range(4):
+        text = " ".join(sentences[page_num * 10:(page_num + 1) * 10]) + " "
+        page_map.append((page_num, offset, text))
+        offset += len(text)
+    all_text = "".join(p[2] for p in page_map)
+
+    sections = list(prepdocs.TextSplitter(max_section_length=100, sentence_search_limit=30, section_overlap=20).split_pages(page_map))
+    assert len(sections) > 4
+    for section, page_num in sections:
+        start = all_text.index(section)
+        assert page_map[page_num][1] <= start < page_map[page_num][1] + len(page_map[page_num][2])
+        # Every section starts at the beginning of a sentence and ends right after one
+        assert section.startswith(" Sentence") or start == 0
+        assert section.endswith("!") or section.endswith("! ")
+    assert all_text.startswith(sections[0][0])
+    assert all_text.endswith(sections[-1][0])
+
+def test_text_splitter_matches_legacy_output_with_default_settings():
+    # The expected sections were produced by the former per-character splitter (benchmarks/bench_split_text.py), for a
+    # document with empty pages, tables, a page without sentence endings and a page without any word break
+    with open(os.path.join(os.path.dirname(__file__), "testdata", "split_text.legacy.json"), encoding="utf-8") as f:
+        recorded = json.load(f)
+    page_map = [tuple(p) for p in recorded["page_map"]]
+    assert [list(s) for s in prepdocs.TextSplitter().split_pages(page_map)] == recorded["sections"]
+    assert list(prepdocs.TextSplitter().split_pages([(0, 0, "")])) == []
+
+def test_text_splitter_rejects_overlap_longer_than_section():
+    with pytest.raises(ValueError):
+        prepdocs.TextSplitter(max_section_length=100, section_overlap=100)
+
+@pytest.mark.parametrize("fixture", sorted(glob.glob(os.path.join(os.path.dirname(__file__), "testdata", "*.layout.json"))))
+def test_form_recognizer_page_map_matches_recorded_pages(fixture):
+    # The expected page maps were produced by the former per-character implementation
+    with open(fixture, encoding="utf-8") as f:
+        recorded = json.load(f)
+    page_map = prepdocs.form_recognizer_page_map(AnalyzeResult.from_dict(recorded["analyze_result"]))
+    assert [list(p) for p in page_map] == recorded["page_map"]
+
+def test_form_recognizer_page_map_overlapping_tables():
+    def table(offset, length, content):
+        cell = {"kind": "content", "row_index": 0, "column_index": 0, "row_span": 1, "column_span": 1, "content": content}
+        return {"row_count": 1, "column_count": 1, "cells": [cell], "bounding_regions": [{"page_number": 1, "polygon": []}], "spans": [{"offset": offset, "length": length}]}
+    result = AnalyzeResult.from_dict({
+        "content": "abcdefghij",
+        "pages": [{"page_number": 1, "spans": [{"offset": 0, "length": 10}]}],
+        # the second table covers the middle of the first one, the text of the first table resumes after it
+        "tables": [table(1, 6, "A"), table(3, 2, "B")]})
+    assert prepdocs.form_recognizer_page_map(result) == [(0, 0, "a<table><tr><td>A</td></tr></table><table><tr><td>B</td></tr></table>hij ")]
+
+class FakePoller:
+    def __init__(self, client):
+        self.client = client
+
+    def result(self):
+        with self.client.lock:
+            self.client.in_flight += 1
+            self.client.max_in_flight = max(self.client.max_in_flight, self.client.in_flight)
+        time.sleep(0.01)
+        with self.client.lock:
+            self.client.in_flight -= 1
+        return self.client.result
+
+class FakeFormRecognizerClient:
+    """Stands in for DocumentAnalysisClient, answering with a recorded layout after throttling the first requests."""
+    def __init__(self, result, throttled_requests = 0):
+        self.result = result
+        self.throttled_requests = throttled_requests
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def begin_analyze_document(self, model, document, locale):
+        with self.lock:
+            self.calls += 1
+            if self.throttled_requests > 0:
+                self.throttled_requests -= 1
+                error = HttpResponseError(message="Too Many Requests")
+                error.status_code = 429
+                raise error
+        return FakePoller(self)
+
+def recorded_layout():
+    with open(os.path.join(os.path.dirname(__file__), "testdata", "SA_SS_ttb-all-free.layout.json"), encoding="utf-8") as f:
+        return AnalyzeResult.from_dict(json.load(f)["analyze_result"])
+
+def test_form_recognizer_results_are_cached_by_content(monkeypatch, tmp_path):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(verbose=False), raising=False)
+    for name in ("a.pdf", "b.pdf"):
+        (tmp_path / name).write_bytes(b"same content")
+    client = FakeFormRecognizerClient(recorded_layout(), throttled_requests=2)
+    analyzer = prepdocs.FormRecognizerAnalyzer(client, cache=prepdocs.FormRecognizerCache(str(tmp_path / "cache")), backoff_seconds=0)
+
+    first = analyzer.analyze(str(tmp_path / "a.pdf"))
+    # b.pdf has the same content, so it is served from the cache
+    second = analyzer.analyze(str(tmp_path / "b.pdf"))
+    assert prepdocs.form_recognizer_page_map(first) == prepdocs.form_recognizer_page_map(second)
+    assert client.calls == 3
+    assert (analyzer.analyzed, analyzer.cached, analyzer.retries) == (1, 1, 2)
+
+    # A different locale is a different analysis
+    analyzer.locale = "en-US"
+    analyzer.analyze(str(tmp_path / "a.pdf"))
+    assert client.calls == 4
+
+def test_form_recognizer_concurrency_is_capped(monkeypatch, tmp_path):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(verbose=False), raising=False)
+    filenames = []
+    for i in range(8):
+        (tmp_path / f"{i}.pdf").write_bytes(str(i).encode())
+        filenames.append(str(tmp_path / f"{i}.pdf"))
+    client = FakeFormRecognizerClient(recorded_layout())
+    analyzer = prepdocs.FormRecognizerAnalyzer(client, max_concurrency=3)
+
+    analyzer.prefetch(filenames)
+    results = [analyzer.analyze(filename) for filename in filenames]
+    assert len(results) == 8
+    assert client.calls == 8
+    assert client.max_in_flight <= 3
+
+def test_form_recognizer_gives_up_after_max_retries(monkeypatch, tmp_path):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(verbose=False), raising=False)
+    (tmp_path / "a.pdf").write_bytes(b"content")
+    client = FakeFormRecognizerClient(recorded_layout(), throttled_requests=10)
+    analyzer = prepdocs.FormRecognizerAnalyzer(client, max_retries=2, backoff_seconds=0)
+    with pytest.raises(HttpResponseError):
+        analyzer.analyze(str(tmp_path / "a.pdf"))
+    assert client.calls == 3
+
+class FakeContainerClient:
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.uploaded = []
+        self.deleted = []
+
+    def list_blobs(self, name_starts_with):
+        return [types.SimpleNamespace(name=name, content_settings=types.SimpleNamespace(content_md5=bytearray.fromhex(md5)))
+                for name, md5 in self.blobs.items() if name.startswith(name_starts_with)]
+
+    def upload_blob(self, name, data, overwrite, content_settings):
+        self.uploaded.append(name)
+        self.blobs[name] = bytes(content_settings.content_md5).hex()
+
+    def list_blob_names(self, name_starts_with = ""):
+        return [name for name in self.blobs if name.startswith(name_starts_with)]
+
+    def delete_blob(self, name):
+        self.deleted.append(name)
+
+def test_upload_blobs_skips_pages_already_in_storage(monkeypatch):
+    filename = os.path.join(os.path.dirname(__file__), "data", "tc_accident_insurance_all_free.pdf")
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(verbose=False), raising=False)
+    monkeypatch.setattr(prepdocs, "PAGES_PER_RENDER_TASK", 2)
+    monkeypatch.setattr(prepdocs, "page_renderer", None, raising=False)
+    monkeypatch.setattr(prepdocs, "upload_executor", concurrent.futures.ThreadPoolExecutor(4), raising=False)
+    inline_hashes = dict((prepdocs.blob_name_from_file_page(filename, i), hashlib.md5(data).hexdigest()) for i, data in prepdocs.rendered_pdf_pages(filename))
+
+    # Pages rendered by the process pool are identical to the ones rendered inline
+    with concurrent.futures.ProcessPoolExecutor(2) as page_renderer:
+        monkeypatch.setattr(prepdocs, "page_renderer", page_renderer)
+        container = FakeContainerClient({"tc_accident_insurance_all_free-0.pdf": inline_hashes["tc_accident_insurance_all_free-0.pdf"],
+                                         "tc_accident_insurance_all_free-1.pdf": "00" * 16})
+        monkeypatch.setattr(prepdocs, "blob_container", container, raising=False)
+        blob_hashes = prepdocs.upload_blobs(filename, known_blobs={"tc_accident_insurance_all_free-2.pdf": inline_hashes["tc_accident_insurance_all_free-2.pdf"],
+                                                                    "tc_accident_insurance_all_free-9.pdf": "11" * 16})
+
+    assert blob_hashes == inline_hashes
+    assert list(blob_hashes) == [prepdocs.blob_name_from_file_page(filename, i) for i in range(6)]
+    # page 0 matches the blob in storage, page 2 the hash from the last run, page 1 changed
+    assert sorted(container.uploaded) == [prepdocs.blob_name_from_file_page(filename, i) for i in (1, 3, 4, 5)]
+    assert container.deleted == ["tc_accident_insurance_all_free-9.pdf"]
+
+def test_remove_blobs_deletes_the_blobs_recorded_for_the_file(monkeypatch):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(verbose=False), raising=False)
+    container = FakeContainerClient({"ttb-all-free.docx": "00" * 16, "ttb-all-free-0.pdf": "11" * 16, "ttb-all-free-1.pdf": "22" * 16,
+                                     "ttb-all-free-debit-card-0.pdf": "33" * 16, "ttb-all-free.html": "44" * 16})
+    monkeypatch.setattr(prepdocs, "blob_container", container, raising=False)
+
+    prepdocs.remove_blobs("data/ttb-all-free.docx", {"ttb-all-free.docx": "00" * 16})
+    assert container.deleted == ["ttb-all-free.docx"]
+
+    # Without a manifest, the pages of a PDF or the file itself
+    container.deleted = []
+    prepdocs.remove_blobs("data/ttb-all-free.pdf")
+    prepdocs.remove_blobs("data/ttb-all-free.html")
+    assert container.deleted == ["ttb-all-free-0.pdf", "ttb-all-free-1.pdf", "ttb-all-free.html"]
+
+class FakeEmbedder:
+    name = "fake"
+    dim = 4
+
+    def __init__(self, throttled_requests = 0):
+        self.batches = []
+        self.throttled_requests = throttled_requests
+        self.lock = threading.Lock()
+
+    def config(self):
+        return {"name": self.name, "dim": self.dim}
+
+    def embed(self, texts):
+        with self.lock:
+            if self.throttled_requests > 0:
+                self.throttled_requests -= 1
+                raise openai.error.RateLimitError("Requests to the Embeddings Operation have exceeded the rate limit", http_status=429, headers={"Retry-After": "0"})
+            self.batches.append(list(texts))
+        return np.array([[len(t), 1, 0, 0] for t in texts], dtype=np.float32)
+
+def test_embeddings_are_batched_and_cached_by_content(monkeypatch, tmp_path):
+    monkeypatch.setattr(prepdocs, "args", argparse.Namespace(verbose=False), raising=False)
+    embedder = FakeEmbedder(throttled_requests=1)
+    cache = prepdocs.EmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    batch_embedder = prepdocs.BatchEmbedder(embedder, cache=cache, max_batch_size=3, max_batch_tokens=40, backoff_seconds=0)
+
+    # Thai characters count as 3 bytes each and the duplicate is only embedded once: the batches are split when
+    # they would go over 40 tokens or 3 sections
+    texts = ["บัตรเดบิต"[:4], "a" * 10, "a" * 10, "b" * 30, "c", "d", "e", "f"]
+    vectors = batch_embedder.embed(texts)
+    assert vectors[:, 0].tolist() == [len(t) for t in texts]
+    assert sorted(map(len, embedder.batches)) == [2, 2, 3]
+    assert all(sum(len(t.encode("utf-8")) for t in batch) <= 40 for batch in embedder.batches)
+    assert (batch_embedder.embedded, batch_embedder.batches, batch_embedder.retries) == (7, 3, 1)
+    batch_embedder.close()
+
+    # Unchanged sections cost no embedding calls on the next run
+    embedder.batches = []
+    batch_embedder = prepdocs.BatchEmbedder(embedder, cache=prepdocs.EmbeddingCache(str(tmp_path / "embeddings.sqlite")))
+    assert np.array_equal(batch_embedder.embed(texts + ["g"]), np.concatenate([vectors, [[1, 1, 0, 0]]]))
+    assert embedder.batches == [["g"]]
+    assert batch_embedder.cached == 8